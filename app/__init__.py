@@ -1,33 +1,87 @@
 # pylint: disable=wrong-import-position,import-outside-toplevel
 
-from elasticsearch import Elasticsearch
 from flask import Flask
 from flask_login import LoginManager
-from flask_migrate import Migrate
-from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 
+from app.replicas import RoutingSQLAlchemy, release_writer, remember_write
+from app.startup import LazyMigrate, LazyMoment, bytecode_cache
 from config import Config
 
-db = SQLAlchemy()
-migrate = Migrate()
+db = RoutingSQLAlchemy()
+db.event.listen(db.session, 'after_commit', remember_write)
+db.event.listen(db.session, 'after_commit', release_writer)
+db.event.listen(db.session, 'after_rollback', release_writer)
+migrate = LazyMigrate()
 login = LoginManager()
 login.login_view = 'auth.login'
 
-moment = Moment()
+moment = LazyMoment()
+
+from app.activity import LastSeenBuffer
+last_seen = LastSeenBuffer()
+
+from app.search import LazyElasticsearch, SearchIndexer, make_backend
+search_indexer = SearchIndexer()
+
+from app.fragments import FragmentCache
+fragments = FragmentCache()
+
+from app.timelines import TimelineCache
+timeline_cache = TimelineCache()
+
+from app.trending import TrendingRanking
+trending = TrendingRanking()
+
+from app.tags import TagIndex
+tag_index = TagIndex()
+
+from app.suggestions import Suggestions
+suggestions = Suggestions()
+
+from app.stream import PostStream
+post_stream = PostStream()
+
+from app.metrics import Metrics
+metrics = Metrics()
+
+from app.hashing import PasswordHasher
+hasher = PasswordHasher()
+
+from app.identity import IdentityCache
+identity_cache = IdentityCache()
+
+from app.assets import Assets
+assets = Assets()
+
+from app.compression import Compressor
+compressor = Compressor()
 
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    bytecode_cache(app)
 
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
     moment.init_app(app)
+    last_seen.init_app(app)
+    search_indexer.init_app(app)
+    fragments.init_app(app)
+    timeline_cache.init_app(app)
+    trending.init_app(app)
+    suggestions.init_app(app)
+    tag_index.init_app(app)
+    post_stream.init_app(app)
+    metrics.init_app(app)
+    hasher.init_app(app)
+    identity_cache.init_app(app)
+    assets.init_app(app)
+    compressor.init_app(app)
 
-    print(app.config['ELASTICSEARCH_URL'])
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
+    app.elasticsearch = LazyElasticsearch(app.config['ELASTICSEARCH_URL']) \
         if app.config['ELASTICSEARCH_URL'] else None
+    app.search_backend = make_backend(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
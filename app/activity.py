@@ -0,0 +1,75 @@
+import atexit
+from datetime import datetime
+import threading
+
+from flask import current_app
+
+from app import db
+
+# lightweight handle on the user table so this module doesn't import models
+_user = db.table('user', db.column('id'), db.column('last_seen'))
+
+class _Pending(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seen = {}
+        self.timer = None
+
+class LastSeenBuffer(object):
+    """write-behind buffer for User.last_seen
+
+    Requests record a timestamp in memory; the buffer is written back in one
+    batched UPDATE once LAST_SEEN_FLUSH_INTERVAL seconds have passed since
+    the first pending entry or LAST_SEEN_FLUSH_SIZE users are waiting,
+    whichever comes first, and once more at interpreter shutdown. An interval
+    of 0 writes through on every request.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LAST_SEEN_FLUSH_INTERVAL', 60)
+        app.config.setdefault('LAST_SEEN_FLUSH_SIZE', 500)
+        app.extensions['last_seen'] = _Pending()
+        atexit.register(self._flush_app, app)
+
+    def touch(self, user_id, when=None):
+        app = current_app._get_current_object() # pylint: disable=protected-access
+        pending = app.extensions['last_seen']
+        interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        with pending.lock:
+            pending.seen[user_id] = when or datetime.utcnow()
+            due = interval <= 0 or \
+                len(pending.seen) >= app.config['LAST_SEEN_FLUSH_SIZE']
+            if not due and pending.timer is None:
+                pending.timer = threading.Timer(
+                    interval, self._flush_app, [app]
+                )
+                pending.timer.daemon = True
+                pending.timer.start()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """write every pending last_seen value in a single UPDATE"""
+        pending = current_app.extensions['last_seen']
+        with pending.lock:
+            seen, pending.seen = pending.seen, {}
+            if pending.timer is not None:
+                pending.timer.cancel()
+                pending.timer = None
+        if not seen:
+            return
+        with db.write_engine.begin() as conn:
+            conn.execute(
+                _user.update().where(
+                    _user.c.id == db.bindparam('_id')
+                ).values(last_seen=db.bindparam('_last_seen')),
+                [{'_id': _id, '_last_seen': when} for _id, when in seen.items()]
+            )
+
+    def _flush_app(self, app):
+        with app.app_context():
+            self.flush()
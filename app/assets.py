@@ -0,0 +1,172 @@
+"""fingerprinted, precompressed static assets
+
+`flask assets vendor` downloads the pinned third-party scripts the pages
+use into app/static/vendor, checking them against their SRI hashes, and is
+meant to be run once and committed. `flask assets build` then copies every
+file under app/static to ASSETS_DIST with a content hash in its name, next
+to .gz (and .br, when the brotli package is installed) variants and a
+manifest.json mapping names to hashed names; run it on each deploy. It
+refuses to build while a vendored script fails its hash, or is missing and
+ASSETS_CDN_FALLBACK is off.
+
+asset_url() in templates returns the hashed /assets/ url for a name from
+the manifest, which is served with a year long immutable Cache-Control and
+the best precompressed variant the client accepts. Names missing from the
+manifest fall back to /static/, or to None when there is no such file.
+vendored() does the same for the VENDOR scripts; while one is missing,
+pages load it from its CDN, or fail when ASSETS_CDN_FALLBACK is off.
+"""
+from base64 import b64encode
+from hashlib import md5, sha384
+import json
+import mimetypes
+import os
+import shutil
+from urllib.request import urlopen
+
+from flask import current_app, send_from_directory, url_for
+
+from app.compression import choose_encoding, compress, encodings
+
+# name under app/static -> (url, subresource integrity), the builds
+# flask-moment 0.10 would otherwise load from a cdn
+VENDOR = {
+    'vendor/jquery-3.5.1.min.js': (
+        'https://code.jquery.com/jquery-3.5.1.min.js',
+        'sha384-ZvpUoO/+PpLXR1lu4jmpXWu80pZlYUAfxl5NsBMWOEPSjUn/6Z/hRTt8+pR6L4N2',
+    ),
+    'vendor/moment-with-locales-2.26.0.min.js': (
+        'https://cdnjs.cloudflare.com/ajax/libs/moment.js/2.26.0/moment-with-locales.min.js',
+        'sha384-WxkyfzCCre+H1hXpoMH2JOqSotIuNoiH5KQ4zCQxIxOSHo49PeKFlgftAkREuLTR',
+    ),
+}
+
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+class Assets(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_DIST', os.path.join(app.static_folder, 'dist'))
+        app.config.setdefault('ASSETS_MAX_AGE', 365 * 24 * 60 * 60)
+        app.config.setdefault('ASSETS_CDN_FALLBACK', True)
+        app.extensions['assets'] = load_manifest(app.config['ASSETS_DIST'])
+        app.add_template_global(asset_url, 'asset_url')
+        app.add_template_global(vendored, 'vendored')
+        app.add_url_rule('/assets/<path:filename>', 'assets', serve)
+
+def load_manifest(dist):
+    try:
+        with open(os.path.join(dist, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def asset_url(name):
+    """url of a file under app/static, fingerprinted once built"""
+    hashed = current_app.extensions['assets'].get(name)
+    if hashed is not None:
+        return url_for('assets', filename=hashed)
+    if os.path.isfile(os.path.join(current_app.static_folder, name)):
+        return url_for('static', filename=name)
+    return None
+
+def vendored(name):
+    """asset_url() of a VENDOR script, None to load it from its CDN"""
+    url = asset_url(name)
+    if url is None and not current_app.config['ASSETS_CDN_FALLBACK']:
+        raise RuntimeError('{} is not vendored, run `flask assets vendor` '
+                           'or set ASSETS_CDN_FALLBACK'.format(name))
+    return url
+
+def serve(filename):
+    """a built asset, precompressed when the client accepts it"""
+    dist = current_app.config['ASSETS_DIST']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    available = [encoding for encoding in encodings()
+                 if os.path.isfile(os.path.join(dist, filename + SUFFIXES[encoding]))]
+    encoding = choose_encoding(available)
+    response = send_from_directory(
+        dist, filename + SUFFIXES[encoding] if encoding else filename,
+        mimetype=mimetype, cache_timeout=current_app.config['ASSETS_MAX_AGE']
+    )
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def integrity(data):
+    """the subresource integrity hash of `data`"""
+    return 'sha384-' + b64encode(sha384(data).digest()).decode()
+
+def vendor(static_folder):
+    """download the VENDOR scripts missing from `static_folder`"""
+    fetched = []
+    for name, (url, sri) in VENDOR.items():
+        path = os.path.join(static_folder, name)
+        if os.path.isfile(path):
+            continue
+        with urlopen(url, timeout=30) as response:
+            data = response.read()
+        if integrity(data) != sri:
+            raise ValueError('{} does not match its integrity hash'.format(url))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        fetched.append(name)
+    return fetched
+
+def check_vendored(static_folder, scripts=None, missing_ok=False):
+    """raise ValueError unless every VENDOR script is present and intact"""
+    for name, (_, sri) in (VENDOR if scripts is None else scripts).items():
+        try:
+            with open(os.path.join(static_folder, name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            if missing_ok:
+                continue
+            raise ValueError('{} is missing, run `flask assets vendor`'.format(name))
+        if integrity(data) != sri:
+            raise ValueError('{} does not match its integrity hash'.format(name))
+
+def build(static_folder, dist, level=9, scripts=None, missing_ok=False):
+    """fingerprint and precompress everything under `static_folder` into `dist`
+
+    `scripts` are the vendored scripts that must be there, VENDOR by default;
+    with missing_ok they only need to be intact when present.
+    """
+    check_vendored(static_folder, scripts, missing_ok)
+    static_folder, dist = os.path.abspath(static_folder), os.path.abspath(dist)
+    if os.path.isdir(dist):
+        shutil.rmtree(dist)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.join(root, d) != dist and not d.startswith('.'))
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(name)
+            hashed = '{}.{}{}'.format(stem, md5(data).hexdigest()[:12], ext)
+            target = os.path.join(dist, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            for encoding in encodings():
+                packed = compress(data, encoding, level)
+                if len(packed) < len(data):
+                    with open(target + SUFFIXES[encoding], 'wb') as f:
+                        f.write(packed)
+            manifest[name] = hashed
+    os.makedirs(dist, exist_ok=True)
+    with open(os.path.join(dist, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
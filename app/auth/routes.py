@@ -19,6 +19,10 @@ def login():
         if _user is None or not _user.check_password(form.password.data):
             flash('invalid username or password ;-(')
             return redirect(url_for('auth.login'))
+        if _user.password_needs_rehash():
+            # the configured cost changed since this hash was made
+            _user.set_password(form.password.data)
+            db.session.commit()
         login_user(_user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         # Check that next is not set to an absolute URL with a foreign domain
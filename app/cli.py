@@ -0,0 +1,147 @@
+import click
+
+from app import suggestions, tag_index, trending
+from app.assets import build, vendor
+from app.models import Post, User
+from app.replicas import sync_replicas
+from app.search import drain_outbox, outbox_lag
+from app.startup import compile_templates
+
+def register(app):
+    @app.cli.group()
+    def timeline():
+        """home timeline maintenance commands"""
+
+    @timeline.command()
+    def rebuild():
+        """rebuild every home timeline from posts and follows"""
+        User.rebuild_timelines()
+
+    @app.cli.group()
+    def counters():
+        """denormalized counter maintenance commands"""
+
+    @counters.command()
+    def reconcile():
+        """recompute follower, following and post counts for every user"""
+        User.reconcile_counters()
+
+    @app.cli.group('trending')
+    def trending_group():
+        """trending ranking commands"""
+
+    @trending_group.command()
+    def decay():
+        """drop posts that decayed out of the ranking; run every few minutes"""
+        click.echo('dropped {} posts'.format(trending.decay()))
+
+    @trending_group.command('rebuild')
+    def rebuild_trending():
+        """rank recent posts from scratch"""
+        click.echo('ranked {} posts'.format(trending.rebuild()))
+
+    @app.cli.group('suggestions')
+    def suggestions_group():
+        """who to follow commands"""
+
+    @suggestions_group.command('build')
+    @click.option('--workers', type=int, default=None,
+                  help='processes to compute in, 0 for none (default SUGGESTIONS_WORKERS)')
+    def build_suggestions(workers):
+        """recompute every user's suggestions from the follow graph"""
+        def progress(done, total):
+            click.echo('{}/{} users'.format(done, total))
+        click.echo('wrote {} suggestions'.format(
+            suggestions.build(workers, progress=progress)
+        ))
+
+    @app.cli.group()
+    def tags():
+        """hashtag and mention index commands"""
+
+    @tags.command()
+    @click.option('--chunk-size', type=int, default=10000, help='posts per transaction')
+    def backfill(chunk_size):
+        """index the tags and mentions of every existing post"""
+        def progress(done, written):
+            click.echo('{} posts, {} terms'.format(done, written))
+        tag_index.backfill(chunk_size, progress=progress)
+
+    @app.cli.group()
+    def replicas():
+        """read replica commands"""
+
+    @replicas.command()
+    def sync():
+        """copy the sqlite primary over every sqlite replica"""
+        sync_replicas(app)
+
+    @app.cli.group()
+    def search():
+        """search index maintenance commands"""
+
+    @search.command()
+    def status():
+        """show how far the search index lags behind the database"""
+        pending, lag = outbox_lag()
+        click.echo('{} pending operations, oldest {:.1f}s ago'.format(pending, lag))
+
+    @search.command()
+    def drain():
+        """send every queued index operation to elasticsearch now"""
+        total = 0
+        while True:
+            sent = drain_outbox(app.config['SEARCH_QUEUE_BATCH_SIZE'])
+            if not sent:
+                break
+            total += sent
+        click.echo('sent {} operations'.format(total))
+
+    @app.cli.group()
+    def assets():
+        """static asset commands"""
+
+    @assets.command('vendor')
+    def vendor_scripts():
+        """download the pinned third-party scripts into app/static/vendor"""
+        for name in vendor(app.static_folder):
+            click.echo('fetched ' + name)
+
+    @assets.command('build')
+    def build_assets():
+        """fingerprint and precompress app/static for serving under /assets"""
+        try:
+            manifest = build(app.static_folder, app.config['ASSETS_DIST'],
+                             missing_ok=app.config['ASSETS_CDN_FALLBACK'])
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        click.echo('built {} assets into {}'.format(len(manifest), app.config['ASSETS_DIST']))
+
+    @app.cli.group()
+    def templates():
+        """template commands"""
+
+    @templates.command('compile')
+    def compile_():
+        """fill the jinja bytecode cache so new processes skip compiling"""
+        if not app.config['JINJA_BYTECODE_CACHE']:
+            raise click.ClickException('JINJA_BYTECODE_CACHE is not set')
+        names = compile_templates(app)
+        click.echo('compiled {} templates into {}'.format(
+            len(names), app.config['JINJA_BYTECODE_CACHE']
+        ))
+
+    @app.cli.command()
+    @click.option('--chunk-size', default=1000, help='posts per bulk request')
+    @click.option('--workers', default=4, help='concurrent bulk requests')
+    @click.option('--resume', is_flag=True, help='continue an interrupted run')
+    def reindex(chunk_size, workers, resume):
+        """rebuild the post search index and swap it in when done"""
+        def progress(done, total, seconds):
+            click.echo('\r{}/{} posts, {:.0f} posts/s'.format(
+                done, total, done / seconds if seconds else 0
+            ), nl=False)
+        old = Post.reindex(chunk_size, workers, resume, progress)
+        click.echo('')
+        for name in old:
+            click.echo('{} is no longer in use and can be deleted'.format(name))
@@ -0,0 +1,70 @@
+import gzip
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError: # optional, gzip only without it
+    brotli = None
+
+COMPRESSIBLE = ('text/html', 'text/css', 'text/plain', 'text/xml', 'text/javascript',
+                'application/json', 'application/javascript')
+
+def encodings():
+    """content codings this process can produce, best first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def choose_encoding(available):
+    """the best of `available` codings the client accepts, None for identity"""
+    offers = [encoding for encoding in encodings() if encoding in available]
+    best = request.accept_encodings.best_match(offers)
+    if best is None or not request.accept_encodings[best]:
+        return None
+    return best
+
+def compress(data, encoding, level):
+    """`level` is gzip's 1-9, brotli quality is derived from it"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=min(level + 2, 11))
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+class Compressor(object):
+    """compresses text responses for clients that accept it
+
+    Responses of COMPRESS_MIMETYPES of at least COMPRESS_MIN_SIZE bytes are
+    gzipped, or brotli compressed when the brotli package is installed and
+    the client prefers it. Files, streams and anything already encoded are
+    left alone; fingerprinted assets come precompressed, see app/assets.py.
+    Strong ETags become weak, since the bytes no longer match.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('COMPRESS_RESPONSES', True)
+        app.config.setdefault('COMPRESS_LEVEL', 6)
+        app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+        app.config.setdefault('COMPRESS_MIMETYPES', COMPRESSIBLE)
+        if app.config['COMPRESS_RESPONSES']:
+            app.after_request(self._compress)
+
+    @staticmethod
+    def _compress(response):
+        config = current_app.config
+        if response.mimetype not in config['COMPRESS_MIMETYPES'] or \
+                response.status_code != 200 or response.direct_passthrough or \
+                response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(encodings())
+        data = response.get_data()
+        if encoding is None or len(data) < config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(compress(data, encoding, config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
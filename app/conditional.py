@@ -0,0 +1,52 @@
+from functools import wraps
+from hashlib import md5
+from time import time
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+def conditional(watermark):
+    """answer GETs with 304 Not Modified while `watermark` stays put
+
+    `watermark(**view_args)` runs before the view and returns a tuple of
+    cheap version markers for everything the page shows, authors included,
+    or None to skip straight to the view. The weak ETag also covers the
+    viewer, the query string and an epoch that rolls over every
+    WTF_CSRF_TIME_LIMIT / 2 seconds, so form tokens on a reused page stay
+    valid. No Last-Modified is sent: no page changes only when a newer post
+    arrives, so If-Modified-Since alone can't be answered with a 304.
+    Requests with pending flashed messages always render.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return f(*args, **kwargs)
+            parts = watermark(**kwargs)
+            if parts is None:
+                return f(*args, **kwargs)
+            etag = _etag(parts)
+            if is_resource_modified(request.environ, etag=etag):
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            else:
+                response = current_app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapped
+    return decorator
+
+def _etag(parts):
+    # watermarks read anything else about the viewer a page depends on, as
+    # current_user may be a cached snapshot
+    viewer = (current_user.id, current_user.profile_version) \
+        if current_user.is_authenticated else None
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600
+    key = repr((request.endpoint, request.query_string, viewer,
+                int(time() // (limit // 2)), parts))
+    return md5(key.encode('utf-8')).hexdigest()
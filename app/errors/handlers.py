@@ -7,6 +7,10 @@ from app.errors import bp
 def not_found_error(error): # pylint: disable=unused-argument
     return render_template('errors/404.html'), 404
 
+@bp.app_errorhandler(503)
+def unavailable_error(error): # pylint: disable=unused-argument
+    return render_template('errors/503.html'), 503, {'Retry-After': '1'}
+
 @bp.app_errorhandler(500)
 def internal_error(error): # pylint: disable=unused-argument
     db.session.rollback()
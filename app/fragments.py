@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import threading
+
+from flask import current_app
+from markupsafe import Markup
+from werkzeug.utils import import_string
+
+from app.tags import mentioned, mentions, usernames
+
+class _Fragments(object):
+    def __init__(self, store):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> markup
+        self.store = store
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+class FragmentCache(object):
+    """rendered _post.html fragments, reused across pages and requests
+
+    A post's markup only depends on the post, its author's name and avatar,
+    the users it mentions and the locale, so fragments are keyed by (post
+    id, author id, post timestamp, author profile_version, locale, usernames
+    its mentions resolve to) and never go stale: posts can't be edited,
+    profile changes get a new key, a post reusing the id of a deleted one
+    still differs in author or timestamp, and a mentioned user signing up or
+    changing name changes what the mentions resolve to.
+    FRAGMENT_CACHE_SIZE fragments are kept in an in-process LRU (0 turns the
+    cache off). FRAGMENT_CACHE_STORE can name a shared store, an object or
+    an import string for a factory taking the app, with get(key) -> str or
+    None and set(key, value, ttl) methods, consulted on local misses.
+    """
+
+    def __init__(self, app=None):
+        self._locale_selector = lambda: None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 5000)
+        app.config.setdefault('FRAGMENT_CACHE_STORE', None)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 24 * 60 * 60)
+        store = app.config['FRAGMENT_CACHE_STORE']
+        if isinstance(store, str):
+            store = import_string(store)(app)
+        app.extensions['fragments'] = _Fragments(store)
+        app.add_template_global(self.render_post, 'render_post')
+
+    def localeselector(self, f):
+        """register the function telling which locale fragments render in"""
+        self._locale_selector = f
+        return f
+
+    def render_post(self, post, page=None):
+        """_post.html for `post`, from the cache when possible
+
+        `page` is the list of posts it's shown with, whose mentions are then
+        looked up together.
+        """
+        if page is not None:
+            mentioned(page)
+        size = current_app.config['FRAGMENT_CACHE_SIZE']
+        if not size:
+            return self._render(post)
+        fragments = current_app.extensions['fragments']
+        key = 'post:{}:{}:{}:{}:{}:{}'.format(
+            post.id, post.user_id, post.timestamp.isoformat(),
+            post.author.profile_version, self._locale_selector() or '',
+            ' '.join(sorted(set(usernames(mentions(post.body)).values())))
+        )
+        with fragments.lock:
+            markup = fragments.entries.get(key)
+            if markup is not None:
+                fragments.entries.move_to_end(key)
+                fragments.hits += 1
+                return markup
+        html = fragments.store.get(key) if fragments.store else None
+        if html is not None:
+            markup = Markup(html)
+            stored = True
+        else:
+            markup = self._render(post)
+            stored = False
+            if fragments.store:
+                fragments.store.set(key, str(markup),
+                                    current_app.config['FRAGMENT_CACHE_TTL'])
+        with fragments.lock:
+            if stored:
+                fragments.store_hits += 1
+            else:
+                fragments.misses += 1
+            fragments.entries[key] = markup
+            fragments.entries.move_to_end(key)
+            while len(fragments.entries) > size:
+                fragments.entries.popitem(last=False)
+        return markup
+
+    def stats(self): # pylint: disable=no-self-use
+        """hits, store_hits, misses and size for the current app"""
+        fragments = current_app.extensions['fragments']
+        with fragments.lock:
+            return {
+                'hits': fragments.hits,
+                'store_hits': fragments.store_hits,
+                'misses': fragments.misses,
+                'size': len(fragments.entries),
+            }
+
+    @staticmethod
+    def _render(post):
+        # straight through jinja so the metrics render timer isn't restarted
+        context = {'post': post}
+        current_app.update_template_context(context)
+        template = current_app.jinja_env.get_template('_post.html')
+        return Markup(template.render(context))
@@ -0,0 +1,105 @@
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import threading
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+class _Pool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.slots = None
+
+class PasswordHasher(object):
+    """password hashing on a small, bounded process pool
+
+    PBKDF2 is deliberately slow, so hashing inline lets a burst of logins
+    or sign-ups hold every request worker. Here at most
+    PASSWORD_HASH_WORKERS processes hash at once and at most
+    PASSWORD_HASH_QUEUE jobs may be waiting; anything beyond that fails
+    straight away with a 503 instead of piling up. A job running past
+    PASSWORD_HASH_TIMEOUT seconds or a pool that broke (a worker died or
+    never started) is a 503 too, and a broken pool is replaced on the next
+    call. PASSWORD_HASH_WORKERS = 0 hashes inline, which is what the tests
+    use.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:150000')
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 16)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        app.extensions['hasher'] = _Pool()
+
+    def _submit(self, fn, *args): # pylint: disable=no-self-use
+        config = current_app.config
+        if not config['PASSWORD_HASH_WORKERS']:
+            return fn(*args)
+        pool = current_app.extensions['hasher']
+        with pool.lock:
+            # created on first use so every forked web worker gets its own
+            if pool.executor is None:
+                pool.executor = ProcessPoolExecutor(
+                    config['PASSWORD_HASH_WORKERS'],
+                    mp_context=multiprocessing.get_context('spawn')
+                )
+                pool.slots = threading.BoundedSemaphore(
+                    config['PASSWORD_HASH_WORKERS'] + config['PASSWORD_HASH_QUEUE']
+                )
+            executor, slots = pool.executor, pool.slots
+        if not slots.acquire(blocking=False):
+            raise ServiceUnavailable('too many password checks in flight')
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self._reset(executor)
+            raise ServiceUnavailable('password hashing is unavailable')
+        except Exception:
+            slots.release()
+            raise
+        future.add_done_callback(lambda f: slots.release())
+        try:
+            return future.result(config['PASSWORD_HASH_TIMEOUT'])
+        except FutureTimeout:
+            future.cancel()
+            raise ServiceUnavailable('password check timed out')
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise ServiceUnavailable('password hashing is unavailable')
+
+    @staticmethod
+    def _reset(executor):
+        """drop `executor` so the next call starts a fresh pool"""
+        pool = current_app.extensions['hasher']
+        with pool.lock:
+            if pool.executor is executor:
+                pool.executor = None
+        executor.shutdown(wait=False)
+
+    def hash(self, password):
+        return self._submit(
+            generate_password_hash, password,
+            current_app.config['PASSWORD_HASH_METHOD']
+        )
+
+    def verify(self, pw_hash, password):
+        return self._submit(check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash): # pylint: disable=no-self-use
+        """True when pw_hash was made with a different method or cost"""
+        return pw_hash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
+
+    def shutdown(self): # pylint: disable=no-self-use
+        pool = current_app.extensions['hasher']
+        with pool.lock:
+            if pool.executor is not None:
+                pool.executor.shutdown()
+                pool.executor = None
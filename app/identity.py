@@ -0,0 +1,194 @@
+from collections import OrderedDict
+from datetime import datetime
+import json
+import sqlite3
+import threading
+from time import time
+from types import FunctionType, MethodType
+
+from flask import current_app, g, has_app_context
+from flask_login import UserMixin
+
+from app import db
+
+# never cached: nothing that reads current_user needs it
+_EXCLUDED = {'pw_hash'}
+
+class UserSnapshot(UserMixin):
+    """detached, read-only copy of a user's columns, safe to share
+
+    Model methods run against the snapshot, so anything that only needs
+    columns (is_following, following_posts, avatar...) costs nothing extra.
+    Relationships and attribute writes fetch the live ORM object for the
+    rest of the request instead, and the change invalidates the cache entry
+    once it's committed.
+    """
+
+    def __init__(self, model, data):
+        self.__dict__['_model'] = model
+        self.__dict__['_data'] = data
+
+    def live(self):
+        """the ORM instance behind this snapshot, loaded in this session"""
+        _id = self.__dict__['_data']['id']
+        g.setdefault('_live_users', set()).add(_id)
+        return self.__dict__['_model'].query.get(_id)
+
+    def _upgraded(self):
+        return has_app_context() and \
+            self.__dict__['_data']['id'] in g.get('_live_users', ())
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        data = self.__dict__['_data']
+        if self._upgraded():
+            return getattr(self.live(), name)
+        if name in data:
+            return data[name]
+        attr = getattr(self.__dict__['_model'], name)
+        if isinstance(attr, FunctionType):
+            return MethodType(attr, self)
+        return getattr(self.live(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.live(), name, value)
+
+    def __repr__(self):
+        return '<UserSnapshot {}>'.format(self.__dict__['_data'].get('username'))
+
+class SQLiteIdentityStore(object):
+    """snapshot store shared by every process on the host, in a sqlite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS identity '
+                '(id INTEGER PRIMARY KEY, data TEXT, expires REAL)'
+            )
+        return conn
+
+    def get(self, _id):
+        """(data, version) of a live snapshot, or None"""
+        row = self._conn().execute(
+            'SELECT data, expires FROM identity WHERE id = ? AND expires > ?',
+            (_id, time())
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def version(self, _id):
+        """what get(_id) would return as the version, without the data"""
+        row = self._conn().execute(
+            'SELECT expires FROM identity WHERE id = ? AND expires > ?',
+            (_id, time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, _id, data, ttl):
+        """store a snapshot, returns its version"""
+        # every write gets a new expiry, which doubles as the version
+        expires = time() + ttl
+        self._conn().execute(
+            'INSERT OR REPLACE INTO identity (id, data, expires) VALUES (?, ?, ?)',
+            (_id, json.dumps(data), expires)
+        )
+        return expires
+
+    def delete(self, ids):
+        self._conn().executemany(
+            'DELETE FROM identity WHERE id = ?', [(_id,) for _id in ids]
+        )
+
+class _Cache(object):
+    def __init__(self, store):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # id -> (expires, snapshot, store version)
+        self.store = store
+
+class IdentityCache(object):
+    """LRU + TTL cache of user snapshots for the flask-login user_loader
+
+    IDENTITY_CACHE_TTL seconds (0 turns caching off) bounds how stale a
+    snapshot may get; IDENTITY_CACHE_SIZE caps the in-process entries. With
+    IDENTITY_CACHE_PATH set, snapshots are also shared between processes
+    through a sqlite file, and invalidations reach every process straight
+    away: a local entry is only used while the shared store still holds the
+    version it was loaded from, which costs one primary key read.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('IDENTITY_CACHE_TTL', 30)
+        app.config.setdefault('IDENTITY_CACHE_SIZE', 10000)
+        app.config.setdefault('IDENTITY_CACHE_PATH', None)
+        path = app.config['IDENTITY_CACHE_PATH']
+        app.extensions['identity_cache'] = _Cache(
+            SQLiteIdentityStore(path) if path else None
+        )
+
+    def load(self, model, _id): # pylint: disable=no-self-use
+        config = current_app.config
+        ttl = config['IDENTITY_CACHE_TTL']
+        if not ttl:
+            return model.query.get(_id)
+        cache = current_app.extensions['identity_cache']
+        now = time()
+        with cache.lock:
+            entry = cache.entries.get(_id)
+        if entry is not None and entry[0] > now and (
+                cache.store is None or cache.store.version(_id) == entry[2]):
+            with cache.lock:
+                if _id in cache.entries:
+                    cache.entries.move_to_end(_id)
+            return entry[1]
+        stored = cache.store.get(_id) if cache.store else None
+        if stored is not None:
+            data, version = _decode(model, stored[0]), stored[1]
+        else:
+            user = model.query.get(_id)
+            if user is None:
+                return None
+            data = {
+                column.key: getattr(user, column.key)
+                for column in model.__table__.columns
+                if column.key not in _EXCLUDED
+            }
+            version = cache.store.set(_id, _encode(data), ttl) if cache.store else None
+        snapshot = UserSnapshot(model, data)
+        with cache.lock:
+            cache.entries[_id] = (now + ttl, snapshot, version)
+            cache.entries.move_to_end(_id)
+            while len(cache.entries) > config['IDENTITY_CACHE_SIZE']:
+                cache.entries.popitem(last=False)
+        return snapshot
+
+    def invalidate(self, ids): # pylint: disable=no-self-use
+        cache = current_app.extensions['identity_cache']
+        with cache.lock:
+            for _id in ids:
+                cache.entries.pop(_id, None)
+        if cache.store:
+            cache.store.delete(ids)
+
+def _encode(data):
+    return {
+        key: value.isoformat() if isinstance(value, datetime) else value
+        for key, value in data.items()
+    }
+
+def _decode(model, data):
+    for column in model.__table__.columns:
+        if isinstance(column.type, db.DateTime) and data.get(column.key):
+            data[column.key] = datetime.fromisoformat(data[column.key])
+    return data
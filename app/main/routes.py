@@ -1,40 +1,88 @@
-from datetime import datetime
 from flask import current_app, flash, g, redirect, render_template, request, \
     url_for
 from flask_login import current_user, login_required
 
-from app import db
+from app import db, last_seen, post_stream
+from app.conditional import conditional
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
-from app.models import Post, User
+from app.models import Post, User, follows, timeline
+from app.pagination import paginate_keyset
+from app.replicas import read_replica
+from app.tags import mention_term, post_term, tag_term
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user.id)
         g.search_form = SearchForm()
 
+# Pages listing posts by many authors also carry User.profiles_version(), so
+# a rename, new avatar or new user (who may be mentioned) moves their ETag.
+
+def _newest_in_timeline():
+    g.timeline_head = current_user.timeline_head(User.profiles_version())
+    return tuple(g.timeline_head)
+
+def _newest_by_user(username):
+    def newest(column):
+        return db.session.query(column).filter(
+            Post.user_id == User.id
+        ).order_by(
+            Post.timestamp.desc(), Post.id.desc()
+        ).limit(1).correlate(User).as_scalar()
+    # whether we follow them decides the follow button
+    following = db.exists().where(db.and_(
+        follows.c.follower_id == current_user.id, follows.c.followed_id == User.id
+    ))
+    row = db.session.query(
+        User.id, User.profile_version, User.about_me, User.last_seen,
+        User.post_count, User.followers_count, User.following_count,
+        newest(Post.id), newest(Post.timestamp), following
+    ).filter(User.username == username).first()
+    if row is None:
+        return None
+    return tuple(row)
+
+def _newest_post():
+    newest = db.session.query(Post.id, User.profiles_version()).filter(
+        Post.id == db.session.query(db.func.max(Post.id)).as_scalar()
+    ).first()
+    if newest is None:
+        return (None,)
+    return tuple(newest)
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
+@read_replica
 @login_required
+@conditional(_newest_in_timeline)
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        post = Post(body=form.post.data, author=current_user)
+        post = Post(body=form.post.data, user_id=current_user.id)
         db.session.add(post)
         db.session.commit()
         flash('your post has been sent to the void')
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.following_posts().paginate(
-        page,
+    if 'timeline_head' not in g:
+        g.timeline_head = current_user.timeline_head()
+    posts = current_user.cached_timeline_page(
         current_app.config['POSTS_PER_PAGE'],
-        False
+        g.timeline_head,
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    ) or paginate_keyset(
+        current_user.following_posts(),
+        timeline.c.timestamp,
+        timeline.c.post_id,
+        current_app.config['POSTS_PER_PAGE'],
+        after=request.args.get('after'),
+        before=request.args.get('before')
     )
-    next_url = url_for('main.index', page=posts.next_num) \
+    next_url = url_for('main.index', after=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', before=posts.prev_cursor) \
         if posts.has_prev else None
     # pylint: disable=bad-continuation
     return render_template('index.html',
@@ -42,22 +90,32 @@ def index():
         form=form,
         posts=posts.items,
         next_url=next_url,
-        prev_url=prev_url)
+        prev_url=prev_url,
+        # rebuilt offline, so a cached page showing older ones is fine;
+        # following one of them moves the ETag anyway
+        suggestions=current_user.suggestions() if prev_url is None else None,
+        stream_url=post_stream.url('home') if prev_url is None else None)
 
 
 @bp.route('/user/<username>')
+@read_replica
 @login_required
+@conditional(_newest_by_user)
 def user(username):
     _user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = _user.posts.order_by(
-        Post.timestamp.desc()
-    ).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False
+    posts = paginate_keyset(
+        _user.posts,
+        Post.timestamp,
+        Post.id,
+        current_app.config['POSTS_PER_PAGE'],
+        after=request.args.get('after'),
+        before=request.args.get('before')
     )
-    next_url = url_for('main.user', username=_user.username, page=posts.next_num) \
+    next_url = url_for('main.user', username=_user.username,
+                       after=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.user', username=_user.username, page=posts.prev_num) \
+    prev_url = url_for('main.user', username=_user.username,
+                       before=posts.prev_cursor) \
         if posts.has_prev else None
     form = EmptyForm()
     return render_template(
@@ -124,28 +182,111 @@ def edit_profile():
     return render_template('edit_profile.html', title="edit profile", form=form)
 
 
+def _explore_watermark():
+    if request.args.get('mode') == 'trending':
+        return None # follows reorder it without any new post
+    return _newest_post()
+
 @bp.route('/explore')
+@read_replica
 @login_required
+@conditional(_explore_watermark)
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page,
+    modes = {
+        'latest_url': url_for('main.explore'),
+        'trending_url': url_for('main.explore', mode='trending'),
+    }
+    if request.args.get('mode') == 'trending':
+        return render_template(
+            'index.html',
+            title='trending',
+            posts=Post.trending_posts(),
+            **modes
+        )
+    posts = paginate_keyset(
+        Post.listing_query(),
+        Post.timestamp,
+        Post.id,
         current_app.config['POSTS_PER_PAGE'],
-        False
+        after=request.args.get('after'),
+        before=request.args.get('before')
     )
-    next_url = url_for('main.explore', page=posts.next_num) \
+    next_url = url_for('main.explore', after=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
+    prev_url = url_for('main.explore', before=posts.prev_cursor) \
         if posts.has_prev else None
     return render_template(
         'index.html',
         title='explore',
         posts=posts.items,
         next_url=next_url,
+        prev_url=prev_url,
+        stream_url=post_stream.url('explore') if prev_url is None else None,
+        **modes
+    )
+
+def _newest_with_term(term):
+    newest = Post.term_head(term, User.profiles_version())
+    if newest is None:
+        return (None,)
+    return tuple(newest)
+
+def _term_timeline(term, title, endpoint, **view_args):
+    posts = paginate_keyset(
+        Post.with_term(term),
+        post_term.c.timestamp,
+        post_term.c.post_id,
+        current_app.config['POSTS_PER_PAGE'],
+        after=request.args.get('after'),
+        before=request.args.get('before')
+    )
+    next_url = url_for(endpoint, after=posts.next_cursor, **view_args) \
+        if posts.has_next else None
+    prev_url = url_for(endpoint, before=posts.prev_cursor, **view_args) \
+        if posts.has_prev else None
+    return render_template(
+        'index.html',
+        title=title,
+        heading=title,
+        posts=posts.items,
+        next_url=next_url,
         prev_url=prev_url
     )
 
+@bp.route('/tag/<name>')
+@read_replica
+@login_required
+@conditional(lambda name: _newest_with_term(tag_term(name)))
+def tag(name):
+    return _term_timeline(tag_term(name), '#' + name.lower(), 'main.tag',
+                          name=name)
+
+def _newest_mentioning(username):
+    def newest(column):
+        return db.session.query(column).filter(
+            post_term.c.term == mention_term(username)
+        ).order_by(
+            post_term.c.timestamp.desc(), post_term.c.post_id.desc()
+        ).limit(1).as_scalar()
+    row = db.session.query(
+        User.id, newest(post_term.c.post_id), newest(post_term.c.timestamp),
+        User.profiles_version()
+    ).filter(User.username == username).first()
+    if row is None:
+        return None # the view answers 404
+    return tuple(row)
+
+@bp.route('/user/<username>/mentions')
+@read_replica
+@login_required
+@conditional(_newest_mentioning)
+def mentions(username):
+    _user = User.query.filter_by(username=username).first_or_404()
+    return _term_timeline(mention_term(_user.username), '@' + _user.username,
+                          'main.mentions', username=_user.username)
+
 @bp.route('/search')
+@read_replica
 @login_required
 def search():
     if not g.search_form.validate():
@@ -0,0 +1,205 @@
+from bisect import bisect_left
+import threading
+from time import perf_counter
+
+from flask import Response, current_app, g, has_request_context, request, \
+    request_finished, request_started, before_render_template, \
+    template_rendered
+from sqlalchemy.engine import Engine
+
+from app import db, fragments, timeline_cache
+from app.search import outbox_lag
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+class Histogram(object):
+    """prometheus style histogram with one series per endpoint"""
+
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, endpoint, value):
+        series = self.series.get(endpoint)
+        if series is None:
+            # [count per bucket ..., +Inf count, sum]
+            series = self.series[endpoint] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def expose(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} histogram'.format(self.name),
+        ]
+        for endpoint, series in sorted(self.series.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                total += count
+                lines.append('{}_bucket{{endpoint="{}",le="{}"}} {}'.format(
+                    self.name, endpoint, bound, total
+                ))
+            lines.append('{}_sum{{endpoint="{}"}} {}'.format(
+                self.name, endpoint, series[-1]
+            ))
+            lines.append('{}_count{{endpoint="{}"}} {}'.format(
+                self.name, endpoint, total
+            ))
+        return lines
+
+class _RequestStats(object):
+    __slots__ = ('started', 'queries', 'db_time', 'render_time',
+                 'query_started', 'render_started', 'statements')
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.query_started = None
+        self.render_started = None
+        self.statements = []
+
+def _stats():
+    if has_request_context():
+        return g.get('_metrics')
+    return None
+
+def _before_cursor_execute(conn, cursor, statement, *args): # pylint: disable=unused-argument
+    stats = _stats()
+    if stats is not None:
+        stats.query_started = perf_counter()
+        stats.statements.append(statement)
+
+def _after_cursor_execute(conn, cursor, statement, *args): # pylint: disable=unused-argument
+    stats = _stats()
+    if stats is not None and stats.query_started is not None:
+        stats.queries += 1
+        stats.db_time += perf_counter() - stats.query_started
+        stats.query_started = None
+
+db.event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+db.event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+class _Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = Histogram(
+            'microblog_request_seconds',
+            'Time spent handling the request.', LATENCY_BUCKETS
+        )
+        self.db_time = Histogram(
+            'microblog_request_db_seconds',
+            'Time spent running SQL per request.', LATENCY_BUCKETS
+        )
+        self.render_time = Histogram(
+            'microblog_request_render_seconds',
+            'Time spent rendering templates per request.', LATENCY_BUCKETS
+        )
+        self.queries = Histogram(
+            'microblog_request_queries',
+            'SQL statements run per request.', QUERY_BUCKETS
+        )
+
+class Metrics(object):
+    """per-endpoint request, SQL and template timings
+
+    Timings are kept in process-local histograms and served in prometheus
+    text format from /metrics when METRICS_ENDPOINT is set. Requests slower
+    than SLOW_REQUEST_THRESHOLD seconds are logged with their SQL.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENDPOINT', False)
+        app.config.setdefault('SLOW_REQUEST_THRESHOLD', 1.0)
+        app.extensions['metrics'] = _Registry()
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        if app.config['METRICS_ENDPOINT']:
+            app.add_url_rule('/metrics', 'metrics', self.expose)
+
+    def _request_started(self, sender, **extra): # pylint: disable=unused-argument,no-self-use
+        g._metrics = _RequestStats() # pylint: disable=protected-access
+
+    def _before_render(self, sender, **extra): # pylint: disable=unused-argument,no-self-use
+        stats = _stats()
+        if stats is not None:
+            stats.render_started = perf_counter()
+
+    def _rendered(self, sender, **extra): # pylint: disable=unused-argument,no-self-use
+        stats = _stats()
+        if stats is not None and stats.render_started is not None:
+            stats.render_time += perf_counter() - stats.render_started
+            stats.render_started = None
+
+    def _request_finished(self, sender, response, **extra): # pylint: disable=unused-argument,no-self-use
+        stats = _stats()
+        if stats is None:
+            return
+        elapsed = perf_counter() - stats.started
+        endpoint = request.endpoint or 'unmatched'
+        registry = current_app.extensions['metrics']
+        with registry.lock:
+            registry.latency.observe(endpoint, elapsed)
+            registry.db_time.observe(endpoint, stats.db_time)
+            registry.render_time.observe(endpoint, stats.render_time)
+            registry.queries.observe(endpoint, stats.queries)
+        if elapsed >= current_app.config['SLOW_REQUEST_THRESHOLD']:
+            current_app.logger.warning(
+                'slow request %s %s: %.3fs, %d queries in %.3fs, '
+                'render %.3fs\n%s',
+                request.method, request.full_path, elapsed, stats.queries,
+                stats.db_time, stats.render_time,
+                '\n'.join(stats.statements)
+            )
+
+    def expose(self): # pylint: disable=no-self-use
+        registry = current_app.extensions['metrics']
+        lines = []
+        with registry.lock:
+            for histogram in (registry.latency, registry.db_time,
+                              registry.render_time, registry.queries):
+                lines.extend(histogram.expose())
+        stats = fragments.stats()
+        lines.extend([
+            '# HELP microblog_fragment_cache_requests_total Post fragments by where they came from.',
+            '# TYPE microblog_fragment_cache_requests_total counter',
+            'microblog_fragment_cache_requests_total{{result="hit"}} {}'.format(stats['hits']),
+            'microblog_fragment_cache_requests_total{{result="store_hit"}} {}'.format(stats['store_hits']),
+            'microblog_fragment_cache_requests_total{{result="miss"}} {}'.format(stats['misses']),
+        ])
+        stats = timeline_cache.stats()
+        lines.extend([
+            '# HELP microblog_timeline_cache_requests_total Hot timeline cache lookups.',
+            '# TYPE microblog_timeline_cache_requests_total counter',
+            'microblog_timeline_cache_requests_total{{result="hit"}} {}'.format(stats['hits']),
+            'microblog_timeline_cache_requests_total{{result="miss"}} {}'.format(stats['misses']),
+            '# HELP microblog_timeline_cache_users Timelines held in the hot cache.',
+            '# TYPE microblog_timeline_cache_users gauge',
+            'microblog_timeline_cache_users {}'.format(stats['users']),
+            '# HELP microblog_timeline_cache_bytes Memory held by cached timelines.',
+            '# TYPE microblog_timeline_cache_bytes gauge',
+            'microblog_timeline_cache_bytes {}'.format(stats['bytes']),
+        ])
+        backend = current_app.search_backend
+        if backend and backend.queues_writes:
+            pending, lag = outbox_lag()
+            lines.extend([
+                '# HELP microblog_search_outbox_pending Queued search index operations.',
+                '# TYPE microblog_search_outbox_pending gauge',
+                'microblog_search_outbox_pending {}'.format(pending),
+                '# HELP microblog_search_outbox_lag_seconds Age of the oldest queued operation.',
+                '# TYPE microblog_search_outbox_lag_seconds gauge',
+                'microblog_search_outbox_lag_seconds {}'.format(lag),
+            ])
+        return Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain; version=0.0.4')
@@ -1,21 +1,39 @@
 # pylint: disable=no-member,protected-access
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from hashlib import md5
-from time import time
+from time import monotonic, time
 
 from flask import current_app
 from flask_login import UserMixin
 import jwt
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, hasher, identity_cache, login, post_stream, \
+    search_indexer, tag_index, timeline_cache, trending
+from app.pagination import KeysetPagination, decode_cursor, encode_cursor
+from app.search import bulk_index, clear_checkpoint, create_index, \
+    finish_index, fts5_ddl, invalidate_results, load_checkpoint, \
+    note_touched, outbox_row, query_index, save_checkpoint, search_outbox, \
+    swap_alias, take_touched
+from app.suggestions import suggestion
+from app.tags import post_term
+from app.timelines import page_ids
 
 follows = db.Table(
     'follows',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Index('ix_follows_followed_id_follower_id', 'followed_id', 'follower_id'),
+)
+
+# materialized home timelines: one row per (reader, post), fanned out on write
+timeline = db.Table(
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_id_timestamp_post_id', 'user_id', 'timestamp', 'post_id'),
 )
 
 class User(UserMixin, db.Model):
@@ -34,15 +52,29 @@ class User(UserMixin, db.Model):
     )
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
+    # denormalized counts, kept up to date on write; see reconcile_counters
+    followers_count = db.Column(db.Integer, default=0)
+    following_count = db.Column(db.Integer, default=0)
+    post_count = db.Column(db.Integer, default=0)
+    # set past every other user's on sign-up and whenever something shown next
+    # to this user's posts changes, so the largest one moves on any such change
+    profile_version = db.Column(db.Integer, default=1, index=True)
+    # bumped on follow and unfollow, see app/conditional.py
+    timeline_version = db.Column(db.Integer, default=1)
+    # @mentions are matched case-insensitively, see app/tags.py
+    __table_args__ = (db.Index('ix_user_username_lower', db.func.lower(username)),)
 
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.pw_hash = generate_password_hash(password)
+        self.pw_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.pw_hash, password)
+        return hasher.verify(self.pw_hash, password)
+
+    def password_needs_rehash(self):
+        return hasher.needs_rehash(self.pw_hash)
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -68,79 +100,371 @@ class User(UserMixin, db.Model):
         return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(digest, size)
 
     def is_following(self, user):
-        return self.following.filter(
+        return db.session.query(db.exists().where(db.and_(
+            follows.c.follower_id == self.id,
             follows.c.followed_id == user.id
-        ).count() > 0
+        ))).scalar()
 
     def follow(self, user):
         if not self.is_following(user):
             self.following.append(user)
+            self.following_count = User.following_count + 1
+            self.timeline_version = User.timeline_version + 1
+            user.followers_count = User.followers_count + 1
+            trending.engage(db.session, user.id)
+            # backfill the followed user's posts into our timeline
+            db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'timestamp'],
+                db.select([
+                    db.literal(self.id), Post.id, Post.timestamp
+                ]).where(Post.user_id == user.id)
+            ))
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.following_count = User.following_count - 1
+            self.timeline_version = User.timeline_version + 1
+            user.followers_count = User.followers_count - 1
+            # trim the unfollowed user's posts out of our timeline
+            db.session.execute(timeline.delete().where(db.and_(
+                timeline.c.user_id == self.id,
+                timeline.c.post_id.in_(
+                    db.select([Post.id]).where(Post.user_id == user.id)
+                )
+            )))
 
     def following_posts(self):
-        following = Post.query.join(
-            follows,
-            follows.c.followed_id == Post.user_id
-        ).filter(follows.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return following.union(own).order_by(Post.timestamp.desc())
+        return Post.listing_query().join(
+            timeline,
+            timeline.c.post_id == Post.id
+        ).filter(
+            timeline.c.user_id == self.id
+        ).order_by(timeline.c.timestamp.desc(), timeline.c.post_id.desc())
+
+    def timeline_head(self, *columns):
+        """(post_id, timestamp, timeline_version, *columns) as the database has them
+
+        post_id and timestamp are the newest post in our timeline, None when
+        it's empty; timeline_version is read too, since ours may be a cached
+        snapshot.
+        """
+        def newest(column):
+            return db.session.query(column).filter(
+                timeline.c.user_id == User.id
+            ).order_by(
+                timeline.c.timestamp.desc(), timeline.c.post_id.desc()
+            ).limit(1).correlate(User).as_scalar()
+        return db.session.query(
+            newest(timeline.c.post_id), newest(timeline.c.timestamp),
+            User.timeline_version, *columns
+        ).filter(User.id == self.id).one()
+
+    def suggestions(self, limit=None):
+        """[(user, mutual follows)] we don't follow yet, from the last build"""
+        return db.session.query(User, suggestion.c.mutual).join(
+            suggestion, suggestion.c.suggested_id == User.id
+        ).filter(
+            suggestion.c.user_id == self.id,
+            ~db.exists().where(db.and_(
+                follows.c.follower_id == self.id,
+                follows.c.followed_id == suggestion.c.suggested_id
+            ))
+        ).order_by(suggestion.c.rank).limit(
+            limit or current_app.config['SUGGESTIONS_SHOWN']
+        ).all()
+
+    def cached_timeline_page(self, per_page, head, after=None, before=None):
+        """a page of following_posts() from the hot timeline cache, or None
+
+        `head` is what timeline_head() returned for this request. None means
+        the page can't come from the cache; use paginate_keyset instead.
+        """
+        if not timeline_cache.enabled:
+            return None
+        head_id, version = head[0], head[2]
+        entry = timeline_cache.get(self.id, version, head_id)
+        if entry is None:
+            if not timeline_cache.admit(self.id):
+                return None
+            depth = current_app.config['TIMELINE_CACHE_DEPTH']
+            ids = [post_id for post_id, in db.session.query(
+                timeline.c.post_id
+            ).filter(
+                timeline.c.user_id == self.id
+            ).order_by(
+                timeline.c.timestamp.desc(), timeline.c.post_id.desc()
+            ).limit(depth + 1)]
+            if (ids[0] if ids else None) != head_id:
+                return None # the timeline moved since head was read
+            entry = timeline_cache.put(self.id, version,
+                                       ids[:depth], len(ids) <= depth)
+        after, before = decode_cursor(after), decode_cursor(before)
+        window = page_ids(entry, per_page, after and after[1], before and before[1])
+        if window is None:
+            return None
+        ids, has_next, has_prev = window
+        items = Post.get_many(ids)
+        return KeysetPagination(
+            items,
+            encode_cursor(items[-1]) if items and has_next else None,
+            encode_cursor(items[0]) if items and has_prev else None
+        )
+
+    @classmethod
+    def reconcile_counters(cls):
+        """recompute every user's denormalized counts from the source tables"""
+        user = cls.__table__
+        db.session.execute(user.update().values(
+            followers_count=db.select([db.func.count()]).where(
+                follows.c.followed_id == user.c.id
+            ).as_scalar(),
+            following_count=db.select([db.func.count()]).where(
+                follows.c.follower_id == user.c.id
+            ).as_scalar(),
+            post_count=db.select([db.func.count()]).where(
+                Post.user_id == user.c.id
+            ).as_scalar()
+        ))
+        db.session.commit()
+
+    @classmethod
+    def rebuild_timelines(cls):
+        """recompute every home timeline from the post and follows tables"""
+        db.session.execute(timeline.delete())
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([Post.user_id, Post.id, Post.timestamp])
+        ))
+        db.session.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            db.select([
+                follows.c.follower_id, Post.id, Post.timestamp
+            ]).select_from(
+                follows.join(Post.__table__, follows.c.followed_id == Post.user_id)
+            )
+        ))
+        db.session.commit()
+
+    @classmethod
+    def bump_profile_versions(cls, session, flush_context, instances): # pylint: disable=unused-argument
+        """new profile_version for new users and those whose name or avatar changed"""
+        for obj in session.new:
+            if isinstance(obj, User):
+                obj.profile_version = User.profiles_version() + 1
+        for obj in session.dirty:
+            if isinstance(obj, User) and obj.profile_changed():
+                obj.profile_version = User.profiles_version() + 1
+
+    @staticmethod
+    def profiles_version():
+        """scalar subquery that changes whenever a user joins or changes name or avatar"""
+        other = db.aliased(User)
+        return db.session.query(
+            db.func.coalesce(db.func.max(other.profile_version), 0)
+        ).as_scalar()
+
+    def profile_changed(self):
+        state = db.inspect(self)
+        return any(
+            state.attrs[field].history.has_changes()
+            for field in ('username', 'email')
+        )
+
+    @classmethod
+    def track_changes(cls, session, flush_context): # pylint: disable=unused-argument
+        """remember which users were modified so their snapshots can go"""
+        changed = session.info.setdefault('users_changed', set())
+        for obj in session.dirty | session.deleted:
+            if isinstance(obj, User):
+                changed.add(obj.id)
+
+    @classmethod
+    def after_commit(cls, session):
+        """drop cached snapshots of users this commit changed"""
+        changed = session.info.pop('users_changed', None)
+        if changed:
+            identity_cache.invalidate(changed)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('users_changed', None)
+
+db.event.listen(db.session, 'before_flush', User.bump_profile_versions)
+db.event.listen(db.session, 'after_flush', User.track_changes)
+db.event.listen(db.session, 'after_commit', User.after_commit)
+db.event.listen(db.session, 'after_rollback', User.after_rollback)
 
 @login.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity_cache.load(User, int(user_id))
 
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
+        """(list of matching objects in relevance order, total matches)"""
         ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = [] # use in sql order_by to keep search relevancy order
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(
-            cls.id.in_(ids)
-        ).order_by(
-            db.case(when, value=cls.id)
-        ), total
-
-    @classmethod
-    def before_commit(cls, session):
-        """store session changes somewhere they'll survive the commit"""
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
+        if not ids:
+            return [], total
+        # one primary key fetch, put back in relevance order here
+        found = {
+            obj.id: obj for obj in cls.listing_query().filter(cls.id.in_(ids))
         }
+        return [found[_id] for _id in ids if _id in found], total
 
     @classmethod
-    def after_commit(cls, session):
-        """update elasticsearch index based on session changes"""
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+    def listing_query(cls):
+        """base query for result lists; override to eager load relations"""
+        return cls.query
+
+    @classmethod
+    def enqueue_changes(cls, session, flush_context): # pylint: disable=unused-argument
+        """queue index operations for flushed changes in the search outbox"""
+        backend = current_app.search_backend
+        if not backend:
+            return
+        changes = []
+        for obj in session.new:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                changes.append((obj, 'index'))
+        for obj in session.dirty:
+            if isinstance(obj, SearchableMixin) and obj.search_fields_changed():
+                changes.append((obj, 'index'))
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                changes.append((obj, 'delete'))
+        if not changes:
+            return
+        session.info.setdefault('search_changed', set()).update(
+            obj.__tablename__ for obj, _ in changes
+        )
+        if backend.queues_writes:
+            session.execute(search_outbox.insert(), [
+                outbox_row(obj.__tablename__, obj, op) for obj, op in changes
+            ])
+            session.info['search_queued'] = True
+
+    @classmethod
+    def after_commit(cls, session):
+        """wake the background indexer if this commit queued anything"""
+        changed = session.info.pop('search_changed', ())
+        if session.info.pop('search_queued', False):
+            search_indexer.notify()
+        else:
+            # fts5 triggers indexed these as part of the commit itself
+            for index in changed:
+                invalidate_results(index)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_changed', None)
+        session.info.pop('search_queued', None)
+
+    def search_fields_changed(self):
+        state = db.inspect(self)
+        return any(
+            state.attrs[field].history.has_changes()
+            for field in self.__searchable__
+        )
 
     @classmethod
-    def reindex(cls):
-        """refresh search index with all data from db"""
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, chunk_size=1000, workers=4, resume=False, progress=None):
+        """rebuild the search index into a fresh one, then swap the alias over to it"""
+        backend = current_app.search_backend
+        if backend and not backend.queues_writes:
+            backend.rebuild(cls.__tablename__)
+            invalidate_results(cls.__tablename__)
+            return []
+        client = current_app.elasticsearch
+        if not client:
+            return []
+        alias = cls.__tablename__
+        state = load_checkpoint(alias) if resume else None
+        if state is None:
+            state = {
+                'index': '{}-{}'.format(alias, datetime.utcnow().strftime('%Y%m%d%H%M%S%f')),
+                'chunk_size': chunk_size,
+                'done_through': 0,
+                'done': 0,
+            }
+            create_index(client, state['index'])
+            take_touched(alias) # left over from an abandoned build
+            save_checkpoint(alias, state)
+        chunk_size = state['chunk_size']
+        max_id = db.session.query(db.func.max(cls.id)).scalar() or 0
+        total = cls.query.count()
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        finished = {} # range start -> docs, waiting for earlier ranges
+        failed = []
+        started = monotonic()
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+        def collect(futures):
+            for future in futures:
+                start, count = pending.pop(future)
+                if future.result():
+                    failed.append(start)
+                    continue
+                finished[start] = count
+            # only advance the checkpoint past a contiguous run of ranges
+            while state['done_through'] in finished:
+                state['done'] += finished.pop(state['done_through'])
+                state['done_through'] += chunk_size
+            save_checkpoint(alias, state)
+            if progress:
+                progress(state['done'], total, monotonic() - started)
+
+        pending = {}
+        with ThreadPoolExecutor(workers) as pool:
+            for start in range(state['done_through'], max_id + 1, chunk_size):
+                docs = [
+                    (row[0], dict(zip(cls.__searchable__, row[1:])))
+                    for row in db.session.query(cls.id, *columns).filter(
+                        cls.id >= start, cls.id < start + chunk_size
+                    )
+                ]
+                if docs:
+                    future = pool.submit(bulk_index, client, state['index'], docs)
+                    pending[future] = (start, len(docs))
+                else:
+                    finished[start] = 0
+                if len(pending) >= workers * 2:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            collect(wait(pending).done)
+        if failed:
+            raise RuntimeError(
+                '{} id ranges failed to index, rerun with resume'.format(len(failed))
+            )
+        # catch up on documents that changed during the build, until none did
+        while True:
+            db.session.rollback() # see rows committed since
+            ids = sorted(take_touched(alias))
+            if not ids:
+                break
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i:i + chunk_size]
+                docs = [
+                    (row[0], dict(zip(cls.__searchable__, row[1:])))
+                    for row in db.session.query(cls.id, *columns).filter(cls.id.in_(chunk))
+                ]
+                deleted = set(chunk) - {_id for _id, _ in docs}
+                if bulk_index(client, state['index'], docs, deleted):
+                    note_touched(alias, ids[i:]) # keep them for a resume
+                    raise RuntimeError('changed documents failed to index, rerun with resume')
+        finish_index(client, state['index'])
+        old = swap_alias(client, alias, state['index'])
+        clear_checkpoint(alias)
+        invalidate_results(cls.__tablename__)
+        return old
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.enqueue_changes)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __table_args__ = (
+        db.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -148,3 +472,160 @@ class Post(SearchableMixin, db.Model):
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+    @classmethod
+    def listing_query(cls):
+        """posts with their authors joined in, as _post.html needs them"""
+        return cls.query.options(db.joinedload(cls.author))
+
+    @classmethod
+    def trending_posts(cls, limit=None):
+        """the top ranked posts, best first"""
+        return cls.get_many(trending.top(limit))
+
+    @classmethod
+    def with_term(cls, term):
+        """posts with a #tag or @mention, to page on post_term's timestamp and post_id"""
+        return cls.listing_query().join(
+            post_term, post_term.c.post_id == Post.id
+        ).filter(post_term.c.term == term)
+
+    @classmethod
+    def term_head(cls, term, *columns):
+        """(post_id, timestamp, *columns) of the newest post with `term`, or None"""
+        return db.session.query(post_term.c.post_id, post_term.c.timestamp, *columns).filter(
+            post_term.c.term == term
+        ).order_by(post_term.c.timestamp.desc(), post_term.c.post_id.desc()).first()
+
+    @classmethod
+    def get_many(cls, ids):
+        """posts for `ids` in that order, with one primary key fetch"""
+        if not ids:
+            return []
+        found = {post.id: post for post in cls.listing_query().filter(cls.id.in_(ids))}
+        return [found[_id] for _id in ids if _id in found]
+
+    @classmethod
+    def fan_out(cls, session, flush_context): # pylint: disable=unused-argument
+        """copy flushed posts into their author's and followers' timelines"""
+        for obj in session.new:
+            if isinstance(obj, Post):
+                session.info.setdefault('posts_published', []).append(
+                    (obj.id, obj.user_id)
+                )
+                author = db.select([
+                    db.literal(obj.user_id), db.literal(obj.id),
+                    db.literal(obj.timestamp, db.DateTime)
+                ])
+                followers = db.select([
+                    follows.c.follower_id, db.literal(obj.id),
+                    db.literal(obj.timestamp, db.DateTime)
+                ]).where(follows.c.followed_id == obj.user_id)
+                session.execute(timeline.insert().from_select(
+                    ['user_id', 'post_id', 'timestamp'],
+                    author.union_all(followers)
+                ))
+        deleted = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        if deleted:
+            session.execute(
+                timeline.delete().where(timeline.c.post_id.in_(deleted))
+            )
+
+    @classmethod
+    def rank_posts(cls, session, flush_context): # pylint: disable=unused-argument
+        """add flushed posts to the trending ranking"""
+        trending.rank(session, [(obj.id, obj.user_id, obj.timestamp)
+                                for obj in session.new if isinstance(obj, Post)])
+
+    @classmethod
+    def unrank_posts(cls, session, flush_context, instances): # pylint: disable=unused-argument
+        """take posts about to be deleted out of the trending ranking"""
+        trending.forget(session, [obj.id for obj in session.deleted
+                                  if isinstance(obj, Post)])
+
+    @classmethod
+    def index_terms(cls, session, flush_context): # pylint: disable=unused-argument
+        """add flushed posts' tags and mentions to the term index"""
+        tag_index.index(session, [(obj.id, obj.timestamp, obj.body)
+                                  for obj in session.new if isinstance(obj, Post)])
+
+    @classmethod
+    def unindex_terms(cls, session, flush_context, instances): # pylint: disable=unused-argument
+        """take posts about to be deleted out of the term index"""
+        tag_index.forget(session, [obj.id for obj in session.deleted
+                                   if isinstance(obj, Post)])
+
+    @classmethod
+    def count_posts(cls, session, flush_context): # pylint: disable=unused-argument
+        """keep User.post_count in step with flushed posts"""
+        delta = {}
+        for obj in session.new:
+            if isinstance(obj, Post):
+                delta[obj.user_id] = delta.get(obj.user_id, 0) + 1
+        for obj in session.deleted:
+            if isinstance(obj, Post):
+                delta[obj.user_id] = delta.get(obj.user_id, 0) - 1
+        for user_id, change in delta.items():
+            if user_id is not None and change:
+                session.execute(User.__table__.update().where(
+                    User.id == user_id
+                ).values(post_count=User.post_count + change))
+                session.info.setdefault('users_changed', set()).add(user_id)
+
+    @classmethod
+    def announce(cls, session):
+        """after_commit: tell live streams and hot timelines about new posts"""
+        published = session.info.pop('posts_published', None)
+        if not published:
+            return
+        for post_id, author_id in published:
+            post_stream.publish(post_id, author_id)
+        cls.prepend_to_timelines(published)
+
+    @classmethod
+    def prepend_to_timelines(cls, published):
+        """put new posts on their readers' hot cached timelines"""
+        if not timeline_cache.enabled:
+            return
+        cached = set(timeline_cache.cached_users())
+        if not cached:
+            return
+        # the session can't run SQL once committed
+        with db.engine.connect() as conn:
+            for post_id, author_id in published:
+                readers = {author_id} & cached
+                for chunk in _chunks(sorted(cached), 500):
+                    readers.update(follower_id for follower_id, in conn.execute(
+                        db.select([follows.c.follower_id]).where(db.and_(
+                            follows.c.followed_id == author_id,
+                            follows.c.follower_id.in_(chunk)
+                        ))
+                    ))
+                timeline_cache.prepend(readers, post_id)
+
+    @classmethod
+    def forget_published(cls, session):
+        session.info.pop('posts_published', None)
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+db.event.listen(db.session, 'after_flush', Post.fan_out)
+db.event.listen(db.session, 'after_flush', Post.count_posts)
+db.event.listen(db.session, 'after_flush', Post.rank_posts)
+db.event.listen(db.session, 'before_flush', Post.unrank_posts)
+db.event.listen(db.session, 'after_flush', Post.index_terms)
+db.event.listen(db.session, 'before_flush', Post.unindex_terms)
+db.event.listen(db.session, 'after_commit', Post.announce)
+db.event.listen(db.session, 'after_rollback', Post.forget_published)
+
+for statement in fts5_ddl(Post.__tablename__, Post.__searchable__):
+    db.event.listen(
+        Post.__table__, 'after_create',
+        db.DDL(statement).execute_if(dialect='sqlite')
+    )
+db.event.listen(
+    Post.__table__, 'before_drop',
+    db.DDL('DROP TABLE IF EXISTS post_fts').execute_if(dialect='sqlite')
+)
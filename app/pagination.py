@@ -0,0 +1,71 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+from datetime import datetime
+
+from app import db
+
+def encode_cursor(item):
+    """opaque url token for an item's (timestamp, id) position"""
+    raw = '{}|{}'.format(item.timestamp.isoformat(), item.id)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        timestamp, _id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None # a mangled cursor just starts over from the newest page
+
+class KeysetPagination(object):
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+def paginate_keyset(query, timestamp, _id, per_page, after=None, before=None):
+    """page through newest-first items keyed on (timestamp, id)
+
+    `timestamp` and `_id` are the columns the query is sorted by; they must
+    hold the same values as the items' own `timestamp` and `id`. Pages are
+    fetched with a range scan of per_page + 1 rows and no COUNT(*).
+    """
+    query = query.order_by(None)
+    after, before = decode_cursor(after), decode_cursor(before)
+    if before is not None:
+        # walk backwards towards newer items, then flip back to newest-first
+        rows = query.filter(db.or_(
+            timestamp > before[0],
+            db.and_(timestamp == before[0], _id > before[1])
+        )).order_by(timestamp.asc(), _id.asc()).limit(per_page + 1).all()
+        more = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        return KeysetPagination(
+            items,
+            encode_cursor(items[-1]) if items else None,
+            encode_cursor(items[0]) if items and more else None
+        )
+    if after is not None:
+        query = query.filter(db.or_(
+            timestamp < after[0],
+            db.and_(timestamp == after[0], _id < after[1])
+        ))
+    rows = query.order_by(
+        timestamp.desc(), _id.desc()
+    ).limit(per_page + 1).all()
+    items = rows[:per_page]
+    return KeysetPagination(
+        items,
+        encode_cursor(items[-1]) if len(rows) > per_page else None,
+        encode_cursor(items[0]) if items and after is not None else None
+    )
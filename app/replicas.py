@@ -0,0 +1,163 @@
+import random
+import sqlite3
+from time import time
+
+from flask import has_request_context, request, session as cookie
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+from app.sqlite import PRAGMAS, Writer, apply_production_options, production_mode, \
+    set_pragmas
+
+# flask session key holding when this client last wrote to the primary
+WRITE_COOKIE = '_db_write_at'
+
+def read_replica(view=None, staleness=None):
+    """let GET requests to this view read from a replica
+
+    Use as @read_replica, or @read_replica(staleness=seconds) to override
+    REPLICA_READ_AFTER_WRITE for this route. Put it directly under
+    @bp.route so the mark survives the other decorators.
+    """
+    def decorate(f):
+        f.read_replica = True
+        f.replica_staleness = staleness
+        return f
+    if view is not None:
+        return decorate(view)
+    return decorate
+
+def _is_write(clause):
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        words = clause.text.split(None, 1)
+        return not words or words[0].upper() not in ('SELECT', 'WITH')
+    return False
+
+class RoutingSession(SignallingSession):
+    """sends reads from @read_replica views to a replica bind
+
+    Everything else goes to the primary: writes, flushes, any request that
+    isn't a GET to a marked view, anything after this session wrote, and
+    clients that wrote less than REPLICA_READ_AFTER_WRITE seconds ago (so
+    people see their own posts). A request sticks to one replica.
+
+    In sqlite production mode a transaction that writes moves to the
+    process's writer connection until it commits or rolls back.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or _is_write(clause):
+            self.info['wrote'] = self.info['writing'] = True
+        elif self._reads_from_replica():
+            key = self.info.get('replica')
+            if key is None:
+                key = self.info['replica'] = random.choice(
+                    self.app.config['SQLALCHEMY_REPLICAS']
+                )
+            return get_state(self.app).db.get_engine(self.app, bind=key)
+        writer = self.app.extensions.get('sqlite_writer')
+        if writer is not None and self.info.get('writing'):
+            return writer.get_engine(get_state(self.app).db)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def _reads_from_replica(self):
+        config = self.app.config
+        if self.info.get('wrote') or not config.get('SQLALCHEMY_REPLICAS'):
+            return False
+        if not has_request_context() or request.method not in ('GET', 'HEAD'):
+            return False
+        view = self.app.view_functions.get(request.endpoint)
+        if not getattr(view, 'read_replica', False):
+            return False
+        staleness = view.replica_staleness
+        if staleness is None:
+            staleness = config['REPLICA_READ_AFTER_WRITE']
+        return time() - cookie.get(WRITE_COOKIE, 0) >= staleness
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        # replicas are ordinary binds named replica0, replica1...
+        app.config.setdefault('REPLICA_READ_AFTER_WRITE', 5)
+        app.config.setdefault('SQLITE_PRODUCTION', False)
+        app.config.setdefault('SQLITE_PRAGMAS', PRAGMAS)
+        app.config.setdefault('SQLITE_WRITE_TIMEOUT', 30)
+        replicas = app.config.get('SQLALCHEMY_REPLICA_URIS') or []
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        app.config['SQLALCHEMY_REPLICAS'] = []
+        for i, uri in enumerate(replicas):
+            binds['replica{}'.format(i)] = uri
+            app.config['SQLALCHEMY_REPLICAS'].append('replica{}'.format(i))
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        super(RoutingSQLAlchemy, self).init_app(app)
+        if production_mode(app, make_url(app.config['SQLALCHEMY_DATABASE_URI'])):
+            app.extensions['sqlite_writer'] = Writer(app)
+        app.before_request(self._start_request)
+
+    def _start_request(self):
+        # routing decisions are per request, even if the session outlives it
+        self.session.info.pop('wrote', None)
+        self.session.info.pop('replica', None)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, sa_url, options)
+        if production_mode(app, sa_url):
+            apply_production_options(app, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        pragmas = engine_opts.pop('sqlite_pragmas', None)
+        engine = super(RoutingSQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if pragmas:
+            set_pragmas(engine, pragmas)
+        return engine
+
+    @property
+    def write_engine(self):
+        """engine for core writes, the writer connection in sqlite production mode
+
+        Don't use it while the session has uncommitted writes in the same
+        thread, the session would be holding the only writer connection.
+        """
+        app = self.get_app()
+        writer = app.extensions.get('sqlite_writer')
+        if writer is None:
+            return self.get_engine(app)
+        return writer.get_engine(self)
+
+def remember_write(session):
+    """after_commit hook: pin this client to the primary for a while"""
+    if session.info.get('wrote') and has_request_context():
+        cookie[WRITE_COOKIE] = time()
+
+def release_writer(session):
+    """after_commit/after_rollback hook: the transaction no longer writes"""
+    session.info.pop('writing', None)
+
+def sync_replicas(app):
+    """copy a sqlite primary onto every sqlite replica file
+
+    Stands in for real replication when developing and testing locally.
+    """
+    primary = _sqlite_path(app.config['SQLALCHEMY_DATABASE_URI'])
+    source = sqlite3.connect(primary)
+    try:
+        for key in app.config['SQLALCHEMY_REPLICAS']:
+            target = sqlite3.connect(_sqlite_path(app.config['SQLALCHEMY_BINDS'][key]))
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+    finally:
+        source.close()
+
+def _sqlite_path(uri):
+    if not uri.startswith('sqlite:///'):
+        raise ValueError('replica sync only works with sqlite files: ' + uri)
+    return uri[len('sqlite:///'):]
@@ -1,5 +1,49 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import json
+import os
+import threading
+from time import time
+
 from flask import current_app
 
+from app import db
+
+# durable outbox of index operations, written in the same transaction as the
+# change that caused them and drained into elasticsearch by SearchIndexer
+search_outbox = db.Table(
+    'search_outbox',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('index_name', db.String(64)),
+    db.Column('object_id', db.Integer),
+    db.Column('op', db.String(8)),
+    db.Column('body', db.Text),
+    db.Column('attempts', db.Integer, default=0),
+    db.Column('created_at', db.DateTime, default=datetime.utcnow),
+    db.Column('next_attempt', db.DateTime, default=datetime.utcnow, index=True),
+    db.Index('ix_search_outbox_index_name_object_id', 'index_name', 'object_id'),
+)
+
+class LazyElasticsearch(object):
+    """an Elasticsearch client for `url`, built on first use
+
+    Importing the client library is a good part of create_app's cost, and
+    most short lived processes never talk to elasticsearch.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from elasticsearch import Elasticsearch # pylint: disable=import-outside-toplevel
+                    self._client = Elasticsearch([self.url])
+        return getattr(self._client, name)
+
 def add_to_index(index, model):
     if not current_app.elasticsearch:
         return
@@ -7,30 +51,400 @@ def add_to_index(index, model):
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
     current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    invalidate_results(index)
 
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
     current_app.elasticsearch.delete(index=index, id=model.id)
+    invalidate_results(index)
+
+class _ResultCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (index, generation, query, page, per_page) -> (expires, ids, total)
+        self.entries = OrderedDict()
+        self.generations = {}
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    """(ids, total) for one page of matches
+
+    Results are kept in an LRU of SEARCH_CACHE_SIZE pages for up to
+    SEARCH_CACHE_TTL seconds (0 turns it off). Keys carry the index's
+    generation, which invalidate_results() bumps whenever documents change,
+    so an answer computed before a change is never served after it. The TTL
+    bounds staleness from other processes and elasticsearch refreshes.
+    """
+    backend = current_app.search_backend
+    if not backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={
-            'query': {
-                'multi_match': {
-                    'query': query,
-                    'fields': ['*']
-                }
-            },
-            'from': (page - 1) * per_page,
-            'size': per_page
-        }
-    )
-    ids = [
-        int(hit['_id'])
-        for hit in search['hits']['hits']
+    ttl = current_app.config['SEARCH_CACHE_TTL']
+    if not ttl:
+        return backend.query(index, query, page, per_page)
+    cache = current_app.extensions['search_cache']
+    now = time()
+    with cache.lock:
+        key = (index, cache.generations.get(index, 0), query, page, per_page)
+        entry = cache.entries.get(key)
+        if entry is not None and entry[0] > now:
+            cache.entries.move_to_end(key)
+            return list(entry[1]), entry[2]
+    ids, total = backend.query(index, query, page, per_page)
+    with cache.lock:
+        cache.entries[key] = (now + ttl, tuple(ids), total)
+        cache.entries.move_to_end(key)
+        while len(cache.entries) > current_app.config['SEARCH_CACHE_SIZE']:
+            cache.entries.popitem(last=False)
+    return ids, total
+
+def invalidate_results(index):
+    """forget cached query results for `index` after its documents changed"""
+    cache = current_app.extensions['search_cache']
+    with cache.lock:
+        cache.generations[index] = cache.generations.get(index, 0) + 1
+
+class ElasticsearchBackend(object):
+    """full text search in elasticsearch, fed through the search outbox"""
+    queues_writes = True
+
+    def query(self, index, query, page, per_page): # pylint: disable=no-self-use
+        if not current_app.elasticsearch:
+            return [], 0
+        search = current_app.elasticsearch.search(
+            index=index,
+            body={
+                'query': {
+                    'multi_match': {
+                        'query': query,
+                        'fields': ['*']
+                    }
+                },
+                'from': (page - 1) * per_page,
+                'size': per_page
+            }
+        )
+        ids = [
+            int(hit['_id'])
+            for hit in search['hits']['hits']
+        ]
+        return ids, search['hits']['total']['value']
+
+class SQLiteFTSBackend(object):
+    """full text search in an external-content fts5 table next to each model
+
+    The `<table>_fts` table and the triggers that keep it in step with the
+    model table are created by fts5_ddl(), so writes need no extra work here.
+    Matches are ranked with bm25.
+    """
+    queues_writes = False
+
+    def query(self, index, query, page, per_page): # pylint: disable=no-self-use
+        # quote every word so user input can't trip fts5 query syntax
+        terms = ' OR '.join(
+            '"{}"'.format(word.replace('"', '""')) for word in query.split()
+        )
+        if not terms:
+            return [], 0
+        rows = db.session.execute(
+            'SELECT id, count(*) OVER () FROM ('
+            'SELECT rowid AS id, bm25({0}_fts) AS score FROM {0}_fts '
+            'WHERE {0}_fts MATCH :terms'
+            ') ORDER BY score LIMIT :limit OFFSET :offset'.format(index),
+            {'terms': terms, 'limit': per_page, 'offset': (page - 1) * per_page}
+        ).fetchall()
+        if rows:
+            return [row[0] for row in rows], rows[0][1]
+        if page == 1:
+            return [], 0
+        return [], db.session.execute(
+            'SELECT count(*) FROM {0}_fts WHERE {0}_fts MATCH :terms'.format(index),
+            {'terms': terms}
+        ).scalar()
+
+    def rebuild(self, index): # pylint: disable=no-self-use
+        db.session.execute(
+            "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(index)
+        )
+        db.session.commit()
+
+def fts5_ddl(table, fields):
+    """statements creating `table`'s fts5 index and its sync triggers"""
+    fts = '{}_fts'.format(table)
+    columns = ', '.join(fields)
+    new = ', '.join('new.' + field for field in fields)
+    old = ', '.join('old.' + field for field in fields)
+    delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {2});" \
+        .format(fts, columns, old)
+    insert = 'INSERT INTO {0}(rowid, {1}) VALUES (new.id, {2});' \
+        .format(fts, columns, new)
+    return [
+        "CREATE VIRTUAL TABLE {0} USING fts5({1}, content='{2}', content_rowid='id')"
+        .format(fts, columns, table),
+        'CREATE TRIGGER {0}_ai AFTER INSERT ON {1} BEGIN {2} END'
+        .format(fts, table, insert),
+        'CREATE TRIGGER {0}_ad AFTER DELETE ON {1} BEGIN {2} END'
+        .format(fts, table, delete),
+        'CREATE TRIGGER {0}_au AFTER UPDATE OF {1} ON {2} BEGIN {3} {4} END'
+        .format(fts, columns, table, delete, insert),
     ]
-    return ids, search['hits']['total']['value']
+
+def make_backend(app):
+    """pick the configured search backend, or the best one available"""
+    name = app.config['SEARCH_BACKEND']
+    if name is None:
+        if app.config['ELASTICSEARCH_URL']:
+            name = 'elasticsearch'
+        elif app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+            name = 'sqlite'
+    if name == 'elasticsearch':
+        return ElasticsearchBackend()
+    if name == 'sqlite':
+        return SQLiteFTSBackend()
+    return None
+
+def create_index(client, name):
+    """create an index tuned for bulk loading: no refreshes until it's done"""
+    client.indices.create(
+        index=name, body={'settings': {'refresh_interval': '-1'}}
+    )
+
+def finish_index(client, name):
+    client.indices.put_settings(
+        index=name, body={'index': {'refresh_interval': None}}
+    )
+    client.indices.refresh(index=name)
+
+def bulk_index(client, index, docs, deleted=()):
+    """index (id, payload) pairs and delete `deleted` ids in one bulk
+    request, return ids that failed"""
+    actions = []
+    for _id, payload in docs:
+        actions.append({'index': {'_index': index, '_id': _id}})
+        actions.append(payload)
+    for _id in deleted:
+        actions.append({'delete': {'_index': index, '_id': _id}})
+    if not actions:
+        return []
+    failed = []
+    for item in client.bulk(body=actions)['items']:
+        op, result = list(item.items())[0]
+        status = result.get('status', 500)
+        # deleting a document that was never indexed is fine
+        if status >= 300 and not (op == 'delete' and status == 404):
+            failed.append(result['_id'])
+    return failed
+
+def swap_alias(client, alias, index):
+    """atomically point `alias` at `index`, return the indices it left"""
+    old = []
+    actions = []
+    if client.indices.exists_alias(name=alias):
+        old = list(client.indices.get_alias(name=alias))
+        for name in old:
+            actions.append({'remove': {'index': name, 'alias': alias}})
+    elif client.indices.exists(index=alias):
+        # first build after running without aliases: replace the real index
+        actions.append({'remove_index': {'index': alias}})
+    actions.append({'add': {'index': index, 'alias': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    return old
+
+def checkpoint_path(alias):
+    return os.path.join(current_app.instance_path, 'reindex-{}.json'.format(alias))
+
+def load_checkpoint(alias):
+    try:
+        with open(checkpoint_path(alias)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_checkpoint(alias, state):
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    with open(checkpoint_path(alias), 'w') as f:
+        json.dump(state, f)
+
+def clear_checkpoint(alias):
+    for path in (checkpoint_path(alias), touched_path(alias)):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# While an index is rebuilt, drain_outbox mirrors every operation for its
+# alias into the new index and notes the document ids here, so reindex can
+# sync them from the db again once the bulk load, which may have read them
+# before they changed, is over.
+def touched_path(alias):
+    return os.path.join(current_app.instance_path, 'reindex-{}.touched'.format(alias))
+
+def note_touched(alias, ids):
+    with open(touched_path(alias), 'a') as f:
+        f.write(''.join('{}\n'.format(_id) for _id in ids))
+
+def take_touched(alias):
+    """ids noted for `alias` since the last call"""
+    path = touched_path(alias)
+    taken = path + '.taken'
+    try:
+        os.replace(path, taken)
+    except FileNotFoundError:
+        return set()
+    with open(taken) as f:
+        ids = {int(line) for line in f if line.strip()}
+    os.remove(taken)
+    return ids
+
+def outbox_row(index, model, op):
+    row = {'index_name': index, 'object_id': model.id, 'op': op, 'body': None}
+    if op == 'index':
+        row['body'] = json.dumps({
+            field: getattr(model, field) for field in model.__searchable__
+        })
+    return row
+
+def drain_outbox(batch_size=500):
+    """send one batch of queued operations to elasticsearch
+
+    Repeated operations on the same document within the batch are coalesced
+    so only the newest one is sent. Once it succeeds every row for that
+    document up to it is deleted, including older ones still backing off,
+    which would otherwise replay stale data later. When it fails, all of
+    the document's rows are retried together with exponential backoff.
+    Operations for an alias that is being rebuilt are mirrored into the new
+    index too. Returns the number of rows handled.
+    """
+    if not current_app.elasticsearch:
+        return 0
+    from elasticsearch import ElasticsearchException # pylint: disable=import-outside-toplevel
+    now = datetime.utcnow()
+    with db.engine.begin() as conn:
+        rows = conn.execute(
+            search_outbox.select().where(
+                search_outbox.c.next_attempt <= now
+            ).order_by(search_outbox.c.id).limit(batch_size)
+        ).fetchall()
+    if not rows:
+        return 0
+    latest = {}
+    for row in rows:
+        latest[(row.index_name, row.object_id)] = row
+    keys = list(latest)
+    building = {}
+    for index in {index for index, _id in keys}:
+        state = load_checkpoint(index)
+        if state is not None:
+            building[index] = state['index']
+            note_touched(index, [_id for name, _id in keys if name == index])
+    actions = []
+    mirrored = []
+    for index, _id in keys:
+        row = latest[(index, _id)]
+        actions.append({row.op: {'_index': index, '_id': _id}})
+        body = [json.loads(row.body)] if row.op == 'index' else []
+        actions.extend(body)
+        if index in building:
+            mirrored.append({row.op: {'_index': building[index], '_id': _id}})
+            mirrored.extend(body)
+    # mirrored operations ride along at the end; reindex syncs their
+    # documents again anyway, so only the alias's own results count
+    actions.extend(mirrored)
+    try:
+        items = current_app.elasticsearch.bulk(body=actions)['items']
+        failed = set()
+        for key, item in zip(keys, items):
+            result = list(item.values())[0]
+            # deleting a document that was never indexed is fine
+            if result.get('status', 500) >= 300 and not (
+                    latest[key].op == 'delete' and result.get('status') == 404):
+                failed.add(key)
+    except ElasticsearchException as error:
+        current_app.logger.warning('search outbox drain failed: %s', error)
+        failed = set(keys)
+    sent = [key for key in keys if key not in failed]
+    max_backoff = current_app.config['SEARCH_QUEUE_MAX_BACKOFF']
+    same_document = db.and_(
+        search_outbox.c.index_name == db.bindparam('_index'),
+        search_outbox.c.object_id == db.bindparam('_id'),
+    )
+    with db.write_engine.begin() as conn:
+        if sent:
+            conn.execute(search_outbox.delete().where(db.and_(
+                same_document, search_outbox.c.id <= db.bindparam('_last')
+            )), [{'_index': index, '_id': _id, '_last': latest[(index, _id)].id}
+                 for index, _id in sent])
+        if failed:
+            attempts = {}
+            for row in rows:
+                key = (row.index_name, row.object_id)
+                attempts[key] = max(attempts.get(key, 0), row.attempts or 0)
+            conn.execute(search_outbox.update().where(same_document).values(
+                attempts=search_outbox.c.attempts + 1,
+                next_attempt=db.bindparam('_next')
+            ), [{'_index': index, '_id': _id, '_next': now + timedelta(
+                seconds=min(2 ** attempts[(index, _id)], max_backoff)
+            )} for index, _id in failed])
+    for index in {index for index, _id in sent}:
+        invalidate_results(index)
+    return len([row for row in rows if (row.index_name, row.object_id) not in failed])
+
+def outbox_lag():
+    """(pending operations, age in seconds of the oldest one)"""
+    with db.engine.connect() as conn:
+        count, oldest = conn.execute(db.select([
+            db.func.count(search_outbox.c.id),
+            db.func.min(search_outbox.c.created_at)
+        ])).first()
+    if oldest is None:
+        return 0, 0.0
+    if not isinstance(oldest, datetime): # sqlite hands back raw strings here
+        oldest = datetime.fromisoformat(oldest)
+    return count, (datetime.utcnow() - oldest).total_seconds()
+
+class SearchIndexer(object):
+    """background thread that drains the search outbox
+
+    The thread is started on demand the first time there is work and woken
+    after every commit that queued an operation; otherwise it polls every
+    SEARCH_QUEUE_POLL_INTERVAL seconds to pick up retries.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_QUEUE_WORKER', True)
+        app.config.setdefault('SEARCH_QUEUE_BATCH_SIZE', 500)
+        app.config.setdefault('SEARCH_QUEUE_POLL_INTERVAL', 5)
+        app.config.setdefault('SEARCH_QUEUE_MAX_BACKOFF', 300)
+        app.config.setdefault('SEARCH_CACHE_TTL', 60)
+        app.config.setdefault('SEARCH_CACHE_SIZE', 1000)
+        app.extensions['search_cache'] = _ResultCache()
+        app.before_first_request(self.notify)
+
+    def notify(self):
+        app = current_app._get_current_object() # pylint: disable=protected-access
+        if not app.elasticsearch or not app.config['SEARCH_QUEUE_WORKER']:
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, args=(app,), daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(app.config['SEARCH_QUEUE_POLL_INTERVAL'])
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    while drain_outbox(app.config['SEARCH_QUEUE_BATCH_SIZE']):
+                        pass
+                except Exception: # pylint: disable=broad-except
+                    app.logger.exception('search indexer crashed, retrying')
@@ -0,0 +1,66 @@
+"""opt-in production settings for a file backed sqlite database
+
+With SQLITE_PRODUCTION on, every connection runs SQLITE_PRAGMAS as it is
+opened (WAL, busy_timeout, synchronous=NORMAL, mmap and page cache) and
+connections are pooled instead of reopened for each checkout.
+
+Writes from a process all go through one writer connection. Sessions that
+flush and core writers such as the last_seen buffer check it out of a pool
+of size one, so threads queue up for it in turn instead of racing for the
+database lock and giving up with "database is locked". Only the processes
+themselves still compete for the lock, and busy_timeout waits that out.
+"""
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+# applied in order; busy_timeout goes first so switching to WAL can wait
+PRAGMAS = [
+    ('busy_timeout', 5000),
+    ('journal_mode', 'wal'),
+    ('synchronous', 'normal'),
+    ('mmap_size', 256 * 1024 * 1024),
+    ('cache_size', -64 * 1024), # negative sizes are in KiB
+]
+
+def production_mode(app, sa_url):
+    return bool(app.config.get('SQLITE_PRODUCTION')) and \
+        sa_url.drivername == 'sqlite' and \
+        sa_url.database not in (None, '', ':memory:')
+
+def apply_production_options(app, options):
+    """engine options for a pooled, tuned sqlite file"""
+    options['poolclass'] = QueuePool
+    options.setdefault('connect_args', {})['check_same_thread'] = False
+    options['sqlite_pragmas'] = app.config['SQLITE_PRAGMAS']
+
+def set_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record): # pylint: disable=unused-variable,unused-argument
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+class Writer(object):
+    """the single connection a process sends its writes through"""
+
+    def __init__(self, app):
+        self.app = app
+        self.engine = None
+        self.lock = threading.Lock()
+
+    def get_engine(self, db):
+        with self.lock:
+            if self.engine is None:
+                sa_url = make_url(self.app.config['SQLALCHEMY_DATABASE_URI'])
+                options = {}
+                db.apply_driver_hacks(self.app, sa_url, options)
+                options.update(
+                    pool_size=1, max_overflow=0,
+                    pool_timeout=self.app.config['SQLITE_WRITE_TIMEOUT']
+                )
+                self.engine = db.create_engine(sa_url, options)
+            return self.engine
@@ -0,0 +1,56 @@
+"""keeping process start cheap
+
+Web workers and CLI commands all go through create_app, so extensions that
+pull in big libraries are only set up once something uses them: alembic
+for `flask db`, and flask-moment (which imports distutils, and through it
+setuptools) for the first template render. Templates are compiled through
+a bytecode cache on disk, which `flask templates compile` can fill ahead
+of time.
+"""
+import os
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.local import LocalProxy
+
+class LazyMigrate(object):
+    """Flask-Migrate, set up the first time a `flask db` command asks for it"""
+
+    def init_app(self, app, db):
+        app.extensions['migrate'] = LocalProxy(lambda: self._load(app, db))
+
+    @staticmethod
+    def _load(app, db):
+        if type(app.extensions['migrate']) is LocalProxy: # pylint: disable=unidiomatic-typecheck
+            from flask_migrate import Migrate # pylint: disable=import-outside-toplevel
+            Migrate(app, db)
+        return app.extensions['migrate']
+
+class LazyMoment(object):
+    """Flask-Moment's `moment` template global, imported on first render"""
+
+    def init_app(self, app):
+        app.context_processor(self.context_processor)
+
+    @staticmethod
+    def context_processor():
+        moment = current_app.extensions.get('moment')
+        if moment is None:
+            from flask_moment import _moment # pylint: disable=import-outside-toplevel
+            moment = current_app.extensions['moment'] = _moment
+        return {'moment': moment}
+
+def bytecode_cache(app):
+    """compile templates through JINJA_BYTECODE_CACHE, a directory, if set"""
+    directory = app.config.get('JINJA_BYTECODE_CACHE')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=FileSystemBytecodeCache(directory))
+
+def compile_templates(app):
+    """load every template once, so the bytecode cache holds all of them"""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
@@ -0,0 +1,312 @@
+"""live new-post notifications over server-sent events
+
+The web workers are plain WSGI, where a streaming response would pin a
+thread per open connection. Streams are served instead by a small asyncio
+server on STREAM_PORT, running on one background thread per process, so
+thousands of idle clients cost a coroutine and a socket each. It listens on
+STREAM_HOST, 127.0.0.1 unless set, so put it behind the same host as the
+app (proxy /stream to it, and set STREAM_URL); set STREAM_HOST to a public
+address to let the pages connect to the port directly. Bound to loopback
+with no STREAM_URL, pages get no stream at all rather than one browsers
+can't reach.
+
+Posts committed in this process are published straight away; a poller
+picks up posts committed by other processes every STREAM_POLL_INTERVAL
+seconds. Clients get `post` events carrying the new post id: for
+?scope=home only posts by people they followed when they connected (and
+their own), for ?scope=explore everything.
+"""
+import asyncio
+from collections import OrderedDict
+import ipaddress
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from flask import current_app, request
+from werkzeug.http import parse_cookie
+
+from app import db
+
+# lightweight handles on the tables this module reads, so it needn't import models
+_post = db.table('post', db.column('id'), db.column('user_id'))
+_follows = db.table('follows', db.column('follower_id'), db.column('followed_id'))
+
+class Broker(object):
+    """in-process pub/sub of new post ids, only touched on the loop thread
+
+    A subscriber more than `backlog` posts behind is sent None, which tells
+    its connection to hang up; the browser reconnects and starts afresh.
+    """
+
+    def __init__(self, backlog=100):
+        self.backlog = backlog
+        self.everything = set() # explore subscribers' queues
+        self.by_author = {} # author id -> home subscribers' queues
+        self.recent = OrderedDict() # post ids already sent
+
+    def subscribe(self, queue, authors=None):
+        if authors is None:
+            self.everything.add(queue)
+        for author_id in authors or ():
+            self.by_author.setdefault(author_id, set()).add(queue)
+
+    def unsubscribe(self, queue, authors=None):
+        self.everything.discard(queue)
+        for author_id in authors or ():
+            queues = self.by_author.get(author_id)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self.by_author[author_id]
+
+    def dispatch(self, post_id, author_id):
+        if post_id in self.recent:
+            return
+        self.recent[post_id] = True
+        if len(self.recent) > 10000:
+            self.recent.popitem(last=False)
+        for queue in self.everything | self.by_author.get(author_id, set()):
+            if queue.qsize() < self.backlog:
+                queue.put_nowait(post_id)
+            elif queue.qsize() == self.backlog:
+                queue.put_nowait(None)
+
+    @property
+    def subscribers(self):
+        queues = set(self.everything)
+        for subscribed in self.by_author.values():
+            queues |= subscribed
+        return len(queues)
+
+class StreamServer(object):
+    def __init__(self, app):
+        self.app = app
+        self.broker = Broker(app.config['STREAM_BACKLOG'])
+        self.loop = None
+        self.port = None
+        self.connections = 0
+        self._started = threading.Event()
+        self._thread = None
+
+    def start(self, host, port):
+        """serve on a daemon thread, returns once the socket is bound"""
+        self._thread = threading.Thread(target=self._run, args=(host, port),
+                                        daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self.port
+
+    def stop(self):
+        """drop every connection and end the loop thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+
+    def publish(self, post_id, author_id):
+        """hand a new post to the loop; safe from any thread"""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broker.dispatch, post_id, author_id)
+
+    def _run(self, host, port):
+        self.loop = asyncio.new_event_loop()
+        server = self.loop.run_until_complete(asyncio.start_server(
+            self._handle, host, port, reuse_port=True, backlog=1024
+        ))
+        self.port = server.sockets[0].getsockname()[1]
+        self.loop.create_task(self._poll())
+        self._started.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True)
+            )
+            self.loop.close()
+            self.loop = None
+
+    async def _handle(self, reader, writer):
+        queue = authors = None
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            lines = head.decode('latin-1').split('\r\n')
+            method, target = lines[0].split(' ')[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            if method != 'GET' or url.path.rstrip('/') != '/stream':
+                return await self._refuse(writer, '404 Not Found')
+            user_id = self._user_id(headers.get('cookie', ''))
+            if user_id is None:
+                return await self._refuse(writer, '401 Unauthorized')
+            if parse_qs(url.query).get('scope') != ['explore']:
+                authors = await self.loop.run_in_executor(None, self._following, user_id)
+            writer.write(self._preamble(headers))
+            queue = asyncio.Queue()
+            self.broker.subscribe(queue, authors)
+            self.connections += 1
+            heartbeat = self.app.config['STREAM_HEARTBEAT']
+            hangup = self.loop.create_task(reader.read()) # clients never send more
+            try:
+                while True:
+                    waiting = self.loop.create_task(queue.get())
+                    done, _ = await asyncio.wait({waiting, hangup}, timeout=heartbeat,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    if hangup in done:
+                        waiting.cancel()
+                        break
+                    if waiting not in done:
+                        waiting.cancel()
+                        writer.write(b': keepalive\n\n')
+                    else:
+                        post_id = waiting.result()
+                        if post_id is None:
+                            break
+                        writer.write('id: {0}\nevent: post\ndata: {0}\n\n'
+                                     .format(post_id).encode('ascii'))
+                    await writer.drain()
+            finally:
+                hangup.cancel()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        except asyncio.CancelledError:
+            pass # shutting down; finishing quietly keeps asyncio from logging it
+        finally:
+            if queue is not None:
+                self.broker.unsubscribe(queue, authors)
+                self.connections -= 1
+            writer.close()
+
+    async def _refuse(self, writer, status): # pylint: disable=no-self-use
+        writer.write('HTTP/1.1 {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+                     .format(status).encode('latin-1'))
+        await writer.drain()
+
+    def _preamble(self, headers):
+        lines = [
+            'HTTP/1.1 200 OK',
+            'Content-Type: text/event-stream',
+            'Cache-Control: no-cache',
+            'Connection: keep-alive',
+            'X-Accel-Buffering: no',
+        ]
+        # pages on the same host, but another port, may read the stream
+        origin = headers.get('origin')
+        if origin and urlsplit(origin).hostname == \
+                urlsplit('//' + headers.get('host', '')).hostname:
+            lines += ['Access-Control-Allow-Origin: ' + origin,
+                      'Access-Control-Allow-Credentials: true']
+        retry = int(self.app.config['STREAM_HEARTBEAT'] * 1000)
+        return ('\r\n'.join(lines) + '\r\n\r\nretry: {}\n\n'.format(retry)) \
+            .encode('latin-1')
+
+    def _user_id(self, cookie):
+        """the flask-login user id in this request's session cookie"""
+        value = parse_cookie(cookie).get(self.app.session_cookie_name)
+        serializer = self.app.session_interface.get_signing_serializer(self.app)
+        if not value or serializer is None:
+            return None
+        try:
+            session = serializer.loads(
+                value, max_age=self.app.permanent_session_lifetime.total_seconds()
+            )
+        except Exception: # pylint: disable=broad-except
+            return None
+        try:
+            return int(session['_user_id'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def _following(self, user_id):
+        with self.app.app_context():
+            try:
+                return {user_id} | {followed_id for followed_id, in db.session.execute(
+                    db.select([_follows.c.followed_id]).where(
+                        _follows.c.follower_id == user_id
+                    )
+                )}
+            finally:
+                db.session.remove()
+
+    async def _poll(self):
+        """publish posts other processes committed"""
+        last = None
+        while True:
+            try:
+                last, posts = await self.loop.run_in_executor(None, self._new_posts, last)
+                for post_id, author_id in posts:
+                    self.broker.dispatch(post_id, author_id)
+            except Exception: # pylint: disable=broad-except
+                self.app.logger.exception('stream poller failed, retrying')
+            await asyncio.sleep(self.app.config['STREAM_POLL_INTERVAL'])
+
+    def _new_posts(self, last):
+        with self.app.app_context():
+            try:
+                if last is None:
+                    return db.session.execute(
+                        db.select([db.func.max(_post.c.id)])
+                    ).scalar() or 0, []
+                posts = db.session.execute(
+                    db.select([_post.c.id, _post.c.user_id]).where(
+                        _post.c.id > last
+                    ).order_by(_post.c.id).limit(1000)
+                ).fetchall()
+                return (posts[-1][0] if posts else last), posts
+            finally:
+                db.session.remove()
+
+class PostStream(object):
+    """starts a StreamServer per process when STREAM_PORT is set"""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('STREAM_PORT', None)
+        app.config.setdefault('STREAM_HOST', '127.0.0.1')
+        app.config.setdefault('STREAM_URL', None)
+        app.config.setdefault('STREAM_HEARTBEAT', 15)
+        app.config.setdefault('STREAM_POLL_INTERVAL', 2)
+        app.config.setdefault('STREAM_BACKLOG', 100)
+        app.extensions['stream'] = StreamServer(app)
+        if app.config['STREAM_PORT'] is not None:
+            app.before_first_request(self.start)
+
+    def start(self): # pylint: disable=no-self-use
+        server = current_app.extensions['stream']
+        if server.loop is None:
+            server.start(current_app.config['STREAM_HOST'],
+                         current_app.config['STREAM_PORT'])
+        return server
+
+    def publish(self, post_id, author_id): # pylint: disable=no-self-use
+        current_app.extensions['stream'].publish(post_id, author_id)
+
+    def url(self, scope): # pylint: disable=no-self-use
+        """where pages should open their EventSource, None when off"""
+        config = current_app.config
+        server = current_app.extensions['stream']
+        if config['STREAM_URL']:
+            base = config['STREAM_URL']
+        elif server.port is not None and not _loopback(config['STREAM_HOST']):
+            base = '//{}:{}/stream'.format(request.host.rsplit(':', 1)[0], server.port)
+        else:
+            return None
+        return '{}?scope={}'.format(base, scope)
+
+def _loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
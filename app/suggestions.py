@@ -0,0 +1,173 @@
+"""offline "who to follow" suggestions from the follow graph
+
+`flask suggestions build` loads the follows table once into a compressed
+sparse row (CSR) adjacency: `indptr[u]:indptr[u + 1]` is the slice of
+`indices` holding the ids user u follows, both flat arrays of machine
+integers, so even millions of edges stay compact and cheap to hand to
+worker processes. Users are then split into batches of SUGGESTIONS_BATCH
+ids, and a process pool counts, for every user in a batch, how many of the
+people they follow follow each second degree account. Accounts following
+more than SUGGESTIONS_MAX_FANIN others only contribute an evenly spaced
+sample of that many, so a user's cost is bounded by how many people they
+follow, not by how many those follow; the mutual counts through such
+accounts are undercounted accordingly. The top
+SUGGESTIONS_K accounts they don't already follow, by mutual count, then
+follower count, are written to the suggestion table one batch per
+transaction, so pages keep showing the previous suggestions until a user's
+new ones are in.
+"""
+from array import array
+from collections import Counter
+import heapq
+import multiprocessing
+import os
+
+from flask import current_app
+
+from app import db
+
+suggestion = db.Table(
+    'suggestion',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('rank', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('suggested_id', db.Integer, db.ForeignKey('user.id')),
+    db.Column('mutual', db.Integer),
+)
+
+# lightweight handles on the tables this module reads, so it needn't import models
+_follows = db.table('follows', db.column('follower_id'), db.column('followed_id'))
+_user = db.table('user', db.column('id'), db.column('followers_count'))
+
+class Graph(object):
+    """who follows whom, as CSR arrays indexed by user id"""
+
+    def __init__(self, indptr, indices, followers):
+        self.indptr = indptr
+        self.indices = indices
+        self.followers = followers # user id -> follower count, for ties
+
+    @property
+    def size(self):
+        return len(self.indptr) - 1
+
+    def following(self, user_id, limit=None):
+        """ids user_id follows; at most `limit` of them, evenly spaced, if set"""
+        start, stop = self.indptr[user_id], self.indptr[user_id + 1]
+        step = -(-(stop - start) // limit) if limit else 1
+        return self.indices[start:stop:step or 1]
+
+    @classmethod
+    def load(cls, chunk_size=100000):
+        """read follows in primary key order, straight into the arrays"""
+        size = (db.session.execute(db.select([db.func.max(_user.c.id)])).scalar() or 0) + 1
+        followers = array('q', bytes(8 * size))
+        for user_id, count in db.session.execute(
+                db.select([_user.c.id, _user.c.followers_count])):
+            followers[user_id] = count or 0
+        indptr = array('q', bytes(8 * (size + 1)))
+        indices = array('q')
+        result = db.session.execute(
+            db.select([_follows.c.follower_id, _follows.c.followed_id]).order_by(
+                _follows.c.follower_id, _follows.c.followed_id
+            )
+        )
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            for follower_id, followed_id in rows:
+                indptr[follower_id + 1] += 1
+                indices.append(followed_id)
+        for user_id in range(size):
+            indptr[user_id + 1] += indptr[user_id]
+        return cls(indptr, indices, followers)
+
+    def suggest(self, user_id, k, max_fanin=None):
+        """[(suggested id, mutual count)] for one user, best first"""
+        following = self.following(user_id)
+        if not following:
+            return []
+        counts = Counter()
+        for followed_id in following:
+            counts.update(self.following(followed_id, max_fanin))
+        counts.pop(user_id, None)
+        for followed_id in following:
+            counts.pop(followed_id, None)
+        followers = self.followers
+        return heapq.nlargest(
+            k, counts.items(),
+            key=lambda item: (item[1], followers[item[0]], -item[0])
+        )
+
+    def suggest_batch(self, start, stop, k, max_fanin=None):
+        """suggestion rows for user ids start <= id < stop"""
+        rows = []
+        for user_id in range(start, min(stop, self.size)):
+            for rank, (suggested_id, mutual) in enumerate(
+                    self.suggest(user_id, k, max_fanin)):
+                rows.append({'user_id': user_id, 'rank': rank,
+                             'suggested_id': suggested_id, 'mutual': mutual})
+        return start, stop, rows
+
+_graph = None # the graph in each worker process
+
+def _init_worker(graph):
+    global _graph # pylint: disable=global-statement
+    _graph = graph
+
+def _work(args):
+    return _graph.suggest_batch(*args)
+
+class Suggestions(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app): # pylint: disable=no-self-use
+        app.config.setdefault('SUGGESTIONS_K', 10)
+        app.config.setdefault('SUGGESTIONS_SHOWN', 3)
+        app.config.setdefault('SUGGESTIONS_BATCH', 1000)
+        app.config.setdefault('SUGGESTIONS_MAX_FANIN', 1000)
+        app.config.setdefault('SUGGESTIONS_WORKERS', None) # one per cpu
+
+    def build(self, workers=None, progress=None): # pylint: disable=no-self-use
+        """recompute every user's suggestions, returns the rows written
+
+        workers=0 computes in this process. `progress(users done, users)` is
+        called after each batch is written.
+        """
+        config = current_app.config
+        k = config['SUGGESTIONS_K']
+        batch_size = config['SUGGESTIONS_BATCH']
+        max_fanin = config['SUGGESTIONS_MAX_FANIN']
+        if workers is None:
+            workers = config['SUGGESTIONS_WORKERS']
+        if workers is None:
+            workers = os.cpu_count() or 1
+        graph = Graph.load()
+        db.session.rollback() # done reading; batches are written on their own
+        batches = [(start, start + batch_size, k, max_fanin)
+                   for start in range(0, graph.size, batch_size)]
+        written = 0
+
+        def save(start, stop, rows):
+            with db.write_engine.begin() as conn:
+                conn.execute(suggestion.delete().where(db.and_(
+                    suggestion.c.user_id >= start, suggestion.c.user_id < stop
+                )))
+                if rows:
+                    conn.execute(suggestion.insert(), rows)
+            if progress:
+                progress(min(stop, graph.size), graph.size)
+            return len(rows)
+
+        if not workers:
+            for batch in batches:
+                written += save(*graph.suggest_batch(*batch))
+            return written
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+        with context.Pool(workers, _init_worker, (graph,)) as pool:
+            for result in pool.imap_unordered(_work, batches):
+                written += save(*result)
+        return written
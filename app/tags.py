@@ -0,0 +1,149 @@
+"""#tag and @mention timelines from an inverted index of post terms
+
+Every hashtag and mention in a post gets a row in post_term keyed by
+(term, timestamp, post_id), written in the same flush as the post, so a tag
+or mentions page is one range scan down the primary key, in the order
+paginate_keyset walks it. Terms keep their # or @ and are lowercased, and
+so are usernames when a mentions page looks for theirs; rendered posts link
+mentions to the profile whose username matches regardless of case, and
+leave mentions of nobody as text. Mentions are looked up once per page of
+posts, see mentioned(). `flask tags backfill` tokenizes posts written
+before the index existed.
+"""
+import re
+
+from flask import g, has_app_context, url_for
+from markupsafe import Markup, escape
+
+from app import db
+
+TERM_LENGTH = 64
+
+# a # or @ that doesn't continue a word, so e-mail addresses aren't mentions
+TERM_RE = re.compile(r'(?<!\w)([#@])(\w{1,%d})' % TERM_LENGTH)
+
+post_term = db.Table(
+    'post_term',
+    db.Column('term', db.String(TERM_LENGTH + 1), primary_key=True),
+    db.Column('timestamp', db.DateTime, primary_key=True),
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Index('ix_post_term_post_id', 'post_id'),
+)
+
+# lightweight handles on the tables this module reads, so it needn't import models
+_post = db.table('post', db.column('id'), db.column('body'),
+                 db.column('timestamp', db.DateTime))
+_user = db.table('user', db.column('username'))
+
+def terms(body):
+    """the distinct #tags and @mentions in a post body, lowercased"""
+    return {sign + word.lower() for sign, word in TERM_RE.findall(body or '')}
+
+def tag_term(name):
+    return '#' + name.lower()
+
+def mention_term(username):
+    return '@' + username.lower()
+
+def mentions(body):
+    """the words @mentioned in a post body, as written"""
+    return {word for sign, word in TERM_RE.findall(body or '') if sign == '@'}
+
+def _known():
+    return g.setdefault('_usernames', {}) if has_app_context() else {}
+
+def _look_up(words, known):
+    found = {}
+    if words:
+        for username, in db.session.execute(db.select([_user.c.username]).where(
+                db.func.lower(_user.c.username).in_({word.lower() for word in words}))):
+            found.setdefault(username.lower(), set()).add(username)
+    for word in words:
+        # should two usernames differ only in case, an exact match wins
+        matches = found.get(word.lower(), ())
+        known[word] = word if word in matches else min(matches, default=None)
+
+def usernames(words):
+    """word -> the username it mentions, for those that are users
+
+    Words mentioned() already looked up don't cost another query.
+    """
+    known = _known()
+    _look_up({word for word in words if word not in known}, known)
+    return {word: known[word] for word in words if known[word] is not None}
+
+def mentioned(posts):
+    """look up what a page of posts mentions in one query, ahead of rendering"""
+    if has_app_context() and g.get('_mentions_page') is posts:
+        return
+    _look_up({word for post in posts for word in mentions(post.body)}, _known())
+    if has_app_context():
+        g._mentions_page = posts
+
+def link_terms(body):
+    """post body markup with tags linked to their timelines, mentions to profiles"""
+    body = body or ''
+    matches = list(TERM_RE.finditer(body))
+    users = usernames(mentions(body))
+    parts = []
+    last = 0
+    for match in matches:
+        sign, word = match.groups()
+        if sign == '#':
+            url = url_for('main.tag', name=word.lower())
+        elif word in users:
+            url = url_for('main.user', username=users[word])
+        else:
+            continue
+        parts.append(escape(body[last:match.start()]))
+        parts.append(Markup('<a href="{}">{}</a>').format(url, match.group()))
+        last = match.end()
+    parts.append(escape(body[last:]))
+    return Markup('').join(parts)
+
+class TagIndex(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app): # pylint: disable=no-self-use
+        app.add_template_filter(link_terms, 'link_terms')
+
+    def index(self, session, posts): # pylint: disable=no-self-use
+        """add (post_id, timestamp, body) new posts to the index"""
+        rows = [{'term': term, 'timestamp': timestamp, 'post_id': post_id}
+                for post_id, timestamp, body in posts for term in terms(body)]
+        if rows:
+            session.execute(post_term.insert(), rows)
+        return len(rows)
+
+    def forget(self, session, post_ids): # pylint: disable=no-self-use
+        if post_ids:
+            session.execute(post_term.delete().where(post_term.c.post_id.in_(post_ids)))
+
+    def backfill(self, chunk_size=10000, progress=None):
+        """index every post from scratch, returns the terms written
+
+        Posts are read in primary key order, chunk_size at a time, and each
+        chunk is committed on its own; `progress(posts done, terms)` is
+        called after each. Posts written meanwhile are indexed as they flush.
+        """
+        db.session.execute(post_term.delete())
+        newest = db.session.execute(db.select([db.func.max(_post.c.id)])).scalar() or 0
+        done = written = last_id = 0
+        while True:
+            posts = db.session.execute(
+                db.select([_post.c.id, _post.c.timestamp, _post.c.body]).where(
+                    db.and_(_post.c.id > last_id, _post.c.id <= newest)
+                ).order_by(_post.c.id).limit(chunk_size)
+            ).fetchall()
+            if not posts:
+                break
+            written += self.index(db.session, posts)
+            db.session.commit()
+            done += len(posts)
+            last_id = posts[-1][0]
+            if progress:
+                progress(done, written)
+        db.session.commit()
+        return written
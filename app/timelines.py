@@ -0,0 +1,167 @@
+from array import array
+from collections import OrderedDict
+import sys
+import threading
+
+from flask import current_app
+
+class _Entry(object):
+    __slots__ = ('ids', 'version', 'complete')
+
+    def __init__(self, ids, version, complete):
+        self.ids = ids # post ids, newest first
+        self.version = version
+        self.complete = complete
+
+    @property
+    def head(self):
+        return self.ids[0] if self.ids else None
+
+    @property
+    def size(self):
+        return sys.getsizeof(self.ids)
+
+class _Timelines(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # user id -> _Entry
+        self.seen_once = set()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+class TimelineCache(object):
+    """per-process cache of busy users' newest timeline post ids
+
+    Each cached user costs one array('q') of up to TIMELINE_CACHE_DEPTH
+    ids; all of them together stay under TIMELINE_CACHE_BYTES, evicting the
+    least recently used (0 turns the cache off). A user is only cached the
+    second time their timeline misses, so one-off visits don't churn it.
+
+    An entry is used only while its newest id and the user's
+    timeline_version match what User.timeline_head() reads from the
+    database, which is how other processes' posts and follow changes are
+    noticed. Posts committed in
+    this process are prepended to their followers' cached timelines.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TIMELINE_CACHE_BYTES', 16 * 1024 * 1024)
+        app.config.setdefault('TIMELINE_CACHE_DEPTH', 200)
+        app.extensions['timeline_cache'] = _Timelines()
+
+    @property
+    def enabled(self):
+        return bool(current_app.config['TIMELINE_CACHE_BYTES'])
+
+    def get(self, user_id, version, head): # pylint: disable=no-self-use
+        """the user's cached entry if it is still current, else None"""
+        cache = current_app.extensions['timeline_cache']
+        with cache.lock:
+            entry = cache.entries.get(user_id)
+            if entry is not None and (entry.version, entry.head) != (version, head):
+                _drop(cache, user_id)
+                entry = None
+            if entry is None:
+                cache.misses += 1
+                return None
+            cache.entries.move_to_end(user_id)
+            cache.hits += 1
+            return entry
+
+    def admit(self, user_id): # pylint: disable=no-self-use
+        """whether a miss for this user should fill the cache"""
+        cache = current_app.extensions['timeline_cache']
+        with cache.lock:
+            if user_id in cache.seen_once:
+                cache.seen_once.discard(user_id)
+                return True
+            if len(cache.seen_once) >= 10000:
+                cache.seen_once.clear()
+            cache.seen_once.add(user_id)
+            return False
+
+    def put(self, user_id, version, ids, complete): # pylint: disable=no-self-use
+        cache = current_app.extensions['timeline_cache']
+        entry = _Entry(array('q', ids), version, complete)
+        with cache.lock:
+            _drop(cache, user_id)
+            cache.entries[user_id] = entry
+            cache.bytes += entry.size
+            _evict(cache)
+        return entry
+
+    def cached_users(self): # pylint: disable=no-self-use
+        cache = current_app.extensions['timeline_cache']
+        with cache.lock:
+            return list(cache.entries)
+
+    def prepend(self, user_ids, post_id): # pylint: disable=no-self-use
+        """put a just committed post on top of these users' timelines"""
+        cache = current_app.extensions['timeline_cache']
+        depth = current_app.config['TIMELINE_CACHE_DEPTH']
+        with cache.lock:
+            for user_id in user_ids:
+                entry = cache.entries.get(user_id)
+                if entry is None or post_id in entry.ids[:1]:
+                    continue
+                cache.bytes -= entry.size
+                entry.ids.insert(0, post_id)
+                if len(entry.ids) > depth:
+                    entry.ids.pop()
+                    entry.complete = False
+                cache.bytes += entry.size
+            _evict(cache)
+
+    def stats(self): # pylint: disable=no-self-use
+        cache = current_app.extensions['timeline_cache']
+        with cache.lock:
+            users = len(cache.entries)
+            lookups = cache.hits + cache.misses
+            return {
+                'users': users,
+                'bytes': cache.bytes,
+                'bytes_per_user': cache.bytes / users if users else 0.0,
+                'hits': cache.hits,
+                'misses': cache.misses,
+                'hit_ratio': cache.hits / lookups if lookups else 0.0,
+            }
+
+def _drop(cache, user_id):
+    entry = cache.entries.pop(user_id, None)
+    if entry is not None:
+        cache.bytes -= entry.size
+
+def _evict(cache):
+    budget = current_app.config['TIMELINE_CACHE_BYTES']
+    while cache.bytes > budget and cache.entries:
+        _, entry = cache.entries.popitem(last=False)
+        cache.bytes -= entry.size
+
+def page_ids(entry, per_page, after=None, before=None):
+    """(ids, has_next, has_prev) for a keyset page, None if not cached
+
+    `after` and `before` are the post ids in the decoded cursors.
+    """
+    ids = entry.ids
+    if before is not None:
+        try:
+            end = ids.index(before)
+        except ValueError:
+            return None
+        start = max(end - per_page, 0)
+        return ids[start:end].tolist(), end > 0, start > 0
+    start = 0
+    if after is not None:
+        try:
+            start = ids.index(after) + 1
+        except ValueError:
+            return None
+    page = ids[start:start + per_page + 1]
+    if len(page) <= per_page and not entry.complete:
+        return None # runs past what we hold
+    return page[:per_page].tolist(), len(page) > per_page, after is not None
@@ -0,0 +1,157 @@
+"""time-decayed ranking of recent posts for explore's trending mode
+
+Each ranked post carries an engagement weight that halves every
+TRENDING_HALF_LIFE seconds. A post enters with 1 + ln(1 + its author's
+followers), and every new follow adds TRENDING_FOLLOW_WEIGHT to the
+author's ranked posts, so the table is kept up to date as posts and follows
+are flushed, in the same transaction.
+
+Scores are stored as ln(weight) + t / tau, the weight scaled forward to the
+time t it was added ("forward decay", tau = half-life / ln 2). Every post
+decays at the same rate, so the order of the stored scores is the order of
+the decayed weights at any later time: nothing is rewritten as the clock
+moves, the top N is one backwards range scan of the score index, and
+adding engagement is a logaddexp. The weight a score is worth at `now` is
+exp(score - now / tau). `flask trending decay`, run every few minutes,
+drops posts whose weight decayed under TRENDING_MIN_WEIGHT and keeps the
+table to TRENDING_SIZE rows.
+"""
+from datetime import datetime, timedelta
+import math
+
+from flask import current_app
+
+from app import db
+
+# start of the time scale scores are measured on; keeps the numbers small
+EPOCH = datetime(2020, 1, 1)
+
+ranking = db.Table(
+    'trending',
+    db.Column('post_id', db.Integer, db.ForeignKey('post.id'), primary_key=True),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), index=True),
+    db.Column('score', db.Float),
+    db.Index('ix_trending_score_post_id', 'score', 'post_id'),
+)
+
+# lightweight handles on the tables this module reads, so it needn't import models
+_post = db.table('post', db.column('id'), db.column('user_id'),
+                 db.column('timestamp', db.DateTime))
+_user = db.table('user', db.column('id'), db.column('followers_count'))
+
+def _logaddexp(a, b):
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+class TrendingRanking(object):
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app): # pylint: disable=no-self-use
+        app.config.setdefault('TRENDING_HALF_LIFE', 6 * 60 * 60)
+        app.config.setdefault('TRENDING_FOLLOW_WEIGHT', 1.0)
+        app.config.setdefault('TRENDING_MIN_WEIGHT', .05)
+        app.config.setdefault('TRENDING_SIZE', 1000)
+        app.config.setdefault('TRENDING_TOP', 30)
+
+    def score(self, weight, when): # pylint: disable=no-self-use
+        """the stored score for `weight` added at datetime `when`"""
+        tau = current_app.config['TRENDING_HALF_LIFE'] / math.log(2)
+        return math.log(weight) + (when - EPOCH).total_seconds() / tau
+
+    def weight(self, score, now=None): # pylint: disable=no-self-use
+        """what a stored score is worth at `now`"""
+        tau = current_app.config['TRENDING_HALF_LIFE'] / math.log(2)
+        seconds = ((now or datetime.utcnow()) - EPOCH).total_seconds()
+        return math.exp(score - seconds / tau)
+
+    def rank(self, session, posts):
+        """add (post_id, user_id, timestamp) new posts to the ranking"""
+        if not posts:
+            return
+        followers = dict(session.execute(
+            db.select([_user.c.id, _user.c.followers_count]).where(
+                _user.c.id.in_({user_id for _, user_id, _ in posts})
+            )
+        ).fetchall())
+        session.execute(ranking.insert(), [{
+            'post_id': post_id,
+            'user_id': user_id,
+            'score': self.score(1 + math.log1p(followers.get(user_id) or 0), timestamp),
+        } for post_id, user_id, timestamp in posts])
+
+    def forget(self, session, post_ids): # pylint: disable=no-self-use
+        if post_ids:
+            session.execute(ranking.delete().where(ranking.c.post_id.in_(post_ids)))
+
+    def engage(self, session, author_id, weight=None, now=None):
+        """add engagement to every ranked post by `author_id`"""
+        added = self.score(
+            weight or current_app.config['TRENDING_FOLLOW_WEIGHT'],
+            now or datetime.utcnow()
+        )
+        rows = session.execute(
+            db.select([ranking.c.post_id, ranking.c.score]).where(
+                ranking.c.user_id == author_id
+            )
+        ).fetchall()
+        if rows:
+            session.execute(
+                ranking.update().where(ranking.c.post_id == db.bindparam('_post_id')),
+                [{'_post_id': post_id, 'score': _logaddexp(score, added)}
+                 for post_id, score in rows]
+            )
+
+    def top(self, limit=None): # pylint: disable=no-self-use
+        """ids of the highest ranked posts, best first"""
+        return [post_id for post_id, in db.session.execute(
+            db.select([ranking.c.post_id]).order_by(
+                ranking.c.score.desc(), ranking.c.post_id.desc()
+            ).limit(limit or current_app.config['TRENDING_TOP'])
+        )]
+
+    def decay(self, now=None):
+        """drop posts that decayed away and any past TRENDING_SIZE"""
+        config = current_app.config
+        cutoff = self.score(config['TRENDING_MIN_WEIGHT'], now or datetime.utcnow())
+        removed = db.session.execute(
+            ranking.delete().where(ranking.c.score < cutoff)
+        ).rowcount
+        first_dropped = db.session.execute(
+            db.select([ranking.c.score, ranking.c.post_id]).order_by(
+                ranking.c.score.desc(), ranking.c.post_id.desc()
+            ).offset(config['TRENDING_SIZE']).limit(1)
+        ).first()
+        if first_dropped is not None:
+            score, post_id = first_dropped
+            removed += db.session.execute(ranking.delete().where(db.or_(
+                ranking.c.score < score,
+                db.and_(ranking.c.score == score, ranking.c.post_id <= post_id)
+            ))).rowcount
+        db.session.commit()
+        return removed
+
+    def rebuild(self, now=None):
+        """rank recent posts from scratch; past follows can't be replayed"""
+        config = current_app.config
+        now = now or datetime.utcnow()
+        db.session.execute(ranking.delete())
+        # nothing older than this can still weigh TRENDING_MIN_WEIGHT
+        most_followed = db.session.execute(
+            db.select([db.func.max(_user.c.followers_count)])
+        ).scalar() or 0
+        best = 1 + math.log1p(most_followed)
+        window = config['TRENDING_HALF_LIFE'] * math.log2(
+            max(best / config['TRENDING_MIN_WEIGHT'], 1)
+        )
+        since = now - timedelta(seconds=window)
+        posts = db.session.execute(
+            db.select([_post.c.id, _post.c.user_id, _post.c.timestamp]).where(
+                _post.c.timestamp >= since
+            )
+        ).fetchall()
+        self.rank(db.session, posts)
+        db.session.commit()
+        self.decay(now)
+        return db.session.execute(db.select([db.func.count()]).select_from(ranking)).scalar()
@@ -0,0 +1,69 @@
+"""load generation and benchmarks for microblog
+
+    python -m benchmarks.datagen --users 100000    # fill the database
+    python -m benchmarks.harness -o results.json   # measure the routes
+
+Both use BenchConfig, which points at bench.db next to this package unless
+BENCH_DATABASE_URL is set, so benchmark data never lands in app.db.
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+from datetime import datetime
+
+from config import Config, basedir
+
+# every generated user logs in with this
+PASSWORD = 'bench'
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = os.environ.get('BENCH_DATABASE_URL') or \
+        'sqlite:///' + os.path.join(basedir, 'bench.db')
+    ELASTICSEARCH_URL = os.environ.get('BENCH_ELASTICSEARCH_URL')
+    WTF_CSRF_ENABLED = False
+    SEARCH_QUEUE_WORKER = False
+    POSTS_PER_PAGE = 25
+
+def percentile(ordered, fraction):
+    """nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    rank = max(math.ceil(fraction * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def summarize(latencies, elapsed, errors=0):
+    """latency percentiles in ms and throughput for one scenario"""
+    ordered = sorted(latencies)
+    ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'mean_ms': ms(sum(ordered) / len(ordered)) if ordered else None,
+        'p50_ms': ms(percentile(ordered, .50)),
+        'p95_ms': ms(percentile(ordered, .95)),
+        'p99_ms': ms(percentile(ordered, .99)),
+        'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed else None,
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path, results):
+    """save results along with where and on what commit they were taken"""
+    results = dict(results, meta={
+        'commit': git_commit(),
+        'taken_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+    })
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    return results
@@ -0,0 +1,130 @@
+"""bulk insert synthetic users, posts and a power-law follow graph
+
+    python -m benchmarks.datagen --users 1000000 --posts-per-user 20
+
+Follow targets are drawn from a zipf distribution so a few users have
+most of the followers, and posts and follows per user are pareto
+distributed, which is roughly what real social graphs look like. Rows are
+written with executemany in batches, after which timelines, counters and
+the trending ranking are rebuilt in bulk, and who to follow suggestions
+computed.
+"""
+import argparse
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from itertools import accumulate
+import random
+from time import monotonic
+
+from werkzeug.security import generate_password_hash
+
+from app import create_app, db, suggestions, trending
+from app.models import Post, User, follows
+from benchmarks import PASSWORD, BenchConfig
+
+WORDS = (
+    'the a of and to in is it you that he was for on are with as i his they '
+    'be at one have this from or had by hot word but what some we can out '
+    'other were all there when up use your how said an each she which do '
+    'their time if will way about many then them write would like so these '
+    'cat dog coffee rain code bug deploy sqlite python flask #python #flask '
+    '#coffee #monday #music #travel #news #sqlite'
+).split()
+
+def _heavy_tailed(rng, mean, cap):
+    """pareto(1.5) sample scaled to `mean`; pareto(1.5) itself averages 3"""
+    return min(int(rng.paretovariate(1.5) * mean / 3), cap)
+
+def _insert(table, rows, batch_size):
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[i:i + batch_size])
+    db.session.commit()
+
+def generate(users, posts_per_user=20, follows_per_user=30, alpha=1.1,
+             days=90, seed=0, batch_size=10000, progress=print):
+    """add `users` users with their posts and follows to the database"""
+    rng = random.Random(seed)
+    first_id = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    ids = list(range(first_id, first_id + users))
+    started = monotonic()
+
+    pw_hash = generate_password_hash(PASSWORD)
+    now = datetime.utcnow()
+    _insert(User.__table__, [{
+        'id': _id,
+        'username': 'user{}'.format(_id),
+        'email': 'user{}@example.com'.format(_id),
+        'pw_hash': pw_hash,
+        'last_seen': now,
+    } for _id in ids], batch_size)
+    progress('{} users'.format(users))
+
+    posts = 0
+    rows = []
+    for _id in ids:
+        for _ in range(_heavy_tailed(rng, posts_per_user, posts_per_user * 50)):
+            rows.append({
+                'user_id': _id,
+                'body': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))[:140],
+                'timestamp': now - timedelta(seconds=rng.uniform(0, days * 86400)),
+            })
+        if len(rows) >= batch_size:
+            _insert(Post.__table__, rows, batch_size)
+            posts += len(rows)
+            rows = []
+    _insert(Post.__table__, rows, batch_size)
+    posts += len(rows)
+    progress('{} posts'.format(posts))
+
+    # zipf popularity over a shuffled ranking of users
+    ranked = ids[:]
+    rng.shuffle(ranked)
+    cum_weights = list(accumulate(1 / rank ** alpha for rank in range(1, users + 1)))
+    total_weight = cum_weights[-1]
+    edges = 0
+    rows = []
+    for _id in ids:
+        wanted = min(_heavy_tailed(rng, follows_per_user, users // 2), users - 1)
+        followed = set()
+        while len(followed) < wanted:
+            target = ranked[bisect_left(cum_weights, rng.random() * total_weight)]
+            if target != _id:
+                followed.add(target)
+        rows.extend({'follower_id': _id, 'followed_id': f} for f in followed)
+        if len(rows) >= batch_size:
+            _insert(follows, rows, batch_size)
+            edges += len(rows)
+            rows = []
+    _insert(follows, rows, batch_size)
+    edges += len(rows)
+    progress('{} follows'.format(edges))
+
+    User.rebuild_timelines()
+    User.reconcile_counters()
+    trending.rebuild()
+    progress('timelines, counters and trending rebuilt in {:.1f}s total'.format(
+        monotonic() - started
+    ))
+    suggestions.build()
+    progress('suggestions built in {:.1f}s total'.format(monotonic() - started))
+    return {'users': users, 'posts': posts, 'follows': edges}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--posts-per-user', type=int, default=20)
+    parser.add_argument('--follows-per-user', type=int, default=30)
+    parser.add_argument('--alpha', type=float, default=1.1,
+                        help='zipf exponent of follower popularity')
+    parser.add_argument('--days', type=int, default=90,
+                        help='spread post timestamps over this many days')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    app = create_app(BenchConfig)
+    with app.app_context():
+        db.create_all()
+        generate(args.users, args.posts_per_user, args.follows_per_user,
+                 args.alpha, args.days, args.seed)
+
+if __name__ == '__main__':
+    main()
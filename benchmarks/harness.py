@@ -0,0 +1,200 @@
+"""drive the main routes and report latency percentiles and throughput
+
+    python -m benchmarks.harness --requests 500 --concurrency 4 -o now.json
+    python -m benchmarks.harness --server --compare before.json
+
+Each scenario runs `requests` times split across `concurrency` logged-in
+clients, either the flask test client (default) or HTTP against a local
+threaded WSGI server. Results are written as JSON for comparing commits.
+"""
+import argparse
+from http.cookiejar import CookieJar
+import json
+import random
+import threading
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, \
+    Request, build_opener
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import create_app, db
+from app.models import User
+from benchmarks import PASSWORD, BenchConfig, summarize, write_results
+from benchmarks.datagen import WORDS
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+class _NoRedirect(HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HTTPClient(object):
+    """just enough of the test client interface, over real HTTP"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), _NoRedirect)
+
+    def open(self, path, method='GET', data=None):
+        body = urlencode(data).encode() if data is not None else None
+        request = Request(self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+class TestClient(object):
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def open(self, path, method='GET', data=None):
+        return self.client.open(path, method=method, data=data).status_code
+
+def _login(client, username):
+    return client.open('/auth/login', 'POST',
+                       {'username': username, 'password': PASSWORD})
+
+def _follow(client, rng, usernames):
+    target = rng.choice(usernames)
+    status = client.open('/follow/' + target, 'POST', {})
+    client.open('/unfollow/' + target, 'POST', {}) # undo, unmeasured
+    return status
+
+def _unfollow(client, rng, usernames):
+    target = rng.choice(usernames)
+    client.open('/follow/' + target, 'POST', {}) # set up, unmeasured
+    return client.open('/unfollow/' + target, 'POST', {})
+
+SCENARIOS = {
+    'index': lambda client, rng, usernames: client.open('/index'),
+    'explore': lambda client, rng, usernames: client.open('/explore'),
+    'trending': lambda client, rng, usernames: client.open('/explore?mode=trending'),
+    'user': lambda client, rng, usernames:
+            client.open('/user/' + rng.choice(usernames)),
+    'search': lambda client, rng, usernames:
+              client.open('/search?q=' + rng.choice(WORDS).lstrip('#')),
+    'post': lambda client, rng, usernames: client.open(
+        '/index', 'POST', {'post': ' '.join(rng.choice(WORDS) for _ in range(8))}
+    ),
+    'follow': _follow,
+    'unfollow': _unfollow,
+}
+
+def _run_scenario(name, clients, usernames, requests, seed):
+    """run one scenario on every client at once, returns its summary"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(index, client, count):
+        rng = random.Random(seed + index)
+        mine = []
+        failed = 0
+        for _ in range(count):
+            started = perf_counter()
+            try:
+                if name == 'login':
+                    client.open('/auth/logout')
+                    started = perf_counter()
+                    status = _login(client, rng.choice(usernames))
+                else:
+                    status = SCENARIOS[name](client, rng, usernames)
+            except Exception: # pylint: disable=broad-except
+                status = 599
+            mine.append(perf_counter() - started)
+            if status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    share = [requests // len(clients) + (i < requests % len(clients))
+             for i in range(len(clients))]
+    threads = [threading.Thread(target=worker, args=(i, c, n))
+               for i, (c, n) in enumerate(zip(clients, share))]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, perf_counter() - started, errors[0])
+
+def run(app, scenarios=None, requests=200, concurrency=1, server=False,
+        seed=0, progress=print):
+    """benchmark `scenarios` (default: all, plus login) against `app`"""
+    scenarios = scenarios or list(SCENARIOS) + ['login']
+    with app.app_context():
+        usernames = [u for u, in db.session.query(User.username).order_by(
+            db.func.random()
+        ).limit(1000)]
+    if not usernames:
+        raise SystemExit('no users, run benchmarks.datagen first')
+    httpd = None
+    if server:
+        httpd = make_server('127.0.0.1', 0, app, threaded=True,
+                            request_handler=_QuietHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        base_url = 'http://127.0.0.1:{}'.format(httpd.server_port)
+        clients = [HTTPClient(base_url) for _ in range(concurrency)]
+    else:
+        clients = [TestClient(app) for _ in range(concurrency)]
+    try:
+        for i, client in enumerate(clients):
+            _login(client, usernames[i % len(usernames)])
+        results = {}
+        for name in scenarios:
+            results[name] = _run_scenario(name, clients, usernames, requests, seed)
+            progress('{:10} p50 {p50_ms:8.2f}ms  p95 {p95_ms:8.2f}ms  '
+                     'p99 {p99_ms:8.2f}ms  {throughput_rps:8.1f} req/s  '
+                     '{errors} errors'.format(name, **results[name]))
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+    return {
+        'mode': 'server' if server else 'test_client',
+        'concurrency': concurrency,
+        'scenarios': results,
+    }
+
+def compare(before, after, progress=print):
+    """print the change in p95 latency and throughput per scenario"""
+    for name, now in sorted(after['scenarios'].items()):
+        then = before['scenarios'].get(name)
+        if not then or not then['p95_ms'] or not then['throughput_rps']:
+            continue
+        progress('{:10} p95 {:+7.1f}%  throughput {:+7.1f}%'.format(
+            name,
+            100 * (now['p95_ms'] - then['p95_ms']) / then['p95_ms'],
+            100 * (now['throughput_rps'] - then['throughput_rps']) /
+            then['throughput_rps'],
+        ))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*',
+                        help='default: ' + ' '.join(list(SCENARIOS) + ['login']))
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('-c', '--concurrency', type=int, default=1)
+    parser.add_argument('--server', action='store_true',
+                        help='go through a local WSGI server instead of the test client')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    args = parser.parse_args()
+    results = run(create_app(BenchConfig), args.scenarios, args.requests,
+                  args.concurrency, args.server, args.seed)
+    if args.output:
+        results = write_results(args.output, results)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""logins per second with inline hashing vs the hashing process pool
+
+    python -m benchmarks.logins --requests 200 --concurrency 8 -o logins.json
+
+Runs the harness login scenario over HTTP once per PASSWORD_HASH_WORKERS
+setting (0 hashes inline in the request thread). Needs benchmarks.datagen.
+"""
+import argparse
+
+from app import create_app, hasher
+from benchmarks import BenchConfig, write_results
+from benchmarks.harness import run
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--requests', type=int, default=200)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='PASSWORD_HASH_WORKERS values to compare')
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    args = parser.parse_args()
+    results = {}
+    for workers in args.workers:
+        app = create_app(BenchConfig)
+        app.config['PASSWORD_HASH_WORKERS'] = workers
+        # room for every client, so this measures throughput, not shedding
+        app.config['PASSWORD_HASH_QUEUE'] = args.concurrency
+        print('PASSWORD_HASH_WORKERS={}'.format(workers))
+        results['workers_{}'.format(workers)] = run(
+            app, ['login'], args.requests, args.concurrency, server=True
+        )['scenarios']['login']
+        with app.app_context():
+            hasher.shutdown()
+    if args.output:
+        write_results(args.output, {'concurrency': args.concurrency,
+                                    'scenarios': results})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""bytes sent per page view, without and with compression and built assets
+
+    flask assets vendor && flask assets build   # for the scripts to count
+    python -m benchmarks.pagebytes --views 20 -o pagebytes.json
+
+Logs in as a generated user and visits the main pages the way a browser
+would: each view costs its HTML plus any same-origin script not already in
+the browser cache (scripts are cached while their Cache-Control max-age
+lasts). "before" turns response compression off, sends no Accept-Encoding
+and ignores the asset manifest; "after" is the current configuration with a
+browser's Accept-Encoding. Scripts still loaded from a CDN are counted, not
+measured. Needs benchmarks.datagen.
+"""
+import argparse
+import gzip
+import itertools
+import re
+
+from app import create_app
+from app.compression import brotli
+from app.models import User
+from benchmarks import PASSWORD, BenchConfig, write_results
+
+ACCEPT_ENCODING = 'gzip, deflate, br'
+
+def _scripts(html):
+    return re.findall(r'<script src="([^"]+)"', html)
+
+def measure(compressed, views):
+    """mean bytes per view over `views` page views in one browser session"""
+
+    class ModeConfig(BenchConfig):
+        COMPRESS_RESPONSES = compressed
+
+    app = create_app(ModeConfig)
+    if not compressed:
+        app.extensions['assets'] = {}
+    headers = {'Accept-Encoding': ACCEPT_ENCODING} if compressed else {}
+    with app.app_context():
+        usernames = [u.username for u in User.query.order_by(User.id).limit(5)]
+    if not usernames:
+        raise SystemExit('no users, run benchmarks.datagen first')
+    client = app.test_client()
+    client.post('/auth/login', data={'username': usernames[0], 'password': PASSWORD})
+    pages = itertools.cycle(['/index', '/explore'] +
+                            ['/user/' + name for name in usernames])
+    cache = set()
+    html_bytes = script_bytes = 0
+    external = set()
+    for _ in range(views):
+        response = client.get(next(pages), headers=headers)
+        html_bytes += len(response.data)
+        html = _decoded(response)
+        for src in _scripts(html):
+            if src.startswith('//') or '://' in src:
+                external.add(src)
+                continue
+            if src in cache:
+                continue
+            script = client.get(src, headers=headers)
+            script_bytes += len(script.data)
+            if script.cache_control.max_age:
+                cache.add(src)
+    return {
+        'views': views,
+        'html_bytes_per_view': round(html_bytes / views),
+        'script_bytes_per_view': round(script_bytes / views),
+        'bytes_per_view': round((html_bytes + script_bytes) / views),
+        'cdn_scripts': sorted(external),
+    }
+
+def _decoded(response):
+    encoding = response.headers.get('Content-Encoding')
+    data = response.data
+    if encoding == 'gzip':
+        data = gzip.decompress(data)
+    elif encoding == 'br':
+        data = brotli.decompress(data)
+    return data.decode('utf-8')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--views', type=int, default=20)
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    args = parser.parse_args()
+    results = {}
+    for name, compressed in (('before', False), ('after', True)):
+        results[name] = measure(compressed, args.views)
+        print('{:6}  {bytes_per_view:8} bytes per view  ({html_bytes_per_view} html, '
+              '{script_bytes_per_view} scripts, {cdn} scripts from a cdn)'.format(
+                  name, cdn=len(results[name]['cdn_scripts']), **results[name]))
+    if args.output:
+        write_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""write throughput with default sqlite settings vs SQLITE_PRODUCTION
+
+    python -m benchmarks.sqlite --requests 400 --concurrency 8 -o sqlite.json
+
+Runs write heavy harness scenarios over HTTP with last_seen written through
+on every request, first with sqlite's defaults and then in production mode
+(WAL, pragmas and a single writer connection, see app/sqlite.py). Errors
+under the defaults are "database is locked". Needs benchmarks.datagen and a
+sqlite BENCH_DATABASE_URL.
+"""
+import argparse
+import sqlite3
+
+from sqlalchemy.engine.url import make_url
+
+from app import create_app
+from benchmarks import BenchConfig, write_results
+from benchmarks.harness import compare, run
+
+SCENARIOS = ['post', 'follow', 'index']
+
+def _rollback_journal(uri):
+    """WAL sticks to the file, put it back so the baseline is the default"""
+    conn = sqlite3.connect(make_url(uri).database)
+    try:
+        conn.execute('PRAGMA journal_mode=delete')
+    finally:
+        conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('scenarios', nargs='*', help='default: ' + ' '.join(SCENARIOS))
+    parser.add_argument('-n', '--requests', type=int, default=400)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    args = parser.parse_args()
+    if not BenchConfig.SQLALCHEMY_DATABASE_URI.startswith('sqlite:///'):
+        raise SystemExit('this benchmark needs a sqlite file database')
+    results = {}
+    for production in (False, True):
+        if not production:
+            _rollback_journal(BenchConfig.SQLALCHEMY_DATABASE_URI)
+
+        class ModeConfig(BenchConfig):
+            SQLITE_PRODUCTION = production
+            LAST_SEEN_FLUSH_INTERVAL = 0
+
+        app = create_app(ModeConfig)
+        print('SQLITE_PRODUCTION={}'.format(production))
+        results['production' if production else 'default'] = run(
+            app, args.scenarios or SCENARIOS, args.requests, args.concurrency,
+            server=True
+        )
+    compare(results['default'], results['production'])
+    if args.output:
+        write_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""how long a fresh process takes to import microblog.py and serve a request
+
+    python -m benchmarks.startup --runs 10 -o startup.json
+
+Each run starts a new interpreter that imports microblog.py and sends one
+request through the test client, timing both, and notes which of the
+libraries create_app defers had been imported by then. Medians and worst
+runs are reported. Warm the template cache first (`flask templates
+compile`) to measure what a deployed worker sees.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+from benchmarks import percentile, write_results
+from config import basedir
+
+# libraries create_app leaves for whoever first needs them
+DEFERRED = ('alembic', 'elasticsearch', 'flask_moment')
+
+PROBE = '''
+import json, sys
+from time import perf_counter
+started = perf_counter()
+import microblog
+imported = perf_counter()
+loaded = sorted(name for name in {deferred!r} if name in sys.modules)
+status = microblog.app.test_client().get({path!r}).status_code
+print(json.dumps({{
+    'import_seconds': imported - started,
+    'first_request_seconds': perf_counter() - imported,
+    'status': status,
+    'imported_early': loaded,
+}}))
+'''
+
+def probe(path='/auth/login'):
+    """one cold start in a new interpreter"""
+    started = perf_counter()
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(deferred=DEFERRED, path=path)],
+        cwd=basedir, env=dict(os.environ, FLASK_APP='microblog.py')
+    )
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    result['process_seconds'] = perf_counter() - started
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', default='/auth/login', help='first request')
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    args = parser.parse_args()
+    runs = [probe(args.path) for _ in range(args.runs)]
+    summary = {}
+    for key in ('import_seconds', 'first_request_seconds', 'process_seconds'):
+        ordered = sorted(run[key] for run in runs)
+        summary[key] = {'p50_ms': round(percentile(ordered, .5) * 1000, 1),
+                        'max_ms': round(ordered[-1] * 1000, 1)}
+        print('{:22} p50 {p50_ms:8.1f}ms  max {max_ms:8.1f}ms'.format(key, **summary[key]))
+    early = sorted({name for run in runs for name in run['imported_early']})
+    print('imported at startup: ' + (', '.join(early) or 'none of ' + ', '.join(DEFERRED)))
+    if args.output:
+        write_results(args.output, {'summary': summary, 'runs': runs})
+
+if __name__ == '__main__':
+    main()
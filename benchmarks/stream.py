@@ -0,0 +1,127 @@
+"""how the post stream scales with idle connections
+
+    python -m benchmarks.stream --connections 1000 5000 10000 -o stream.json
+
+For each step, opens that many explore streams against a local stream
+server, then publishes posts and times how long each one takes to reach
+every client. Reports threads, memory per connection (client sockets
+included, so an upper bound) and delivery latency. Needs benchmarks.datagen
+for a user to connect as.
+"""
+import argparse
+import asyncio
+import resource
+import threading
+from time import perf_counter
+
+from app import create_app, db, post_stream
+from app.models import User
+from benchmarks import BenchConfig, percentile, write_results
+
+_published = [0] # fake post ids handed out so far, the broker drops repeats
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def _client(port, cookie, deliveries, ready):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write('GET /stream?scope=explore HTTP/1.1\r\nHost: localhost\r\n'
+                 'Cookie: session={}\r\n\r\n'.format(cookie).encode('latin-1'))
+    await reader.readuntil(b'retry: ')
+    await reader.readuntil(b'\n\n')
+    ready()
+    try:
+        while True:
+            event = await reader.readuntil(b'\n\n')
+            if event.startswith(b'id: '):
+                deliveries.append((int(event.split(b'\n')[0][4:]), perf_counter()))
+    finally:
+        writer.close()
+
+async def _step(server, cookie, connections, posts):
+    deliveries = []
+    ready = asyncio.Event()
+    connected = [0]
+
+    def one_ready():
+        connected[0] += 1
+        if connected[0] == connections:
+            ready.set()
+
+    started = perf_counter()
+    clients = [asyncio.ensure_future(_client(server.port, cookie, deliveries, one_ready))
+               for _ in range(connections)]
+    await ready.wait()
+    connect_time = perf_counter() - started
+    while server.connections < connections:
+        await asyncio.sleep(.01)
+    threads, rss = threading.active_count(), _rss()
+
+    latencies = []
+    for _ in range(posts):
+        deliveries.clear()
+        _published[0] += 1
+        post_id = -_published[0] # never collides with real posts
+        sent = perf_counter()
+        server.publish(post_id, 0)
+        while len(deliveries) < connections:
+            await asyncio.sleep(.001)
+        latencies.append(max(at for _, at in deliveries) - sent)
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    latencies.sort()
+    return {
+        'connections': connections,
+        'connect_seconds': round(connect_time, 3),
+        'threads': threads,
+        'rss_bytes': rss,
+        'fanout_p50_ms': round(percentile(latencies, .5) * 1000, 3),
+        'fanout_p99_ms': round(percentile(latencies, .99) * 1000, 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, nargs='+',
+                        default=[100, 1000, 5000])
+    parser.add_argument('--posts', type=int, default=20)
+    parser.add_argument('-o', '--output', help='write results to this JSON file')
+    args = parser.parse_args()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = 2 * max(args.connections) + 100
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    app = create_app(BenchConfig)
+    app.config.update(STREAM_PORT=0, STREAM_HOST='127.0.0.1')
+    with app.app_context():
+        user = User.query.first()
+        if user is None:
+            raise SystemExit('no users, run benchmarks.datagen first')
+        cookie = app.session_interface.get_signing_serializer(app).dumps(
+            {'_user_id': str(user.id)}
+        )
+        db.session.remove()
+        server = post_stream.start()
+    baseline = {'threads': threading.active_count(), 'rss_bytes': _rss()}
+    steps = []
+    for connections in args.connections:
+        result = asyncio.run(_step(server, cookie, connections, args.posts))
+        result['bytes_per_connection'] = round(
+            (result['rss_bytes'] - baseline['rss_bytes']) / connections
+        )
+        steps.append(result)
+        print('{connections:6} connections  {threads} threads  '
+              '{bytes_per_connection:6} bytes each  connect {connect_seconds:6.2f}s  '
+              'fan-out p50 {fanout_p50_ms:8.2f}ms  p99 {fanout_p99_ms:8.2f}ms'
+              .format(**result))
+    server.stop()
+    if args.output:
+        write_results(args.output, {'baseline': baseline, 'steps': steps})
+
+if __name__ == '__main__':
+    main()
@@ -10,5 +10,63 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # space separated read replica urls for @read_replica views
+    SQLALCHEMY_REPLICA_URIS = (os.environ.get('DATABASE_REPLICA_URLS') or '').split()
+    # seconds a client reads from the primary after writing
+    REPLICA_READ_AFTER_WRITE = 5
+    # WAL, pragmas and a single writer connection for a sqlite file database,
+    # see app/sqlite.py
+    SQLITE_PRODUCTION = os.environ.get('SQLITE_PRODUCTION') == '1'
     POSTS_PER_PAGE = 3
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    # 'elasticsearch' or 'sqlite'; by default elasticsearch when
+    # ELASTICSEARCH_URL is set, otherwise fts5 when the database is sqlite
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    # drain the search outbox from a thread in each web process; turn off when
+    # running `flask search drain` as a dedicated worker instead
+    SEARCH_QUEUE_WORKER = os.environ.get('SEARCH_QUEUE_WORKER', '1') == '1'
+    SEARCH_QUEUE_BATCH_SIZE = 500
+    # seconds a page of search hits may be reused, 0 turns the cache off
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 60)
+    # password hashing runs on its own process pool, see app/hashing.py
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:150000'
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 16)
+    # serve per-endpoint timing histograms for prometheus at /metrics
+    METRICS_ENDPOINT = os.environ.get('METRICS_ENDPOINT') == '1'
+    SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD') or 1.0)
+    # flask-login user_loader cache; a shared sqlite file is optional
+    IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL') or 30)
+    IDENTITY_CACHE_PATH = os.environ.get('IDENTITY_CACHE_PATH')
+    # rendered _post.html fragments kept per process; optionally shared via
+    # FRAGMENT_CACHE_STORE, see app/fragments.py
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+    FRAGMENT_CACHE_STORE = os.environ.get('FRAGMENT_CACHE_STORE')
+    # memory for busy users' cached home timeline post ids, 0 turns it off
+    TIMELINE_CACHE_BYTES = int(os.environ.get('TIMELINE_CACHE_BYTES') or 16 * 1024 * 1024)
+    # trending posts lose half their weight every this many seconds, see
+    # app/trending.py; `flask trending decay` expires them
+    TRENDING_HALF_LIFE = int(os.environ.get('TRENDING_HALF_LIFE') or 6 * 60 * 60)
+    # processes `flask suggestions build` computes who to follow in, see
+    # app/suggestions.py; defaults to one per cpu
+    SUGGESTIONS_WORKERS = int(os.environ['SUGGESTIONS_WORKERS']) \
+        if os.environ.get('SUGGESTIONS_WORKERS') else None
+    # serve new post notifications on this port, see app/stream.py; set
+    # STREAM_URL when a proxy exposes it under the app's own host
+    STREAM_PORT = int(os.environ['STREAM_PORT']) if os.environ.get('STREAM_PORT') else None
+    STREAM_URL = os.environ.get('STREAM_URL')
+    # compiled templates are cached here across process starts; empty turns it off
+    JINJA_BYTECODE_CACHE = os.environ.get(
+        'JINJA_BYTECODE_CACHE', os.path.join(basedir, 'instance', 'jinja')
+    )
+    # gzip (or brotli, when installed) html and other text responses
+    COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', '1') == '1'
+    # where `flask assets build` puts fingerprinted files, see app/assets.py
+    ASSETS_DIST = os.environ.get('ASSETS_DIST') or os.path.join(basedir, 'app', 'static', 'dist')
+    # let pages load jquery and moment from their CDN while they haven't been
+    # vendored with `flask assets vendor`; set to 0 once they are, so a
+    # missing or tampered script fails rendering and builds loudly
+    ASSETS_CDN_FALLBACK = os.environ.get('ASSETS_CDN_FALLBACK', '1') == '1'
+    # max seconds a last_seen update may sit in memory before being written
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 60)
+    LAST_SEEN_FLUSH_SIZE = int(os.environ.get('LAST_SEEN_FLUSH_SIZE') or 500)
@@ -0,0 +1,59 @@
+"""follows primary key, reverse follows index & per-author post index
+
+Revision ID: 2a7c5e91b3d8
+Revises: 8d4f0b7e2a15
+Create Date: 2026-10-18 16:27:13.904410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2a7c5e91b3d8'
+down_revision = '8d4f0b7e2a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sqlite can't add a primary key in place, so copy the distinct rows into
+    # a new table; this also clears out any duplicate follows
+    op.create_table('follows_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute(
+        'INSERT INTO follows_new (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM follows '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL'
+    )
+    op.drop_table('follows')
+    op.rename_table('follows_new', 'follows')
+    op.create_index('ix_follows_followed_id_follower_id', 'follows', ['followed_id', 'follower_id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp', 'post', ['user_id', 'timestamp'], unique=False)
+    # timeline pages sort on (timestamp, post_id), so the index needs both
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestamp_post_id', 'timeline', ['user_id', 'timestamp', 'post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp_post_id', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline', ['user_id', 'timestamp'], unique=False)
+    op.drop_index('ix_post_user_id_timestamp', table_name='post')
+    op.drop_index('ix_follows_followed_id_follower_id', table_name='follows')
+    op.create_table('follows_old',
+    sa.Column('follower_id', sa.Integer(), nullable=True),
+    sa.Column('followed_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], )
+    )
+    op.execute(
+        'INSERT INTO follows_old (follower_id, followed_id) '
+        'SELECT follower_id, followed_id FROM follows'
+    )
+    op.drop_table('follows')
+    op.rename_table('follows_old', 'follows')
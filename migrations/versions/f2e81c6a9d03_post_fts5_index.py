@@ -0,0 +1,48 @@
+"""post fts5 index
+
+Revision ID: f2e81c6a9d03
+Revises: c93a40d1e6b2
+Create Date: 2026-10-18 13:41:09.772514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2e81c6a9d03'
+down_revision = 'c93a40d1e6b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute(
+        "CREATE VIRTUAL TABLE post_fts USING fts5(body, content='post', content_rowid='id')"
+    )
+    op.execute(
+        'CREATE TRIGGER post_fts_ai AFTER INSERT ON post BEGIN '
+        'INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END'
+    )
+    op.execute(
+        'CREATE TRIGGER post_fts_ad AFTER DELETE ON post BEGIN '
+        "INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); END"
+    )
+    op.execute(
+        'CREATE TRIGGER post_fts_au AFTER UPDATE OF body ON post BEGIN '
+        "INSERT INTO post_fts(post_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+        'INSERT INTO post_fts(rowid, body) VALUES (new.id, new.body); END'
+    )
+    # index the posts that are already there
+    op.execute("INSERT INTO post_fts(post_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TRIGGER IF EXISTS post_fts_au')
+    op.execute('DROP TRIGGER IF EXISTS post_fts_ad')
+    op.execute('DROP TRIGGER IF EXISTS post_fts_ai')
+    op.execute('DROP TABLE IF EXISTS post_fts')
@@ -2,16 +2,121 @@
 # pylint: disable=invalid-name
 
 from datetime import datetime, timedelta
+import gzip
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
 import unittest
 
-from app import create_app, db
-from app.models import User, Post
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.http import http_date
+
+from app import create_app, db, fragments, hasher, identity_cache, \
+    last_seen, post_stream, suggestions, tag_index, timeline_cache, trending
+from app.assets import build, integrity
+from app.models import User, Post, load_user
+from app.pagination import paginate_keyset
+from app.replicas import sync_replicas
+from app.search import ElasticsearchBackend, LazyElasticsearch, drain_outbox, \
+    outbox_lag
+from app.startup import compile_templates
+from app.tags import link_terms, terms
+from benchmarks import datagen, harness, percentile, startup
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    SEARCH_QUEUE_WORKER = False
+    WTF_CSRF_ENABLED = False
+    PASSWORD_HASH_WORKERS = 0
+    JINJA_BYTECODE_CACHE = None
+
+class QueryCounter(object):
+    """count the SQL statements run on the app's engine inside a with block"""
+    def __init__(self):
+        self.statements = []
+        self.parameters = []
+
+    def _record(self, conn, cursor, statement, parameters, *args): # pylint: disable=unused-argument
+        self.statements.append(statement)
+        self.parameters.append(parameters)
+
+    def __enter__(self):
+        db.event.listen(db.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc_info):
+        db.event.remove(db.engine, 'before_cursor_execute', self._record)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+class DictStore(object):
+    """shared fragment store stand-in"""
+    def __init__(self):
+        self.values = {}
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, ttl): # pylint: disable=unused-argument
+        self.values[key] = value
+
+class FakeIndices(object):
+    def __init__(self):
+        self.created = []
+        self.aliases = {}
+
+    def create(self, index, body):
+        self.created.append(index)
+
+    def put_settings(self, index, body):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def exists(self, index):
+        return index in self.created
+
+    def exists_alias(self, name):
+        return name in self.aliases
+
+    def get_alias(self, name):
+        return {self.aliases[name]: {}}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            if 'add' in action:
+                self.aliases[action['add']['alias']] = action['add']['index']
+
+class FakeElasticsearch(object):
+    """records bulk requests; documents listed in `failing` are rejected"""
+    def __init__(self):
+        self.requests = []
+        self.failing = set()
+        self.indices = FakeIndices()
+
+    def bulk(self, body):
+        self.requests.append(body)
+        items = []
+        lines = iter(body)
+        for action in lines:
+            op, meta = list(action.items())[0]
+            if op == 'index':
+                next(lines) # document source
+            status = 500 if meta['_id'] in self.failing else 200
+            items.append({op: {'_id': meta['_id'], 'status': status}})
+        return {'errors': any(
+            list(i.values())[0]['status'] >= 300 for i in items
+        ), 'items': items}
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -62,6 +167,31 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        p1 = Post(body='one', author=u2)
+        p2 = Post(body='two', author=u2)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual((u1.following_count, u1.followers_count), (1, 0))
+        self.assertEqual((u2.following_count, u2.followers_count), (0, 1))
+        self.assertEqual(u2.post_count, 2)
+
+        db.session.delete(p1)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.following_count, u2.followers_count), (0, 0))
+        self.assertEqual(u2.post_count, 1)
+
+        db.session.execute('UPDATE user SET post_count = 42, followers_count = 7')
+        User.reconcile_counters()
+        self.assertEqual((u1.post_count, u1.followers_count), (0, 0))
+        self.assertEqual((u2.post_count, u2.followers_count), (1, 0))
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -100,5 +230,1546 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # new posts land in the author's and followers' timelines
+        now = datetime.utcnow()
+        p1 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.assertEqual(u1.following_posts().all(), [p2, p1])
+        self.assertEqual(u2.following_posts().all(), [p1])
+
+        # unfollowing trims, rebuilding reproduces the same timelines
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.following_posts().all(), [p2])
+        u1.follow(u2)
+        db.session.commit()
+        User.rebuild_timelines()
+        self.assertEqual(u1.following_posts().all(), [p2, p1])
+        self.assertEqual(u2.following_posts().all(), [p1])
+
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(u1.following_posts().all(), [p2])
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.utcnow()
+        posts = [Post(body='post {}'.format(i), author=u,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                              reverse=True)
+
+        def page(after=None, before=None):
+            return paginate_keyset(Post.query, Post.timestamp, Post.id, 2,
+                                   after=after, before=before)
+
+        first = page()
+        self.assertEqual(first.items, newest_first[:2])
+        self.assertFalse(first.has_prev)
+        second = page(after=first.next_cursor)
+        self.assertEqual(second.items, newest_first[2:4])
+        last = page(after=second.next_cursor)
+        self.assertEqual(last.items, newest_first[4:])
+        self.assertFalse(last.has_next)
+        back = page(before=last.prev_cursor)
+        self.assertEqual(back.items, newest_first[2:4])
+        self.assertEqual(page(before=back.prev_cursor).items, newest_first[:2])
+        self.assertEqual(page(after='not-a-cursor').items, newest_first[:2])
+    def test_last_seen_buffer(self):
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        self.app.config['LAST_SEEN_FLUSH_SIZE'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        then = datetime(2020, 1, 1)
+        now = datetime(2020, 1, 2)
+
+        # buffered in memory until the size threshold is reached
+        last_seen.touch(u1.id, then)
+        last_seen.touch(u1.id, now)
+        db.session.expire_all()
+        self.assertNotEqual(u1.last_seen, now)
+        last_seen.touch(u2.id, then)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now)
+        self.assertEqual(u2.last_seen, then)
+
+        last_seen.touch(u2.id, now)
+        last_seen.flush()
+        db.session.expire_all()
+        self.assertEqual(u2.last_seen, now)
+
+class SQLiteSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_search_ranks_pages_and_tracks_writes(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='cat cat cat', author=u)
+        p3 = Post(body='a dog', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+
+        self.assertEqual(Post.search('cat', 1, 1), ([p2], 2))
+        self.assertEqual(Post.search('cat', 2, 1), ([p1], 2))
+        self.assertEqual(Post.search('cat', 3, 1), ([], 2))
+        self.assertEqual(Post.search('"dog OR', 1, 10), ([p3], 1))
+
+        p3.body = 'a cat'
+        db.session.delete(p2)
+        db.session.commit()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(set(posts), {p1, p3})
+        self.assertEqual(Post.search('dog', 1, 10)[1], 0)
+
+        Post.reindex()
+        self.assertEqual(Post.search('cat', 1, 10)[1], 2)
+
+    def test_results_are_cached_until_the_index_changes(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='a cat', author=u)
+        db.session.add_all([u, p1])
+        db.session.commit()
+        Post.search('cat', 1, 10)
+        with QueryCounter() as queries:
+            self.assertEqual(Post.search('cat', 1, 10), ([p1], 1))
+        # only the primary key fetch, the matches came from the cache
+        self.assertEqual(queries.count, 1)
+        self.assertNotIn('post_fts', queries.statements[0])
+
+        p2 = Post(body='cat cat', author=u)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(Post.search('cat', 1, 10), ([p2, p1], 2))
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(Post.search('cat', 1, 10), ([p1], 1))
+
+class PageQueryCase(unittest.TestCase):
+    """rendering a page of posts must not cost a query per post"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['POSTS_PER_PAGE'] = 10
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        me = User(username='john', email='john@example.com')
+        me.set_password('cat')
+        others = [User(username='user{}'.format(i),
+                       email='user{}@example.com'.format(i))
+                  for i in range(10)]
+        db.session.add_all([me] + others)
+        # mentions, of users and of nobody, mustn't cost a query per post either
+        db.session.add_all([Post(body='hello cat {} @user{} @nobody'.format(i, (i + 1) % 10),
+                                 author=u)
+                            for i, u in enumerate(others)])
+        db.session.commit()
+        for u in others:
+            me.follow(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertMaxQueries(self, url, limit, posts=10):
+        with QueryCounter() as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b'hello cat'), posts)
+        self.assertLessEqual(queries.count, limit, '\n'.join(queries.statements))
+        return queries.statements
+
+    # each page also runs its conditional GET watermark query, and one looking
+    # up every @mention on the page
+
+    def test_index(self):
+        # one more than explore for the who to follow suggestions
+        self.assertMaxQueries('/index', 6)
+
+    def test_explore(self):
+        self.assertMaxQueries('/explore', 5)
+
+    def test_user(self):
+        statements = self.assertMaxQueries('/user/user3', 7, posts=1)
+        self.assertFalse([s for s in statements if 'count(' in s.lower()])
+
+    def test_post_fragments_are_cached(self):
+        first = self.client.get('/explore').data
+        self.assertEqual(fragments.stats()['misses'], 10)
+        self.assertEqual(self.client.get('/index').data.count(b'hello cat'), 10)
+        self.assertEqual(fragments.stats()['hits'], 10)
+        self.assertEqual(self.client.get('/explore').data, first)
+
+        u = User.query.filter_by(username='user3').first()
+        version = u.profile_version
+        u.about_me = 'not shown next to posts'
+        db.session.commit()
+        self.assertEqual(u.profile_version, version)
+        u.username = 'renamed'
+        db.session.commit()
+        self.assertGreater(u.profile_version, version)
+        self.assertEqual(u.profile_version,
+                         db.session.query(db.func.max(User.profile_version)).scalar())
+        page = self.client.get('/explore').data
+        self.assertIn(b'/user/renamed', page)
+        # user3's post, and user2's whose @user3 no longer names anyone
+        self.assertEqual(fragments.stats()['misses'], 12)
+        self.assertNotIn(b'/user/user3', page)
+
+    def test_cached_fragments_follow_mentioned_users(self):
+        self.assertNotIn(b'href="/user/nobody"', self.client.get('/explore').data)
+        db.session.add(User(username='nobody', email='nobody@example.com'))
+        db.session.commit()
+        self.assertEqual(self.client.get('/explore').data.count(b'href="/user/nobody"'), 10)
+        User.query.filter_by(username='nobody').one().username = 'somebody'
+        db.session.commit()
+        self.assertNotIn(b'href="/user/nobody"', self.client.get('/explore').data)
+
+    def test_reused_post_id_gets_a_fresh_fragment(self):
+        self.client.get('/explore')
+        newest = Post.query.order_by(Post.id.desc()).first()
+        post_id = newest.id
+        db.session.delete(newest)
+        db.session.commit()
+        post = Post(body='a new post', author=User.query.get(1))
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(post.id, post_id) # sqlite hands out the rowid again
+        page = self.client.get('/explore').data
+        self.assertIn(b'a new post', page)
+        self.assertNotIn(b'hello cat 9', page)
+
+    def test_post_fragments_from_shared_store(self):
+        store = DictStore()
+        self.app.config['FRAGMENT_CACHE_STORE'] = store
+        fragments.init_app(self.app)
+        page = self.client.get('/explore').data
+        self.assertEqual(len(store.values), 10)
+        fragments.init_app(self.app) # a fresh process on the same store
+        self.assertEqual(self.client.get('/explore').data, page)
+        self.assertEqual(fragments.stats()['store_hits'], 10)
+        self.assertEqual(fragments.stats()['misses'], 0)
+
+    def test_search(self):
+        self.assertMaxQueries('/search?q=cat', 5)
+
+class ConditionalGetCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['LAST_SEEN_FLUSH_INTERVAL'] = 60
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.me = User(username='john', email='john@example.com')
+        self.me.set_password('cat')
+        self.susan = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.me, self.susan,
+                            Post(body='hello', author=self.susan),
+                            Post(body='my own', author=self.me)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        last_seen.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def revalidate(self, url, response, **headers):
+        if not headers:
+            headers['If-None-Match'] = response.headers['ETag']
+        with QueryCounter() as queries:
+            again = self.client.get(url, headers=headers)
+        return again, queries
+
+    def test_not_modified_costs_one_query(self):
+        for url in '/explore', '/index', '/user/susan':
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.headers['ETag'].startswith('W/'))
+            self.assertNotIn('Last-Modified', response.headers)
+            self.assertIn('private', response.headers['Cache-Control'])
+            again, queries = self.revalidate(url, response)
+            self.assertEqual(again.status_code, 304)
+            self.assertEqual(again.data, b'')
+            self.assertEqual(again.headers['ETag'], response.headers['ETag'])
+            self.assertLessEqual(queries.count, 1, '\n'.join(queries.statements))
+
+    def test_if_modified_since_alone_renders(self):
+        response = self.client.get('/explore')
+        again, _ = self.revalidate('/explore', response, **{
+            'If-Modified-Since': http_date(datetime.utcnow() + timedelta(hours=1)),
+        })
+        self.assertEqual(again.status_code, 200)
+
+    def test_author_changes_move_the_watermarks(self):
+        self.me.follow(self.susan)
+        db.session.commit()
+        pages = [(url, self.client.get(url)) for url in ('/explore', '/index')]
+        self.susan.username = 'susanna'
+        db.session.commit()
+        for url, response in pages:
+            again = self.revalidate(url, response)[0]
+            self.assertEqual(again.status_code, 200)
+            self.assertIn(b'/user/susanna', again.data)
+        # a new user may be someone a post mentions
+        explore = self.client.get('/explore')
+        db.session.add(User(username='bob', email='bob@example.com'))
+        db.session.commit()
+        self.assertEqual(self.revalidate('/explore', explore)[0].status_code, 200)
+
+    def test_changes_move_the_watermarks(self):
+        explore = self.client.get('/explore')
+        index = self.client.get('/index')
+        profile = self.client.get('/user/susan')
+
+        self.me.follow(self.susan)
+        db.session.commit()
+        self.assertEqual(self.revalidate('/index', index)[0].status_code, 200)
+        self.assertEqual(self.revalidate('/user/susan', profile)[0].status_code, 200)
+        explore = self.client.get('/explore')
+        index = self.client.get('/index')
+        profile = self.client.get('/user/susan')
+
+        db.session.add(Post(body='news', author=self.susan))
+        db.session.commit()
+        for url, response in (('/explore', explore), ('/index', index),
+                              ('/user/susan', profile)):
+            again = self.revalidate(url, response)[0]
+            self.assertEqual(again.status_code, 200)
+            self.assertIn(b'news', again.data)
+
+        profile = self.client.get('/user/susan')
+        self.susan.about_me = 'hi there'
+        db.session.commit()
+        self.assertIn(b'hi there',
+                      self.revalidate('/user/susan', profile)[0].data)
+
+class TimelineCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['POSTS_PER_PAGE'] = 5
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.me = User(username='john', email='john@example.com')
+        self.me.set_password('cat')
+        self.others = [User(username='user{}'.format(i),
+                            email='user{}@example.com'.format(i))
+                       for i in range(3)]
+        db.session.add_all([self.me] + self.others)
+        now = datetime.utcnow()
+        db.session.add_all([
+            Post(body='post {}'.format(i), author=self.others[i % 3],
+                 timestamp=now - timedelta(minutes=i))
+            for i in range(12)
+        ])
+        db.session.commit()
+        for u in self.others[:2]:
+            self.me.follow(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def pages(self):
+        """post bodies on every page of the home timeline, oldest page last"""
+        pages, url = [], '/index'
+        while url:
+            html = self.client.get(url).data.decode()
+            pages.append(re.findall(r'<div>(post \d+|news)</div>', html))
+            url = re.search(r'href="(/index\?after=[\w-]+)"', html)
+            url = url and url.group(1)
+        return pages
+
+    def test_hot_users_are_cached(self):
+        expected = [['post 0', 'post 1', 'post 3', 'post 4', 'post 6'],
+                    ['post 7', 'post 9', 'post 10']]
+        self.client.get('/index') # seen once
+        self.assertEqual(timeline_cache.stats()['users'], 0)
+        self.assertEqual(self.pages(), expected) # admitted
+        self.assertEqual(timeline_cache.stats()['users'], 1)
+        with QueryCounter() as queries:
+            self.assertEqual(self.pages(), expected)
+        # only the head check per page reads the timeline table
+        self.assertEqual(
+            len([s for s in queries.statements if 'FROM timeline' in s]), 2
+        )
+        stats = timeline_cache.stats()
+        self.assertEqual(stats['bytes_per_user'], stats['bytes'])
+        self.assertGreater(stats['hit_ratio'], .5)
+
+        second = self.client.get('/index?after=' + re.search(
+            r'after=([\w-]+)', self.client.get('/index').data.decode()
+        ).group(1)).data.decode()
+        first = self.client.get('/index?before=' + re.search(
+            r'before=([\w-]+)', second
+        ).group(1)).data.decode()
+        self.assertEqual(re.findall(r'<div>(post \d+)</div>', first), expected[0])
+        self.assertEqual(timeline_cache.stats()['misses'], stats['misses'])
+
+    def test_new_posts_are_prepended(self):
+        self.pages()
+        self.pages()
+        misses = timeline_cache.stats()['misses']
+        db.session.add(Post(body='news', author=self.others[0]))
+        db.session.commit()
+        self.assertEqual(self.pages()[0][:2], ['news', 'post 0'])
+        self.assertEqual(timeline_cache.stats()['misses'], misses)
+
+    def test_stale_entries_are_refilled(self):
+        self.pages()
+        self.pages()
+        # another process posted: the timeline moved without a prepend here
+        post = Post(body='news', author=self.others[0])
+        db.session.add(post)
+        db.session.flush()
+        db.session.info.pop('posts_published')
+        db.session.commit()
+        self.assertEqual(self.pages()[0][0], 'news')
+        self.me.unfollow(self.others[0])
+        db.session.commit()
+        self.assertEqual(self.pages(), [['post 1', 'post 4', 'post 7', 'post 10']])
+
+    def test_follows_elsewhere_are_noticed(self):
+        self.pages()
+        self.pages()
+        index = self.client.get('/index')
+        # another process followed user2, whose posts are all older than the
+        # head; the snapshot behind current_user here still has the old version
+        self.me.follow(self.others[2])
+        db.session.flush()
+        db.session.info.pop('users_changed')
+        db.session.commit()
+        self.assertIn('post 2', self.pages()[0])
+        again = self.client.get('/index', headers={'If-None-Match': index.headers['ETag']})
+        self.assertEqual(again.status_code, 200)
+
+    def test_memory_budget(self):
+        self.pages()
+        self.pages()
+        size = timeline_cache.stats()['bytes']
+        self.app.config['TIMELINE_CACHE_BYTES'] = size
+        timeline_cache.put(99, 1, range(1000), True)
+        self.assertLessEqual(timeline_cache.stats()['bytes'], size)
+        self.assertEqual(timeline_cache.cached_users(), [])
+
+class QueryPlanCase(unittest.TestCase):
+    """the queries behind every hot page must be served from indexes"""
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i))
+                 for i in range(5)]
+        users[0].set_password('cat')
+        db.session.add_all(users)
+        db.session.add_all([Post(body='hello {}'.format(i), author=users[i % 5])
+                            for i in range(20)])
+        db.session.commit()
+        for u in users[1:4]:
+            users[0].follow(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'user0',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def full_scans(self, queries):
+        scans = []
+        conn = db.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            for statement, parameters in zip(queries.statements,
+                                             queries.parameters):
+                if isinstance(parameters, list) or parameters and \
+                        isinstance(parameters[0], (tuple, list)): # executemany
+                    parameters = parameters[0]
+                cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                for row in cursor.fetchall():
+                    detail = row[-1]
+                    if re.match(r'^SCAN (TABLE )?\w+$', detail) or \
+                            'TEMP B-TREE' in detail:
+                        scans.append('{}\n  {}'.format(statement, detail))
+        finally:
+            conn.close()
+        return scans
+
+    def assertIndexed(self, *requests):
+        with QueryCounter() as queries:
+            for method, url, *data in requests:
+                response = self.client.open(url, method=method,
+                                            data=data[0] if data else None)
+                self.assertLess(response.status_code, 400)
+        scans = self.full_scans(queries)
+        self.assertEqual(scans, [], '\n'.join(scans))
+
+    def test_index(self):
+        response = self.client.get('/index')
+        after = re.search(r'after=([\w-]+)', response.data.decode()).group(1)
+        self.assertIndexed(('GET', '/index'),
+                           ('GET', '/index?after=' + after),
+                           ('GET', '/index?before=' + after))
+
+    def test_explore(self):
+        response = self.client.get('/explore')
+        after = re.search(r'after=([\w-]+)', response.data.decode()).group(1)
+        self.assertIndexed(('GET', '/explore'),
+                           ('GET', '/explore?after=' + after),
+                           ('GET', '/explore?before=' + after))
+
+    def test_user(self):
+        response = self.client.get('/user/user2')
+        after = re.search(r'after=([\w-]+)', response.data.decode()).group(1)
+        self.assertIndexed(('GET', '/user/user2'),
+                           ('GET', '/user/user2?after=' + after))
+
+    def test_trending(self):
+        self.assertIndexed(('GET', '/explore?mode=trending'))
+
+    def test_tags_and_mentions(self):
+        db.session.add_all([Post(body='#hello @user0 {}'.format(i), user_id=2)
+                            for i in range(20)])
+        db.session.commit()
+        response = self.client.get('/tag/hello')
+        after = re.search(r'after=([\w-]+)', response.data.decode()).group(1)
+        self.assertIndexed(('GET', '/tag/hello'),
+                           ('GET', '/tag/hello?after=' + after),
+                           ('GET', '/tag/hello?before=' + after),
+                           ('GET', '/user/user0/mentions'))
+
+    def test_follow_and_post(self):
+        self.assertIndexed(('POST', '/unfollow/user2'),
+                           ('POST', '/follow/user4'),
+                           ('POST', '/index', {'post': 'hi'}))
+        self.assertEqual(Post.query.filter_by(body='hi').count(), 1)
+
+class MetricsConfig(TestConfig):
+    METRICS_ENDPOINT = True
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(MetricsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics_endpoint(self):
+        self.client.get('/explore')
+        self.client.get('/explore')
+        text = self.client.get('/metrics').data.decode()
+        self.assertIn('# TYPE microblog_request_seconds histogram', text)
+        self.assertIn(
+            'microblog_request_seconds_count{endpoint="main.explore"} 2', text
+        )
+        self.assertIn(
+            'microblog_request_queries_bucket{endpoint="main.explore",le="+Inf"} 2',
+            text
+        )
+        render = re.search(
+            r'microblog_request_render_seconds_sum{endpoint="main.explore"} (\S+)',
+            text
+        )
+        self.assertGreater(float(render.group(1)), 0)
+
+    def test_slow_request_log(self):
+        self.app.config['SLOW_REQUEST_THRESHOLD'] = 0
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/explore')
+        self.assertIn('slow request GET /explore?', logs.output[0])
+        self.assertIn('FROM post', logs.output[0])
+
+class BenchmarkCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_generate_and_run(self):
+        counts = datagen.generate(30, posts_per_user=5, follows_per_user=5,
+                                  progress=lambda message: None)
+        self.assertEqual(User.query.count(), 30)
+        self.assertEqual(Post.query.count(), counts['posts'])
+        u = User.query.order_by(User.followers_count.desc()).first()
+        self.assertEqual(u.followers.count(), u.followers_count)
+
+        # one client: the in-memory database is a single shared connection
+        results = harness.run(self.app, requests=4, concurrency=1,
+                              progress=lambda message: None)
+        self.assertEqual(set(results['scenarios']),
+                         set(harness.SCENARIOS) | {'login'})
+        for summary in results['scenarios'].values():
+            self.assertEqual((summary['requests'], summary['errors']), (4, 0))
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+
+    def test_percentile_is_nearest_rank(self):
+        ordered = list(range(1, 101))
+        self.assertEqual([percentile(ordered, f) for f in (.5, .95, .99, 1)],
+                         [50, 95, 99, 100])
+        self.assertEqual(percentile([7], .5), 7)
+        self.assertIsNone(percentile([], .5))
+
+class StartupCase(unittest.TestCase):
+    def test_heavy_libraries_are_deferred(self):
+        result = startup.probe()
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['imported_early'], [])
+
+    def test_lazy_extensions(self):
+        app = create_app(TestConfig)
+        client = LazyElasticsearch('http://localhost:9200')
+        self.assertIsNone(client._client) # pylint: disable=protected-access
+        self.assertTrue(client)
+        self.assertIsNotNone(client.transport)
+        self.assertIsNotNone(client._client) # pylint: disable=protected-access
+        # flask-migrate is set up on first use, as `flask db` would
+        self.assertEqual(app.extensions['migrate'].directory, 'migrations')
+        self.assertIs(app.extensions['migrate'].db, db)
+
+    def test_bytecode_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+
+            class CachedConfig(TestConfig):
+                JINJA_BYTECODE_CACHE = directory
+
+            app = create_app(CachedConfig)
+            names = compile_templates(app)
+            self.assertIn('_post.html', names)
+            self.assertEqual(len(os.listdir(directory)), len(names))
+            # a new process loads the compiled code instead of compiling again
+            app = create_app(CachedConfig)
+            compiled = []
+            app.jinja_env.compile = lambda *args, **kwargs: compiled.append(args)
+            app.jinja_env.get_template('_post.html')
+            self.assertEqual(compiled, [])
+
+class PasswordHashingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        hasher.shutdown()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_process_pool(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.pw_hash.startswith('pbkdf2:sha256:150000$'))
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_full_queue_fails_fast(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        self.app.config['PASSWORD_HASH_QUEUE'] = 0
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        slots = self.app.extensions['hasher'].slots
+        slots.acquire() # the one worker is busy
+        try:
+            response = self.client.post('/auth/login', data={
+                'username': 'susan', 'password': 'cat'
+            })
+        finally:
+            slots.release()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_slow_or_broken_pool_is_unavailable(self):
+        self.app.config['PASSWORD_HASH_WORKERS'] = 1
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 0.2
+        with self.assertRaises(ServiceUnavailable):
+            hasher._submit(time.sleep, 1)
+        self.app.config['PASSWORD_HASH_TIMEOUT'] = 10
+        broken = self.app.extensions['hasher'].executor
+        with self.assertRaises(ServiceUnavailable):
+            hasher._submit(os._exit, 1) # the worker dies
+        self.assertIsNot(self.app.extensions['hasher'].executor, broken)
+        u = User(username='susan')
+        u.set_password('cat') # on a fresh pool
+        self.assertTrue(u.check_password('cat'))
+
+    def test_rehash_on_login(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.assertTrue(u.password_needs_rehash())
+        self.client.post('/auth/login', data={'username': 'susan',
+                                              'password': 'dog'})
+        self.assertTrue(u.pw_hash.startswith('pbkdf2:sha256:1000$'))
+        response = self.client.post('/auth/login', data={
+            'username': 'susan', 'password': 'cat'
+        })
+        self.assertEqual(response.status_code, 302)
+        db.session.expire_all()
+        self.assertTrue(u.pw_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+class IdentityCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_snapshot_is_cached_and_read_only(self):
+        snapshot = load_user(str(self.u1.id))
+        with QueryCounter() as queries:
+            self.assertIs(load_user(str(self.u1.id)), snapshot)
+            self.assertEqual(snapshot.username, 'john')
+            self.assertEqual(snapshot.avatar(36), self.u1.avatar(36))
+            self.assertEqual(snapshot, self.u1)
+        self.assertEqual(queries.count, 0)
+        self.assertFalse(hasattr(snapshot, 'pw_hash') and
+                         'pw_hash' in snapshot.__dict__['_data'])
+
+    def test_writes_upgrade_and_invalidate(self):
+        u1_id, u2_id = self.u1.id, self.u2.id
+        snapshot = load_user(str(u1_id))
+        self.assertFalse(snapshot.is_following(self.u2))
+        snapshot.follow(self.u2)
+        snapshot.about_me = 'hi'
+        self.assertEqual(snapshot.about_me, 'hi') # reads the live object now
+        db.session.commit()
+        db.session.remove()
+        with self.app.app_context():
+            fresh = load_user(str(u1_id))
+            self.assertIsNot(fresh, snapshot)
+            self.assertEqual(fresh.about_me, 'hi')
+            self.assertEqual(fresh.following_count, 1)
+            self.assertTrue(fresh.is_following(User.query.get(u2_id)))
+            self.assertEqual(fresh.following.count(), 1)
+
+    def test_shared_store(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config['IDENTITY_CACHE_PATH'] = os.path.join(tmp, 'ids.db')
+            identity_cache.init_app(self.app)
+            load_user(str(self.u1.id))
+            self.app.extensions['identity_cache'].entries.clear()
+            with QueryCounter() as queries:
+                snapshot = load_user(str(self.u1.id))
+            self.assertEqual(queries.count, 0)
+            self.assertEqual(snapshot.last_seen, self.u1.last_seen)
+            identity_cache.invalidate([self.u1.id])
+            db.session.expunge_all()
+            with QueryCounter() as queries:
+                load_user(str(self.u1.id))
+            self.assertEqual(queries.count, 1)
+
+    def test_invalidation_reaches_other_processes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.app.config['IDENTITY_CACHE_PATH'] = os.path.join(tmp, 'ids.db')
+            identity_cache.init_app(self.app)
+            snapshot = load_user(str(self.u1.id))
+            self.assertIs(load_user(str(self.u1.id)), snapshot)
+            # another process's invalidate only reaches the shared store
+            db.session.execute("UPDATE user SET username = 'johnny' WHERE id = :id",
+                               {'id': self.u1.id})
+            db.session.commit()
+            self.app.extensions['identity_cache'].store.delete([self.u1.id])
+            fresh = load_user(str(self.u1.id))
+            self.assertIsNot(fresh, snapshot)
+            self.assertEqual(fresh.username, 'johnny')
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        primary = os.path.join(self.tmp.name, 'primary.db')
+        replica = os.path.join(self.tmp.name, 'replica.db')
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + primary
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + replica]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add_all([u, Post(body='old post', author=u)])
+        db.session.commit()
+        sync_replicas(self.app)
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john',
+                                              'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_reads_go_to_replica_until_synced(self):
+        db.session.add(Post(body='new post', user_id=1))
+        db.session.commit()
+        page = self.client.get('/explore').data
+        self.assertIn(b'old post', page)
+        self.assertNotIn(b'new post', page)
+        sync_replicas(self.app)
+        self.assertIn(b'new post', self.client.get('/explore').data)
+
+    def test_clients_read_their_own_writes(self):
+        page = self.client.post('/index', data={'post': 'my post'},
+                                follow_redirects=True).data
+        self.assertIn(b'my post', page)
+        self.assertIn(b'my post', self.client.get('/explore').data)
+        self.app.config['REPLICA_READ_AFTER_WRITE'] = 0
+        self.assertNotIn(b'my post', self.client.get('/explore').data)
+
+class SQLiteProductionCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, 'app.db')
+
+        class ProductionConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + path
+            SQLITE_PRODUCTION = True
+
+        self.app = create_app(ProductionConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.write_engine.dispose()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_pragmas(self):
+        for engine in db.engine, db.write_engine:
+            with engine.connect() as conn:
+                pragma = lambda name: conn.execute('PRAGMA ' + name).scalar()
+                self.assertEqual(pragma('journal_mode'), 'wal')
+                self.assertEqual(pragma('busy_timeout'), 5000)
+                self.assertEqual(pragma('synchronous'), 1)
+                self.assertEqual(pragma('cache_size'), -65536)
+
+    def test_writes_use_the_writer_connection(self):
+        self.assertIsNot(db.write_engine, db.engine)
+        self.assertEqual(db.write_engine.pool.size(), 1)
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        self.assertIs(db.session.get_bind(), db.engine)
+        db.session.flush()
+        self.assertIs(db.session.get_bind(), db.write_engine)
+        db.session.commit()
+        self.assertIs(db.session.get_bind(), db.engine)
+
+    def test_concurrent_writers(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        errors = []
+
+        def write(n):
+            with self.app.app_context():
+                try:
+                    for i in range(10):
+                        db.session.add(Post(body='{} {}'.format(n, i), user_id=1))
+                        db.session.commit()
+                        last_seen.touch(1)
+                except Exception as error: # pylint: disable=broad-except
+                    errors.append(error)
+
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Post.query.count(), 80)
+        self.assertEqual(User.query.get(1).post_count, 80)
+
+class StreamCase(unittest.TestCase):
+    def setUp(self):
+        # the stream server reads from its own threads, which an in-memory
+        # database would share a single connection with
+        self.tmp = tempfile.TemporaryDirectory()
+
+        class StreamConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.tmp.name, 'app.db')
+
+        self.app = create_app(StreamConfig)
+        self.app.config.update(STREAM_PORT=0, STREAM_HOST='127.0.0.1',
+                               STREAM_POLL_INTERVAL=.05)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john, self.susan, self.david = [
+            User(username=name, email=name + '@example.com')
+            for name in ('john', 'susan', 'david')
+        ]
+        db.session.add_all([self.john, self.susan, self.david])
+        db.session.commit()
+        self.john.follow(self.susan)
+        db.session.commit()
+        self.server = post_stream.start()
+        self.sockets = []
+
+    def tearDown(self):
+        self.server.stop()
+        for sock in self.sockets:
+            sock.close()
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def connect(self, user=None, scope='home'):
+        sock = socket.create_connection(('127.0.0.1', self.server.port), timeout=2)
+        self.sockets.append(sock)
+        cookie = ''
+        if user is not None:
+            cookie = 'Cookie: session={}\r\n'.format(
+                self.app.session_interface.get_signing_serializer(self.app)
+                .dumps({'_user_id': str(user.id)})
+            )
+        sock.sendall('GET /stream?scope={} HTTP/1.1\r\nHost: localhost\r\n{}\r\n'
+                     .format(scope, cookie).encode('latin-1'))
+        return sock, self.read(sock)
+
+    def read(self, sock, timeout=2):
+        sock.settimeout(timeout)
+        data = b''
+        try:
+            while not data.endswith(b'\n\n'):
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        except socket.timeout:
+            pass
+        return data.decode('latin-1')
+
+    def wait_for_subscribers(self, count):
+        for _ in range(100):
+            if self.server.connections >= count:
+                return
+            time.sleep(.01)
+        self.fail('only {} subscribers'.format(self.server.connections))
+
+    def test_clients_get_relevant_posts(self):
+        home, preamble = self.connect(self.john)
+        self.assertIn('200 OK', preamble)
+        self.assertIn('text/event-stream', preamble)
+        explore, _ = self.connect(self.david, scope='explore')
+        bystander, _ = self.connect(self.david)
+        self.wait_for_subscribers(3)
+
+        post = Post(body='hello', author=self.susan)
+        db.session.add(post)
+        db.session.commit()
+        event = 'id: {0}\nevent: post\ndata: {0}\n\n'.format(post.id)
+        self.assertEqual(self.read(home), event)
+        self.assertEqual(self.read(explore), event)
+        self.assertEqual(self.read(bystander, timeout=.2), '')
+
+    def test_posts_from_other_processes_are_polled(self):
+        explore, _ = self.connect(self.david, scope='explore')
+        self.wait_for_subscribers(1)
+        time.sleep(.1) # let the poller see the starting point
+        db.session.execute(Post.__table__.insert().values(
+            body='elsewhere', user_id=self.susan.id
+        ))
+        db.session.commit()
+        self.assertIn('event: post', self.read(explore))
+
+    def test_anonymous_clients_are_refused(self):
+        self.assertIn('401', self.connect()[1])
+
+    def test_url(self):
+        with self.app.test_request_context(base_url='http://example.com:5000'):
+            # browsers can't reach a server on loopback without a proxy
+            self.assertIsNone(post_stream.url('home'))
+            self.app.config['STREAM_URL'] = '/stream'
+            self.assertEqual(post_stream.url('home'), '/stream?scope=home')
+            self.app.config.update(STREAM_URL=None, STREAM_HOST='0.0.0.0')
+            self.assertEqual(post_stream.url('explore'), '//example.com:{}/stream'
+                             '?scope=explore'.format(self.server.port))
+
+    def test_idle_connections_need_no_threads(self):
+        self.connect(self.john)
+        self.wait_for_subscribers(1)
+        threads = threading.active_count()
+        for _ in range(50):
+            self.connect(self.john, scope='explore')
+        self.wait_for_subscribers(51)
+        self.assertEqual(threading.active_count(), threads)
+
+class AssetsCase(unittest.TestCase):
+    script = b'/* jquery stand-in */\n' + b'function noop() { return null; }\n' * 200
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        static = os.path.join(self.tmp.name, 'static')
+        os.makedirs(os.path.join(static, 'vendor'))
+        with open(os.path.join(static, 'vendor', 'jquery-3.5.1.min.js'), 'wb') as f:
+            f.write(self.script)
+        self.dist = os.path.join(static, 'dist')
+        self.scripts = {'vendor/jquery-3.5.1.min.js': ('', integrity(self.script))}
+        self.manifest = build(static, self.dist, scripts=self.scripts)
+
+        class AssetsConfig(TestConfig):
+            ASSETS_DIST = self.dist
+
+        self.app = create_app(AssetsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username='john', email='john@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.add_all([Post(body='post {}'.format(i), author=u) for i in range(3)])
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'john', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmp.cleanup()
+
+    def test_build(self):
+        hashed = self.manifest['vendor/jquery-3.5.1.min.js']
+        self.assertRegex(hashed, r'^vendor/jquery-3\.5\.1\.min\.[0-9a-f]{12}\.js$')
+        self.assertEqual(list(self.manifest), ['vendor/jquery-3.5.1.min.js'])
+        with open(os.path.join(self.dist, hashed + '.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.script)
+        # a rebuild neither picks up its own output nor changes names
+        static = os.path.dirname(self.dist)
+        self.assertEqual(build(static, self.dist, scripts=self.scripts), self.manifest)
+
+    def test_build_needs_intact_vendored_scripts(self):
+        static = os.path.dirname(self.dist)
+        # the stand-in isn't the jquery build VENDOR pins
+        with self.assertRaisesRegex(ValueError, 'jquery.* integrity hash'):
+            build(static, self.dist)
+        os.remove(os.path.join(static, 'vendor', 'jquery-3.5.1.min.js'))
+        with self.assertRaisesRegex(ValueError, 'jquery.* is missing'):
+            build(static, self.dist, scripts=self.scripts)
+        # while the cdn fallback is on, only present scripts must be intact
+        self.assertEqual(build(static, self.dist, scripts=self.scripts,
+                               missing_ok=True), {})
+
+    def test_default_config_renders(self):
+        response = create_app(Config).test_client().get('/auth/login')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'jquery', response.data)
+
+    def test_pages_use_fingerprinted_scripts(self):
+        html = self.client.get('/index').data.decode()
+        url = '/assets/' + self.manifest['vendor/jquery-3.5.1.min.js']
+        self.assertIn('<script src="{}">'.format(url), html)
+        self.assertNotIn('code.jquery.com', html)
+        # not vendored, so from the cdn only because ASSETS_CDN_FALLBACK says so
+        self.assertIn('cdnjs.cloudflare.com', html)
+        self.app.config['ASSETS_CDN_FALLBACK'] = False
+        with self.assertRaisesRegex(RuntimeError, 'moment-with-locales.* is not vendored'):
+            self.client.get('/explore')
+        self.app.config['ASSETS_CDN_FALLBACK'] = True
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(response.mimetype.endswith('/javascript'))
+        self.assertIn('Accept-Encoding', response.vary)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, 365 * 24 * 60 * 60)
+        self.assertEqual(gzip.decompress(response.data), self.script)
+
+        response = self.client.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.script)
+        self.assertEqual(self.client.get('/assets/vendor/missing.js').status_code, 404)
+
+    def test_response_compression(self):
+        plain = self.client.get('/explore')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.vary)
+        packed = self.client.get('/explore', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(packed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(packed.data), plain.data)
+        self.assertLess(len(packed.data), len(plain.data))
+        # revalidation still works against the compressed response
+        response = self.client.get('/explore', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': packed.headers['ETag'],
+        })
+        self.assertEqual(response.status_code, 304)
+        refused = self.client.get('/explore', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', refused.headers)
+
+        self.app.config['COMPRESS_MIN_SIZE'] = 10 ** 6
+        response = self.client.get('/explore', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+
+class TrendingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username='user{}'.format(i),
+                           email='user{}@example.com'.format(i))
+                      for i in range(4)]
+        self.users[0].set_password('cat')
+        db.session.add_all(self.users)
+        db.session.commit()
+        self.now = datetime.utcnow()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, author, body, hours_ago=0):
+        p = Post(body=body, author=author,
+                 timestamp=self.now - timedelta(hours=hours_ago))
+        db.session.add(p)
+        db.session.commit()
+        return p
+
+    def test_newer_posts_rank_higher(self):
+        old = self.post(self.users[1], 'old', hours_ago=12)
+        new = self.post(self.users[2], 'new', hours_ago=1)
+        self.assertEqual(trending.top(), [new.id, old.id])
+        self.assertEqual(Post.trending_posts(), [new, old])
+
+    def test_weights_decay_by_half_life(self):
+        p = self.post(self.users[1], 'hello', hours_ago=6)
+        score = db.session.execute('SELECT score FROM trending').scalar()
+        self.assertAlmostEqual(trending.weight(score, self.now), .5)
+        self.assertAlmostEqual(trending.weight(score, self.now + timedelta(hours=6)), .25)
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(trending.top(), [])
+
+    def test_follows_lift_the_authors_posts(self):
+        popular = self.post(self.users[1], 'popular', hours_ago=3)
+        fresh = self.post(self.users[2], 'fresh')
+        self.assertEqual(trending.top(), [fresh.id, popular.id])
+        for u in (self.users[0], self.users[3]):
+            u.follow(self.users[1])
+        db.session.commit()
+        self.assertEqual(trending.top(), [popular.id, fresh.id])
+        # 1 to start with, halved every 6 hours, and 1 per follow just now
+        score = db.session.execute(
+            'SELECT score FROM trending WHERE post_id = :id', {'id': popular.id}
+        ).scalar()
+        self.assertAlmostEqual(trending.weight(score, self.now), 2 ** -.5 + 2, places=2)
+
+    def test_decay_and_rebuild(self):
+        self.app.config['TRENDING_SIZE'] = 2
+        ancient = self.post(self.users[1], 'ancient', hours_ago=48)
+        posts = [self.post(self.users[i % 3], 'post {}'.format(i), hours_ago=i)
+                 for i in range(3)]
+        self.assertEqual(len(trending.top()), 4)
+        # the 48 hour old post is under the minimum, the 2 hour old one past the size
+        self.assertEqual(trending.decay(self.now), 2)
+        self.assertEqual(trending.top(), [posts[0].id, posts[1].id])
+
+        self.app.config['TRENDING_SIZE'] = 10
+        self.assertEqual(trending.rebuild(self.now), 3)
+        self.assertNotIn(ancient.id, trending.top())
+
+    def test_explore_modes(self):
+        self.post(self.users[1], 'followed author', hours_ago=5)
+        self.post(self.users[2], 'unknown author')
+        self.users[0].follow(self.users[1])
+        self.users[3].follow(self.users[1])
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+        html = client.get('/explore?mode=trending').data.decode()
+        self.assertLess(html.index('followed author'), html.index('unknown author'))
+        self.assertIn('href="/explore">latest</a>', html)
+        self.assertNotIn('ETag', client.get('/explore?mode=trending').headers)
+        html = client.get('/explore').data.decode()
+        self.assertLess(html.index('unknown author'), html.index('followed author'))
+        self.assertIn('href="/explore?mode=trending">trending</a>', html)
+
+class SuggestionsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['SUGGESTIONS_BATCH'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username='user{}'.format(i),
+                           email='user{}@example.com'.format(i))
+                      for i in range(6)]
+        self.users[0].set_password('cat')
+        db.session.add_all(self.users)
+        db.session.commit()
+        for follower, followed in ((0, 1), (0, 2), (1, 3), (1, 4), (2, 3),
+                                   (2, 0), (3, 4), (5, 4)):
+            self.users[follower].follow(self.users[followed])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def rows(self):
+        return db.session.execute(
+            'SELECT user_id, rank, suggested_id, mutual FROM suggestion '
+            'ORDER BY user_id, rank'
+        ).fetchall()
+
+    def test_second_degree_by_mutual_follows(self):
+        u0, u1, u2, u3, u4, _ = self.users
+        self.assertEqual(suggestions.build(workers=0), 4)
+        # user3 through both user1 and user2, then user4 through user1
+        self.assertEqual(u0.suggestions(), [(u3, 2), (u4, 1)])
+        # ties go to the more followed account
+        self.assertEqual(u2.suggestions(), [(u4, 1), (u1, 1)])
+        self.assertEqual(u4.suggestions(), [])
+        u0.follow(u3)
+        db.session.commit()
+        self.assertEqual(u0.suggestions(), [(u4, 1)])
+
+    def test_fan_in_is_sampled(self):
+        u0, _, _, u3, _, _ = self.users
+        self.app.config['SUGGESTIONS_MAX_FANIN'] = 1
+        suggestions.build(workers=0)
+        # user1 only contributes user3 and user2 only user0, who is skipped
+        self.assertEqual(u0.suggestions(), [(u3, 1)])
+
+    def test_worker_processes_write_the_same_rows(self):
+        suggestions.build(workers=0)
+        expected = self.rows()
+        db.session.execute('DELETE FROM suggestion')
+        db.session.execute(
+            'INSERT INTO suggestion VALUES (:id, 0, :id, 99)', {'id': self.users[4].id}
+        )
+        db.session.commit()
+        self.assertEqual(suggestions.build(workers=2), len(expected))
+        self.assertEqual(self.rows(), expected)
+
+    def test_shown_on_home_page(self):
+        suggestions.build(workers=0)
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'user0', 'password': 'cat'})
+        html = client.get('/index').data.decode()
+        self.assertIn('who to follow', html)
+        self.assertIn('href="/user/user3">user3</a>', html)
+        client.post('/follow/user3')
+        client.post('/follow/user4')
+        self.assertNotIn('who to follow', client.get('/index').data.decode())
+
+class TagIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config['POSTS_PER_PAGE'] = 2
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.susan = User(username='susan', email='susan@example.com')
+        self.susan.set_password('cat')
+        self.john = User(username='john', email='john@example.com')
+        db.session.add_all([self.susan, self.john])
+        db.session.commit()
+        self.now = datetime.utcnow()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'username': 'susan', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, body, seconds_ago=0):
+        p = Post(body=body, author=self.john,
+                 timestamp=self.now - timedelta(seconds=seconds_ago))
+        db.session.add(p)
+        db.session.commit()
+        return p
+
+    def test_terms(self):
+        self.assertEqual(terms('#Cats and #cats, @Susan! mail me@example.com #'),
+                         {'#cats', '@susan'})
+        with self.app.test_request_context():
+            self.assertEqual(link_terms('<b> #Cats @SUSAN @nobody'), '&lt;b&gt; '
+                             '<a href="/tag/cats">#Cats</a> '
+                             '<a href="/user/susan">@SUSAN</a> @nobody')
+
+    def test_indexed_on_flush(self):
+        p = self.post('#a #b @john')
+        self.assertEqual([term for term, in db.session.execute(
+            'SELECT term FROM post_term WHERE post_id = :id ORDER BY term', {'id': p.id}
+        )], ['#a', '#b', '@john'])
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(db.session.execute('SELECT count(*) FROM post_term').scalar(), 0)
+
+    def test_tag_timeline_pages(self):
+        posts = [self.post('#cats number {}'.format(i), seconds_ago=i) for i in range(3)]
+        self.post('#dogs only')
+        html = self.client.get('/tag/Cats').data.decode()
+        self.assertIn('<h1>#cats</h1>', html)
+        self.assertIn('number 0', html)
+        self.assertIn('number 1', html)
+        self.assertNotIn('dogs only', html)
+        after = re.search(r'/tag/Cats\?after=([\w-]+)', html).group(1)
+        html = self.client.get('/tag/Cats?after=' + after).data.decode()
+        self.assertIn('number 2', html)
+        self.assertNotIn('number 1', html)
+        self.assertEqual(Post.with_term('#cats').count(), len(posts))
+
+    def test_mentions_timeline(self):
+        self.post('hey @Susan')
+        self.post('hey everyone')
+        html = self.client.get('/user/susan').data.decode()
+        self.assertIn('href="/user/susan/mentions"', html)
+        html = self.client.get('/user/susan/mentions').data.decode()
+        self.assertIn('<a href="/user/susan">@Susan</a>', html)
+        self.assertNotIn('hey everyone', html)
+        self.assertEqual(self.client.get('/user/nobody/mentions').status_code, 404)
+
+    def test_backfill(self):
+        self.post('#old @susan')
+        self.post('nothing to see')
+        db.session.execute('DELETE FROM post_term')
+        db.session.commit()
+        done = []
+        self.assertEqual(tag_index.backfill(chunk_size=1,
+                                            progress=lambda *p: done.append(p)), 2)
+        self.assertEqual(done, [(1, 2), (2, 2)])
+        self.assertEqual(Post.term_head('#old').post_id, Post.with_term('@susan').one().id)
+
+class SearchQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.elasticsearch = FakeElasticsearch()
+        self.app.search_backend = ElasticsearchBackend()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_commit_queues_and_drain_coalesces(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='first draft', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        p.body = 'second draft'
+        db.session.commit()
+        u.about_me = 'not searchable'
+        db.session.commit()
+        self.assertEqual(outbox_lag()[0], 2)
+
+        self.assertEqual(drain_outbox(), 2)
+        self.assertEqual(self.app.elasticsearch.requests, [[
+            {'index': {'_index': 'post', '_id': p.id}},
+            {'body': 'second draft'},
+        ]])
+        self.assertEqual(outbox_lag(), (0, 0.0))
+
+    def test_failed_operations_are_retried(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='hello', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.app.elasticsearch.failing.add(p.id)
+        self.assertEqual(drain_outbox(), 0)
+        self.assertEqual(outbox_lag()[0], 1)
+        # backed off, so nothing is due right away
+        self.assertEqual(drain_outbox(), 0)
+        self.assertEqual(len(self.app.elasticsearch.requests), 1)
+
+        db.session.delete(p)
+        db.session.commit()
+        self.app.elasticsearch.failing.clear()
+        db.session.execute('UPDATE search_outbox SET next_attempt = created_at')
+        db.session.commit()
+        self.assertEqual(drain_outbox(), 2)
+        self.assertEqual(self.app.elasticsearch.requests[-1], [
+            {'delete': {'_index': 'post', '_id': p.id}},
+        ])
+
+    def test_newer_operation_retires_older_ones_backing_off(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='stale', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.app.elasticsearch.failing.add(p.id)
+        drain_outbox()
+        db.session.execute('UPDATE search_outbox SET attempts = 3')
+        self.app.elasticsearch.failing.clear()
+        p.body = 'fresh'
+        db.session.commit()
+        # only the newer row is due, and it retires the stale one too
+        self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(self.app.elasticsearch.requests[-1][1], {'body': 'fresh'})
+        self.assertEqual(outbox_lag(), (0, 0.0))
+
+    def test_failures_postpone_every_row_for_the_document(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body='one', author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.app.elasticsearch.failing.add(p.id)
+        drain_outbox()
+        p.body = 'two'
+        db.session.commit()
+        self.assertEqual(drain_outbox(), 0)
+        rows = db.session.execute(
+            'SELECT attempts, next_attempt FROM search_outbox ORDER BY id'
+        ).fetchall()
+        self.assertEqual([attempts for attempts, _ in rows], [2, 1])
+        self.assertEqual(rows[0][1], rows[1][1])
+
+    def test_reindex_resumes_and_swaps_alias(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post {}'.format(i), author=u) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        es = self.app.elasticsearch
+        es.failing.add(posts[4].id)
+        with self.assertRaises(RuntimeError):
+            Post.reindex(chunk_size=2, workers=2)
+        self.assertEqual(es.indices.aliases, {})
+
+        es.failing.clear()
+        es.requests = []
+        Post.reindex(resume=True)
+        self.assertEqual(len(es.indices.created), 1)
+        self.assertEqual(es.indices.aliases, {'post': es.indices.created[0]})
+        # only the id range that failed is sent again
+        self.assertEqual(es.requests, [[
+            {'index': {'_index': es.indices.created[0], '_id': posts[3].id}},
+            {'body': 'post 3'},
+            {'index': {'_index': es.indices.created[0], '_id': posts[4].id}},
+            {'body': 'post 4'},
+        ]])
+
+        old = es.indices.created[0]
+        self.assertEqual(Post.reindex(), [old])
+        self.assertNotEqual(es.indices.aliases['post'], old)
+
+    def test_reindex_catches_up_on_changes_made_during_the_build(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post {}'.format(i), author=u) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        drain_outbox()
+        es = self.app.elasticsearch
+        changed = []
+
+        def progress(*args): # pylint: disable=unused-argument
+            if changed:
+                return
+            db.session.delete(posts[3])
+            late = Post(body='written mid build', author=u)
+            db.session.add(late)
+            db.session.commit()
+            changed.extend([posts[3].id, late.id])
+            es.requests = []
+            drain_outbox()
+
+        Post.reindex(chunk_size=2, workers=1, progress=progress)
+        new = es.indices.aliases['post']
+        deleted_id, late_id = changed
+        # the drain went to the alias and was mirrored into the new index
+        self.assertIn({'delete': {'_index': new, '_id': deleted_id}}, es.requests[0])
+        self.assertIn({'index': {'_index': new, '_id': late_id}}, es.requests[0])
+        # and both documents were synced from the db before the swap
+        self.assertEqual(es.requests[-1], [
+            {'index': {'_index': new, '_id': late_id}},
+            {'body': 'written mid build'},
+            {'delete': {'_index': new, '_id': deleted_id}},
+        ])
+        self.assertFalse(os.path.exists(os.path.join(
+            self.app.instance_path, 'reindex-post.touched'
+        )))
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)